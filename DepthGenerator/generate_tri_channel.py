@@ -1,6 +1,6 @@
 import sys
-sys.path.append("../MidtermVisualization")
-from StereoDepth import Convert3D
+sys.path.append("../evaluation")
+from StereoDepth import Convert3D, StereoEngine
 import matplotlib.pyplot as plt
 import cv2
 import os
@@ -18,6 +18,22 @@ plt.show()
 _, ax = plt.subplots(figsize=(20, 10))
 im = ax.imshow(cv2.imread(os.path.join(directory_l, '000000.png')))
 
+# Same matcher the depth channel has always been generated with. Built once
+# and reused for every image.
+window_size = 5
+engine = StereoEngine(left_matcher=cv2.StereoSGBM_create(
+    minDisparity=0,
+    numDisparities=160,
+    blockSize=5,
+    P1=8 * 3 * window_size ** 2,
+    P2=32 * 3 * window_size ** 2,
+    disp12MaxDiff=1,
+    uniquenessRatio=15,
+    speckleWindowSize=0,
+    speckleRange=2,
+    preFilterCap=63,
+    mode=cv2.STEREO_SGBM_MODE_SGBM_3WAY
+))
 
 for i, filename in enumerate(sorted(os.listdir(directory_l))):
 
@@ -32,7 +48,8 @@ for i, filename in enumerate(sorted(os.listdir(directory_l))):
         image_r = cv2.cvtColor(image_r, cv2.COLOR_BGR2RGB)
 
         # Use StereoDepth Conversions---------------------------------
-        frame = Convert3D(image_l, image_r)
+        # Only depth_img is read, so no reprojection or point cloud is computed.
+        frame = Convert3D(image_l, image_r, engine=engine)
         depth_img = np.clip(frame.depth_img * 2, 0, 255)
         #print(depth_img.shape)
 
@@ -5,6 +5,11 @@
 # When you run this evaluation file, it will evaluate on all of the sequences
 # in vehicle-detection/eval. Adjust the thresholds and plots below as needed.
 #
+# main() reads eval/ once for every threshold in SWEEP and hands the result
+# to each plot. Called on their own, the plots evaluate just what they need.
+# Each sequence's results are saved in eval/<seq>/tpfp.npz, so after
+# regenerating a few sequences only those are evaluated again.
+#
 ###############################################################################
 
 
@@ -16,8 +21,12 @@ from sklearn.metrics import confusion_matrix
 import seaborn as sn
 import pandas as pd
 
-def plotDifficulty(mode = '3D', threshold = 1.5):
-    p_easy, r_easy, p_medium, r_medium, p_hard, r_hard, _ = PR(mode, threshold)
+# Thresholds evaluated by main(), for every plot below.
+SWEEP = {'3D': [10, 5, 3, 1.5], '2D': [0.7]}
+
+def plotDifficulty(mode = '3D', threshold = 1.5, result = None):
+    result = result or Evaluate({mode: [threshold]})
+    p_easy, r_easy, p_medium, r_medium, p_hard, r_hard, _ = result.PR(mode, threshold)
     easy, = plt.plot(r_easy, p_easy, color='r')
     med, = plt.plot(r_medium, p_medium, color='g')
     hard, = plt.plot(r_hard, p_hard, color='b')
@@ -33,11 +42,12 @@ def plotDifficulty(mode = '3D', threshold = 1.5):
     plt.savefig("PRC_Difficulty.png", bbox_inches='tight')
     plt.show()
 
-def plotDistance(mode = '3D'):
-    p10, r10, _ = PR(mode, 10, False)
-    p5, r5, _ = PR(mode, 5, False)
-    p3, r3, _ = PR(mode, 3, False)
-    p15, r15, _ = PR(mode, 1.5, False)
+def plotDistance(mode = '3D', result = None):
+    result = result or Evaluate({mode: [10, 5, 3, 1.5]})
+    p10, r10 = result.Curve(mode, 10)
+    p5, r5 = result.Curve(mode, 5)
+    p3, r3 = result.Curve(mode, 3)
+    p15, r15 = result.Curve(mode, 1.5)
 
     plt1, = plt.plot(r10, p10, color='r')
     plt2, = plt.plot(r5, p5, color = 'g')
@@ -55,9 +65,10 @@ def plotDistance(mode = '3D'):
     plt.savefig("PRC_Distance.png", bbox_inches='tight')
     plt.show()
 
-def plotOrientation(mode = '3D', threshold = 1.5):
+def plotOrientation(mode = '3D', threshold = 1.5, result = None):
     plt.clf()
-    _, _, orientation = PR(mode, threshold, False)
+    result = result or Evaluate({mode: [threshold]})
+    orientation = result.Orientations(mode, threshold)
     word_lbls = ["front","l-diag","side","r-diag"]
     lbls = [0,1,2,3]
     conf_mat = confusion_matrix(orientation[0], orientation[1], labels = lbls)
@@ -70,10 +81,11 @@ def plotOrientation(mode = '3D', threshold = 1.5):
     plt.savefig("Orientation_ConfusionMatrix.png", bbox_inches='tight')
     plt.show()
 
-def plot2DComparison(threshold = 1.5):
+def plot2DComparison(threshold = 1.5, result = None):
     iou = 0.7
-    p_2D, r_2D, _ = PR('2D', iou, False)
-    p_3D, r_3D, _ = PR('3D', threshold, False)
+    result = result or Evaluate({'2D': [iou], '3D': [threshold]})
+    p_2D, r_2D = result.Curve('2D', iou)
+    p_3D, r_3D = result.Curve('3D', threshold)
 
     plt1, = plt.plot(r_2D, p_2D, color = 'r')
     plt2, = plt.plot(r_3D, p_3D, color = 'b')
@@ -90,18 +102,17 @@ def plot2DComparison(threshold = 1.5):
     #plt.show()
 
 # Make a table that has the MAP values for each difficulty and for each distance threshold
-def tableMAP():
+def tableMAP(result = None):
 
     difficulties = ["Easy", "Medium", "Hard"]
     thresholds = [10, 5, 3, 1.5]
+    result = result or Evaluate({'3D': thresholds})
     df = pd.DataFrame()
 
     for threshold in thresholds:
-        p_easy, r_easy, p_med, r_med, p_hard, r_hard, _ = PR('3D', threshold)
-
-        map_easy = round(MAP(p_easy, r_easy), 4)
-        map_med = round(MAP(p_med, r_med), 4)
-        map_hard = round(MAP(p_hard, r_hard), 4)
+        map_easy = round(result.MAP('3D', threshold, 'easy'), 4)
+        map_med = round(result.MAP('3D', threshold, 'medium'), 4)
+        map_hard = round(result.MAP('3D', threshold, 'hard'), 4)
 
         map_column = [map_easy, map_med, map_hard]
 
@@ -125,11 +136,27 @@ def tableMAP():
     plt.show()
 
 
-def plotSingle(mode = '3D', threshold = 1.5):
+# Print the KITTI style APs (see evaluation/averageprecision.py) for each
+# difficulty and orientation. interpolation is '11', '40' or 'all'.
+def printAP(mode = '3D', threshold = 1.5, interpolation = '40', result = None):
+    result = result or Evaluate({mode: [threshold]})
+    aps = result.AP(mode, threshold, interpolation)
+    word_lbls = ["front","l-diag","side","r-diag"]
+
+    print("AP ({0} point interpolation) at {1}, {2}".format(interpolation, threshold, mode))
+    for difficulty in ["all", "easy", "medium", "hard"]:
+        print("  {0:<12} {1:.4f}".format(difficulty, aps[difficulty]))
+    for orientation, ap in aps['orientation'].items():
+        label = word_lbls[orientation] if 0 <= orientation < len(word_lbls) else str(orientation)
+        print("  {0:<12} {1:.4f}".format(label, ap))
+
+
+def plotSingle(mode = '3D', threshold = 1.5, result = None):
 
     plt.clf()
 
-    p, r, _ = PR(mode, threshold, False)
+    result = result or Evaluate({mode: [threshold]})
+    p, r = result.Curve(mode, threshold)
     plt1, = plt.plot(r, p, color='r')
 
     plt.xlabel('Recall', fontsize=14)
@@ -143,12 +170,14 @@ def plotSingle(mode = '3D', threshold = 1.5):
 
 
 def main(argv):
-    plotDifficulty()
-    #plotDistance()
-    plotOrientation()
-    #plot2DComparison()
-    #tableMAP()
-    #plotSingle()
+    result = Evaluate(SWEEP)
+    plotDifficulty(result=result)
+    #plotDistance(result=result)
+    plotOrientation(result=result)
+    #plot2DComparison(result=result)
+    #tableMAP(result=result)
+    #plotSingle(result=result)
+    #printAP(result=result)
 
 
 if __name__ == '__main__':
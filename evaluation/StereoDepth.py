@@ -2,32 +2,111 @@ import numpy as np
 import cv2
 import matplotlib.pyplot as plt
 import open3d as o3d
+import threading
+import instrumentation
 
+# Reprojection matrix for the KITTI tracking stereo rig.
+#f = 7.215377000000e+02
+#cx = 6.095593000000e+02
+#cx1 = 526.242457
+#cy = 1.728540000000e+02
+#Tx = -120.00
+KITTI_Q = np.float32([[   1.,            0.,            0.,         -614.37893072],
+                      [   0.,            1.,            0.,         -162.12583194],
+                      [   0.,            0.,            0.,          680.05186262],
+                      [   0.,            0.,           -1.87703644,    0.,        ]])
 
-class Convert3D:
-    def __init__(self, img_l, img_r, prediction = []):
 
-        if isinstance(img_l, str):
-            self.img_l = cv2.imread(img_l)
-            self.img_r = cv2.imread(img_r)
+# Stereo quality presets, from cheapest to best:
+#   fast:     match at half resolution and upsample. Fine for distant traffic
+#             and live dashboards.
+#   balanced-pyramid: balanced, matched coarse-to-fine (see StereoEngine's
+#             pyramid). Faster, at a small cost in accuracy.
+#   balanced: full resolution SGBM. What we've always used by default.
+#   accurate: full resolution SGBM with a left-right WLS filter.
+STEREO_PRESETS = ['fast', 'balanced-pyramid', 'balanced', 'accurate']
+
+
+class StereoEngine:
+    # Holds everything that only depends on the calibration and matcher
+    # config: the SGBM matchers, the WLS filter and Q. Build one and call
+    # compute() for every frame instead of rebuilding them each time.
+    # OpenCV matchers aren't safe to share between threads, so use one engine
+    # per thread (Convert3D does this for its default engine).
+    # preset is one of STEREO_PRESETS; accurate=True is the same as
+    # preset='accurate'. pyramid=True (balanced only) matches coarse-to-fine:
+    # a half resolution pass picks the disparity range for each band of rows
+    # and the full resolution pass only searches that range. The
+    # 'balanced-pyramid' preset is preset='balanced' with pyramid=True.
+    # Pass left_matcher to use a custom cv2.StereoSGBM instead of the built-in
+    # configs.
+    def __init__(self, Q=KITTI_Q, accurate=False, left_matcher=None, preset=None, pyramid=False, pyramid_bands=4):
+        if preset is None:
+            preset = 'accurate' if accurate else 'balanced'
+        if preset not in STEREO_PRESETS:
+            raise ValueError("Unknown stereo preset '{}', expected one of {}".format(preset, STEREO_PRESETS))
+        if preset == 'balanced-pyramid':
+            preset, pyramid = 'balanced', True
+        if pyramid and preset != 'balanced':
+            raise ValueError("pyramid is only supported with the 'balanced' preset")
+
+        self.Q = Q
+        # Convert3D works in negated camera coordinates. Negating the X, Y and
+        # Z rows of Q gets reprojectImageTo3D to produce them directly instead
+        # of flipping the whole HxWx3 image afterwards.
+        self.xyz_Q = np.vstack([-Q[:3], Q[3:]]).astype(np.float32)
+        self.preset = preset
+        self.accurate = preset == 'accurate'
+        self.pyramid = pyramid
+        self.pyramid_bands = pyramid_bands
+        # Matching is done at 1/scale resolution.
+        self.scale = 2 if preset == 'fast' else 1
+
+        if left_matcher is not None:
+            self.left_matcher = left_matcher
+            if self.accurate:
+                self._CreateWLSFilter()
+            else:
+                self.right_matcher = None
+                self.wls_filter = None
+        elif self.accurate:
+            self._CreateAccurateMatchers()
         else:
-            self.img_l = img_l
-            self.img_r = img_r
+            self.left_matcher = self._CreateSGBMMatcher(128 // self.scale)
+            self.right_matcher = None
+            self.wls_filter = None
 
-        self.prediction = prediction
+        if pyramid:
+            self.coarse_matcher = self._CreateSGBMMatcher(self.left_matcher.getNumDisparities() // 2)
 
-        self.depth_img = self._CalculateStereoDisparityFast()
-        #self.depth_img = self._CalculateStereoDisparity()
-        self.xyz_img = -self._XYZImageFromDisparity()
-        self.point_cloud = self.PointCloud()
-        self.positions_3D = self.Positions3D()
+        # Disparity search range in full resolution pixels.
+        self.min_disparity = self.left_matcher.getMinDisparity() * self.scale
+        self.num_disparities = self.left_matcher.getNumDisparities() * self.scale
 
+    #http://www.cvlibs.net/datasets/kitti/eval_stereo_flow_detail.php?benchmark=stereo&error=3&eval=all&result=3ae300a3a3b3ed3e48a63ecb665dffcc127cf8ab
+    def _CreateSGBMMatcher(self, num_disparities=128):
+        # SGBM Parameters
+        window_size = 3
 
-    def _CalculateStereoDisparity(self):
+        return cv2.StereoSGBM_create(
+            minDisparity=0,
+            numDisparities=num_disparities, # must be divisible by 16?
+            blockSize=window_size,
+            P1= 4 * window_size ** 2,
+            P2 = 32 * window_size ** 2,
+            disp12MaxDiff=1,
+            uniquenessRatio=10,
+            speckleWindowSize=100,
+            speckleRange=32,
+            preFilterCap=63,
+            mode=cv2.STEREO_SGBM_MODE_SGBM_3WAY
+        )
+
+    def _CreateAccurateMatchers(self):
         # SGBM Parameters
         window_size = 3
 
-        left_matcher = cv2.StereoSGBM_create(
+        self.left_matcher = cv2.StereoSGBM_create(
             minDisparity=0,
             numDisparities=160, # must be divisible by 16?
             blockSize=5,
@@ -40,77 +119,370 @@ class Convert3D:
             preFilterCap=63,
             mode=cv2.STEREO_SGBM_MODE_SGBM_3WAY
         )
+        self._CreateWLSFilter()
 
-        right_matcher = cv2.ximgproc.createRightMatcher(left_matcher)
+    def _CreateWLSFilter(self):
+        self.right_matcher = cv2.ximgproc.createRightMatcher(self.left_matcher)
 
         # Filter Params
         lmbda = 80000
         sigma = 1.2
         visual_multiplier = 1.0
 
-        wls_filter = cv2.ximgproc.createDisparityWLSFilter(matcher_left=left_matcher)
-        wls_filter.setLambda(lmbda)
-        wls_filter.setSigmaColor(sigma)
+        self.wls_filter = cv2.ximgproc.createDisparityWLSFilter(matcher_left=self.left_matcher)
+        self.wls_filter.setLambda(lmbda)
+        self.wls_filter.setSigmaColor(sigma)
 
-        displ = left_matcher.compute(self.img_l, self.img_r).astype(np.float32)/16.0
-        dispr = right_matcher.compute(self.img_r, self.img_l).astype(np.float32)/16.0
-        filteredImg = wls_filter.filter(displ, self.img_l, None, dispr)
+    def Disparity(self, img_l, img_r):
+        with instrumentation.Time('disparity'):
+            return self._Disparity(img_l, img_r)
 
-        return filteredImg
+    def _Disparity(self, img_l, img_r):
+        if self.scale != 1:
+            return self._DownscaledDisparity(img_l, img_r)
+        if self.pyramid:
+            return self._PyramidDisparity(img_l, img_r)
+        displ = self.left_matcher.compute(img_l, img_r).astype(np.float32) / 16.0
+        if not self.accurate:
+            return displ
+        dispr = self.right_matcher.compute(img_r, img_l).astype(np.float32) / 16.0
+        return self.wls_filter.filter(displ, img_l, None, dispr)
 
+    def _DownscaledDisparity(self, img_l, img_r, matcher=None):
+        # Match at 1/scale resolution, then upsample back to full size.
+        # Nearest neighbour keeps invalid pixels from bleeding into their
+        # neighbours. Disparities are in full resolution pixels.
+        scale = self.scale if self.scale != 1 else 2
+        matcher = matcher if matcher is not None else self.left_matcher
+        height, width = img_l.shape[:2]
+        small_size = (max(1, width // scale), max(1, height // scale))
+        small_l = cv2.resize(img_l, small_size, interpolation=cv2.INTER_AREA)
+        small_r = cv2.resize(img_r, small_size, interpolation=cv2.INTER_AREA)
+        displ = matcher.compute(small_l, small_r).astype(np.float32) / 16.0
+        displ = cv2.resize(displ, (width, height), interpolation=cv2.INTER_NEAREST)
+        invalid = displ < matcher.getMinDisparity()
+        displ *= scale
+        displ[invalid] = self.min_disparity - 1
+        return displ
 
-    #http://www.cvlibs.net/datasets/kitti/eval_stereo_flow_detail.php?benchmark=stereo&error=3&eval=all&result=3ae300a3a3b3ed3e48a63ecb665dffcc127cf8ab
-    def _CalculateStereoDisparityFast(self):
-        # SGBM Parameters
-        window_size = 3
+    def _PyramidDisparity(self, img_l, img_r, margin=4):
+        # Coarse-to-fine: a half resolution pass gives the disparity range for
+        # each band of rows, and each band is then matched at full resolution
+        # over just that range (plus a margin). SGBM cost scales with the
+        # number of disparities searched, so nearby-free bands get much cheaper.
+        coarse = self._DownscaledDisparity(img_l, img_r, self.coarse_matcher)
+        height = img_l.shape[0]
+        invalid_disparity = self.min_disparity - 1
+        displ = np.full(coarse.shape, invalid_disparity, dtype=np.float32)
+        full_min = self.left_matcher.getMinDisparity()
+        full_max = full_min + self.left_matcher.getNumDisparities()
+        block_size = self.left_matcher.getBlockSize()
 
-        left_matcher = cv2.StereoSGBM_create(
-            minDisparity=0,
-            numDisparities=128, # must be divisible by 16?
-            blockSize=window_size,
-            P1= 4 * window_size ** 2,
-            P2 = 32 * window_size ** 2,
-            disp12MaxDiff=1,
-            uniquenessRatio=10,
-            speckleWindowSize=100,
-            speckleRange=32,
-            preFilterCap=63,
-            mode=cv2.STEREO_SGBM_MODE_SGBM_3WAY
-        )
+        band_edges = np.linspace(0, height, self.pyramid_bands + 1).astype(int)
+        for top, bottom in zip(band_edges[:-1], band_edges[1:]):
+            band = coarse[top:bottom]
+            band_valid = band[band > invalid_disparity]
+            if len(band_valid) == 0:
+                band_min, band_max = full_min, full_max
+            else:
+                band_min = max(full_min, int(np.percentile(band_valid, 1)) - margin)
+                band_max = min(full_max, int(np.ceil(np.percentile(band_valid, 99))) + margin)
+            # numDisparities must be a positive multiple of 16.
+            num_disparities = max(16, int(np.ceil((band_max - band_min) / 16.0)) * 16)
+            band_min = max(full_min, min(band_min, full_max - num_disparities))
 
-        displ = left_matcher.compute(self.img_l, self.img_r).astype(np.float32) / 16.0
+            # Pad the band so the block matcher sees the rows around it.
+            padded_top = max(0, top - block_size)
+            padded_bottom = min(height, bottom + block_size)
+            self.left_matcher.setMinDisparity(band_min)
+            self.left_matcher.setNumDisparities(num_disparities)
+            try:
+                band_disparity = self.left_matcher.compute(img_l[padded_top:padded_bottom], img_r[padded_top:padded_bottom]).astype(np.float32) / 16.0
+            finally:
+                self.left_matcher.setMinDisparity(full_min)
+                self.left_matcher.setNumDisparities(full_max - full_min)
+            band_disparity = band_disparity[top - padded_top:bottom - padded_top]
+            band_disparity[band_disparity < band_min] = invalid_disparity
+            displ[top:bottom] = band_disparity
         return displ
 
-    def _XYZImageFromDisparity(self):
-        f = 7.215377000000e+02
-        cx = 6.095593000000e+02
-        cx1 = 526.242457
-        cy = 1.728540000000e+02
-        Tx = -120.00
+    def Reproject(self, disparity, x_offset=0, y_offset=0):
+        # Returns the XYZ image in Convert3D's (negated) coordinates.
+        # x_offset/y_offset give the position of a cropped disparity image in
+        # the full frame, so crops reproject to the same coordinates.
+        Q = self.xyz_Q
+        if x_offset or y_offset:
+            Q = Q.copy()
+            Q[0, 3] += Q[0, 0] * x_offset
+            Q[1, 3] += Q[1, 1] * y_offset
+        with instrumentation.Time('reproject'):
+            return cv2.reprojectImageTo3D(disparity, Q)
+
+    def ROIBands(self, boxes, shape, padding=8):
+        # Group boxes into horizontal bands of rows and return one crop
+        # (top, bottom, left, right) per band. Each crop is padded and extended
+        # to the left by the disparity search range, so every box pixel can
+        # be matched against the full range in the right image.
+        height, width = shape[:2]
+        search_margin = self.min_disparity + self.num_disparities
+
+        intervals = []
+        for box in boxes:
+            top = max(0, int(box['topleft']['y']) - padding)
+            bottom = min(height, int(box['bottomright']['y']) + padding)
+            left = max(0, int(box['topleft']['x']) - padding - search_margin)
+            right = min(width, int(box['bottomright']['x']) + padding)
+            if bottom > top and right > left:
+                intervals.append([top, bottom, left, right])
+        intervals.sort()
+
+        bands = []
+        for top, bottom, left, right in intervals:
+            if bands and top <= bands[-1][1]:
+                band = bands[-1]
+                band[1] = max(band[1], bottom)
+                band[2] = min(band[2], left)
+                band[3] = max(band[3], right)
+            else:
+                bands.append([top, bottom, left, right])
+        return [tuple(band) for band in bands]
 
-        Q = np.float32([[   1.,            0.,            0.,         -614.37893072],
-            [   0.,            1.,            0.,         -162.12583194],
-            [   0.,            0.,            0.,          680.05186262],
-            [   0.,            0.,           -1.87703644,    0.,        ]])
+    def compute(self, img_l, img_r, boxes=[], roi=False):
+        # Returns a (lazy) Convert3D for this frame.
+        return Convert3D(img_l, img_r, boxes, engine=self, roi=roi)
 
-        points = cv2.reprojectImageTo3D(self.depth_img, Q)
-        return points
+
+_default_engines = threading.local()
+
+def DefaultStereoEngine(preset='balanced'):
+    # One engine per preset per thread, created on first use.
+    engines = getattr(_default_engines, 'engines', None)
+    if engines is None:
+        engines = {}
+        _default_engines.engines = engines
+    if preset not in engines:
+        engines[preset] = StereoEngine(preset=preset)
+    return engines[preset]
+
+
+class Convert3D:
+    # Per-frame stereo result. The heavy lifting lives in StereoEngine; pass
+    # one in to control the matcher, otherwise the calling thread's default
+    # engine is used.
+    # depth_img, xyz_img, point_cloud and positions_3D are computed the first
+    # time they're read and then cached, so callers only pay for what they
+    # use. List names in `fields` to compute them up front instead, e.g. to
+    # do the work on a background thread.
+    # With roi=True only bands around the predicted boxes are matched, which
+    # is all Positions3D needs. Pixels outside the bands get an invalid
+    # disparity and point_cloud is None.
+    # position_method picks how positions_3D is estimated: 'disparity' (see
+    # BoxPositions3D) or 'xyz', the original per-box median of xyz_img.
+    # preset picks the default engine's quality (see STEREO_PRESETS) when no
+    # engine is given.
+    def __init__(self, img_l, img_r, prediction = [], engine=None, roi=False, fields=(), position_method='disparity', preset='balanced'):
+
+        if isinstance(img_l, str):
+            self.img_l = cv2.imread(img_l)
+            self.img_r = cv2.imread(img_r)
+        else:
+            self.img_l = img_l
+            self.img_r = img_r
+
+        self.prediction = prediction
+        self.engine = engine if engine is not None else DefaultStereoEngine(preset)
+        self.roi = roi
+        self.position_method = position_method
+
+        self._depth_img = None
+        self._xyz_img = None
+        self._point_cloud = None
+        self._positions_3D = None
+        self._position_stats = None
+
+        for field in fields:
+            getattr(self, field)
+
+    @property
+    def depth_img(self):
+        if self._depth_img is None:
+            if self.roi:
+                self._depth_img, self._xyz_img = self._ROIDepth()
+            else:
+                self._depth_img = self.engine.Disparity(self.img_l, self.img_r)
+        return self._depth_img
+
+    @property
+    def xyz_img(self):
+        if self._xyz_img is None:
+            if self.roi:
+                self._depth_img, self._xyz_img = self._ROIDepth()
+            else:
+                self._xyz_img = self._XYZImageFromDisparity()
+        return self._xyz_img
+
+    @property
+    def point_cloud(self):
+        if self._point_cloud is None and not self.roi:
+            self._point_cloud = self.PointCloud()
+        return self._point_cloud
+
+    @property
+    def positions_3D(self):
+        if self._positions_3D is None:
+            self._positions_3D = self.Positions3D()
+        return self._positions_3D
+
+    def SetPrediction(self, prediction):
+        # Attach detections after construction, e.g. when the disparity was
+        # computed concurrently with the detector.
+        self.prediction = prediction
+        if self.roi:
+            # The matched bands depend on the boxes.
+            self._depth_img = None
+            self._xyz_img = None
+        self._positions_3D = None
+        self._position_stats = None
+
+    def _ROIDepth(self):
+        height, width = self.img_l.shape[:2]
+        invalid_disparity = self.engine.min_disparity - 1
+        depth_img = np.full((height, width), invalid_disparity, dtype=np.float32)
+        xyz_img = np.zeros((height, width, 3), dtype=np.float32)
+
+        for top, bottom, left, right in self.engine.ROIBands(self.prediction, self.img_l.shape):
+            disparity = self.engine.Disparity(self.img_l[top:bottom, left:right], self.img_r[top:bottom, left:right])
+            depth_img[top:bottom, left:right] = disparity
+            xyz_img[top:bottom, left:right] = self.engine.Reproject(disparity, left, top)
+        return depth_img, xyz_img
+
+    def _XYZImageFromDisparity(self):
+        return self.engine.Reproject(self.depth_img)
 
     def PointCloud(self):
         mask = self.depth_img > self.depth_img.min()
         return self.xyz_img[mask]
 
     def Positions3D(self):
-        positions = []
-
-        for predicted_box in self.prediction:
-            xyz_car_img = self.xyz_img[predicted_box['topleft']['y']:predicted_box['bottomright']['y'], predicted_box['topleft']['x']:predicted_box['bottomright']['x']]
-            h, w, _ = xyz_car_img.shape
-            # Crop
-            xyz_car_img = xyz_car_img[int(h/4):int(3*h/4), int(w/4):int(3*w/4)]
-
-            # Get point
-            car_pos = np.median(xyz_car_img.reshape(-1, 3), axis=0)
-            car_pos += (car_pos/np.linalg.norm(car_pos))*1.5
-            positions.append(car_pos)
-        return positions
+        return list(self.position_stats[0])
+
+    @property
+    def position_stats(self):
+        # (positions, confidences, spreads) for every predicted box.
+        if self._position_stats is None:
+            self._position_stats = self._PositionStats()
+        return self._position_stats
+
+    def _PositionStats(self):
+        with instrumentation.Time('box_positions'):
+            if self.position_method == 'xyz':
+                positions = _MedianXYZPositions(self.xyz_img, self.prediction)
+                return positions, np.ones(len(positions)), np.full(len(positions), np.nan)
+            else:
+                positions, confidences, spreads = BoxPositions3D(self.depth_img, self.prediction, self.engine.xyz_Q,
+                                                                 self.engine.min_disparity, self.engine.num_disparities)
+                # Boxes without a single valid disparity fall back to the
+                # old estimate so the tracker never sees NaN for a real box.
+                missing = np.flatnonzero(confidences == 0)
+                if len(missing) > 0:
+                    positions[missing] = _MedianXYZPositions(self.xyz_img, [self.prediction[i] for i in missing])
+            return positions, confidences, spreads
+
+    @property
+    def position_confidences(self):
+        return self.position_stats[1]
+
+    @property
+    def position_spreads(self):
+        return self.position_stats[2]
+
+
+def _MedianXYZPositions(xyz_img, boxes):
+    # Original estimate: per-coordinate median of the reprojected points in
+    # the central half of each box.
+    positions = []
+
+    for predicted_box in boxes:
+        xyz_car_img = xyz_img[predicted_box['topleft']['y']:predicted_box['bottomright']['y'], predicted_box['topleft']['x']:predicted_box['bottomright']['x']]
+        h, w, _ = xyz_car_img.shape
+        # Crop
+        xyz_car_img = xyz_car_img[int(h/4):int(3*h/4), int(w/4):int(3*w/4)]
+
+        # Get point
+        car_pos = np.median(xyz_car_img.reshape(-1, 3), axis=0)
+        car_pos += (car_pos/np.linalg.norm(car_pos))*1.5
+        positions.append(car_pos)
+    return np.array(positions, dtype=np.float32).reshape(-1, 3)
+
+def BoxPositions3D(depth_img, boxes, Q, min_disparity=0, num_disparities=128):
+    # Vectorized position estimate for every box at once, done in disparity
+    # space before any reprojection.
+    # SGBM disparities come in 1/16 px steps, so one bincount over
+    # (box, disparity step) gives an exact histogram per box. The median
+    # disparity over the central half of the box is reprojected through Q at
+    # the centre of that crop, then pushed 1.5m further out to go from the
+    # visible surface towards the middle of the car. Invalid disparities are
+    # ignored.
+    # Returns (positions (N,3), confidences (N,), spreads (N,)): confidence is
+    # the fraction of the crop with a valid disparity (0 means the position is
+    # NaN), spread is half the interquartile range of depth in meters.
+    num_boxes = len(boxes)
+    if num_boxes == 0:
+        return np.zeros((0, 3), dtype=np.float32), np.zeros(0), np.zeros(0)
+
+    height, width = depth_img.shape[:2]
+    corners = np.array([[box['topleft']['y'], box['bottomright']['y'], box['topleft']['x'], box['bottomright']['x']] for box in boxes], dtype=np.int64)
+    top = np.clip(corners[:, 0], 0, height)
+    left = np.clip(corners[:, 2], 0, width)
+    h = np.maximum(np.clip(corners[:, 1], 0, height) - top, 0)
+    w = np.maximum(np.clip(corners[:, 3], 0, width) - left, 0)
+
+    # Central half of each box, same crop as _MedianXYZPositions.
+    crop_top = top + (h / 4).astype(np.int64)
+    crop_left = left + (w / 4).astype(np.int64)
+    crop_h = (3 * h / 4).astype(np.int64) - (h / 4).astype(np.int64)
+    crop_w = (3 * w / 4).astype(np.int64) - (w / 4).astype(np.int64)
+    sizes = crop_h * crop_w
+
+    # Flat pixel indices of every crop, labelled with their box.
+    box_ids = np.repeat(np.arange(num_boxes), sizes)
+    offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    safe_w = np.maximum(crop_w, 1)[box_ids]
+    rows = crop_top[box_ids] + offsets // safe_w
+    cols = crop_left[box_ids] + offsets % safe_w
+
+    disparity = depth_img[rows, cols]
+    valid = (disparity > min_disparity - 1) & (disparity > 0)
+    num_bins = 16 * (min_disparity + num_disparities) + 1
+    bins = np.clip(np.rint(disparity[valid] * 16).astype(np.int64), 0, num_bins - 1)
+    histograms = np.bincount(box_ids[valid] * num_bins + bins, minlength=num_boxes * num_bins).reshape(num_boxes, num_bins)
+    cumulative = np.cumsum(histograms, axis=1)
+    counts = cumulative[:, -1]
+
+    def quantile_bin(rank):
+        # Histogram bin holding the value of the given 0-based rank.
+        return (cumulative > rank[:, None]).argmax(axis=1)
+
+    median_bin = (quantile_bin((counts - 1) // 2) + quantile_bin(counts // 2)) / 2
+    q25_bin = quantile_bin((counts - 1) // 4)
+    q75_bin = quantile_bin((3 * (counts - 1)) // 4)
+
+    # Reproject the crop centre at the median and quartile disparities.
+    Q = np.asarray(Q, dtype=np.float64)
+    centre_u = crop_left + (crop_w - 1) / 2
+    centre_v = crop_top + (crop_h - 1) / 2
+
+    def reproject(disparity_bin):
+        points = np.stack([centre_u, centre_v, disparity_bin / 16, np.ones(num_boxes)], axis=1) @ Q.T
+        return points[:, :3] / points[:, 3:]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        positions = reproject(median_bin)
+        spreads = np.abs(reproject(q25_bin)[:, 2] - reproject(q75_bin)[:, 2]) / 2
+        positions += (positions / np.linalg.norm(positions, axis=1, keepdims=True)) * 1.5
+    confidences = np.where(sizes > 0, counts / np.maximum(sizes, 1), 0.0)
+
+    missing = counts == 0
+    positions[missing] = np.nan
+    spreads[missing] = np.nan
+    return positions.astype(np.float32), confidences, spreads
@@ -0,0 +1,127 @@
+################################################################################
+#
+# Observation to track association for MultiOnlineKalman and
+# MultiOnlineParticleFilter.
+#
+# Association.match builds the observation x track cost matrix in one go,
+# gates it, and solves it either optimally (Hungarian, via
+# scipy.optimize.linear_sum_assignment) or greedily in observation order.
+# With metric='mahalanobis' the cost is the Mahalanobis distance under each
+# track's position covariance, gated at a chi-square quantile, so uncertain
+# tracks accept observations from further away. With many tracks, candidate
+# pairs are found with a k-d tree instead of the full distance matrix.
+#
+################################################################################
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+import instrumentation
+
+ASSOCIATION_METHODS = ['hungarian', 'greedy']
+ASSOCIATION_METRICS = ['euclidean', 'mahalanobis']
+
+# 99% quantile of the chi-square distribution with 3 degrees of freedom.
+CHI2_GATE_3D = 11.345
+
+
+class Association:
+    def __init__(self, distance_cap=1, method='hungarian', metric='euclidean', mahalanobis_gate=CHI2_GATE_3D, spatial_index_min_tracks=32):
+        # distance_cap is a Euclidean gate in metres, applied with either
+        # metric. None disables it, which mahalanobis allows.
+        # mahalanobis_gate is on the squared Mahalanobis distance.
+        # The k-d tree pre-gate is used once there are at least
+        # spatial_index_min_tracks tracks and distance_cap is set.
+        if method not in ASSOCIATION_METHODS:
+            raise ValueError("Unknown association method '{}', expected one of {}".format(method, ASSOCIATION_METHODS))
+        if metric not in ASSOCIATION_METRICS:
+            raise ValueError("Unknown association metric '{}', expected one of {}".format(metric, ASSOCIATION_METRICS))
+        if distance_cap is None and metric == 'euclidean':
+            raise ValueError("Euclidean association needs a distance_cap")
+        self.distance_cap = distance_cap
+        self.method = method
+        self.metric = metric
+        self.mahalanobis_gate = mahalanobis_gate
+        self.spatial_index_min_tracks = spatial_index_min_tracks
+
+    def match(self, observations, track_positions, track_covariances=None):
+        # observations (M,3), track_positions (N,3) and, for mahalanobis,
+        # track_covariances (N,3,3). Returns the matched track index for each
+        # observation, or -1. Each track takes at most one observation.
+        observations = np.asarray(observations, dtype=np.float64).reshape(-1, 3)
+        track_positions = np.asarray(track_positions, dtype=np.float64).reshape(-1, 3)
+        matches = np.full(len(observations), -1)
+        if len(observations) == 0 or len(track_positions) == 0:
+            return matches
+
+        with instrumentation.Time('associate'):
+            costs = self.cost_matrix(observations, track_positions, track_covariances)
+            if self.method == 'greedy':
+                return self._solve_greedy(costs)
+            return self._solve_hungarian(costs)
+
+    def cost_matrix(self, observations, track_positions, track_covariances=None):
+        # (M,N) costs, inf where gated out.
+        rows, cols = self._candidate_pairs(observations, track_positions)
+        differences = observations[rows] - track_positions[cols]
+        if self.metric == 'euclidean':
+            pair_costs = np.linalg.norm(differences, axis=1)
+            passed = pair_costs < self.distance_cap
+        else:
+            if track_covariances is None:
+                raise ValueError("Mahalanobis association needs track covariances")
+            inverse_covariances = np.linalg.inv(np.asarray(track_covariances, dtype=np.float64))
+            squared = np.einsum('ij,ijk,ik->i', differences, inverse_covariances[cols], differences)
+            pair_costs = np.sqrt(np.maximum(squared, 0))
+            passed = squared < self.mahalanobis_gate
+
+        costs = np.full((len(observations), len(track_positions)), np.inf)
+        costs[rows[passed], cols[passed]] = pair_costs[passed]
+        return costs
+
+    def _candidate_pairs(self, observations, track_positions):
+        # (rows, cols) of the pairs inside the Euclidean distance cap, or all
+        # pairs if there is none. NaN observations never pass.
+        if self.distance_cap is None:
+            rows, cols = np.indices((len(observations), len(track_positions)))
+            return rows.ravel(), cols.ravel()
+        if len(track_positions) < self.spatial_index_min_tracks:
+            distances = np.linalg.norm(observations[:, None, :] - track_positions[None, :, :], axis=2)
+            return np.nonzero(distances < self.distance_cap)
+
+        finite = np.flatnonzero(np.all(np.isfinite(observations), axis=1))
+        neighbours = cKDTree(track_positions).query_ball_point(observations[finite], self.distance_cap)
+        counts = np.array([len(cols) for cols in neighbours], dtype=np.int64)
+        rows = np.repeat(finite, counts)
+        cols = np.concatenate([np.asarray(cols, dtype=np.int64) for cols in neighbours]) if len(rows) else np.zeros(0, dtype=np.int64)
+        return rows, cols
+
+    def _solve_greedy(self, costs):
+        # Nearest free track for each observation in turn.
+        costs = costs.copy()
+        matches = np.full(len(costs), -1)
+        for idx in range(len(costs)):
+            closest = np.argmin(costs[idx])
+            if np.isfinite(costs[idx, closest]):
+                matches[idx] = closest
+                costs[:, closest] = np.inf
+        return matches
+
+    def _solve_hungarian(self, costs):
+        # Minimum total cost assignment over the pairs that passed the gate.
+        # Gated pairs get a cost larger than any set of real pairs together,
+        # so the solver first maximizes the number of matches.
+        matches = np.full(len(costs), -1)
+        finite = np.isfinite(costs)
+        rows = np.flatnonzero(finite.any(axis=1))
+        cols = np.flatnonzero(finite.any(axis=0))
+        if len(rows) == 0:
+            return matches
+
+        sub_costs = costs[np.ix_(rows, cols)]
+        sub_finite = finite[np.ix_(rows, cols)]
+        gated_cost = sub_costs[sub_finite].sum() + 1
+        assigned_rows, assigned_cols = linear_sum_assignment(np.where(sub_finite, sub_costs, gated_cost))
+        valid = sub_finite[assigned_rows, assigned_cols]
+        matches[rows[assigned_rows[valid]]] = cols[assigned_cols[valid]]
+        return matches
@@ -0,0 +1,77 @@
+################################################################################
+#
+# Interpolated average precision, as in the KITTI devkit and MonoDIS
+# (https://research.mapillary.com/img/publications/MonoDIS.pdf).
+#
+# The precision envelope (the best precision at any recall at least as
+# high) is computed once per curve with a reverse cumulative max, and then
+# sampled at the recall points of the interpolation:
+#   '11':  recall 0, 0.1, ..., 1, the original KITTI AP
+#   '40':  recall 1/40, 2/40, ..., 1, KITTI's AP|R40
+#   'all': the area under the envelope at every recall the curve reaches
+# Curves with hundreds of thousands of points take a few milliseconds.
+#
+# TableAPs works on the TPFP tables of precisionrecall.Evaluation, usually
+# through Evaluation.AP.
+#
+################################################################################
+
+import numpy as np
+
+INTERPOLATIONS = ['11', '40', 'all']
+RECALL_POINTS = {'11': np.arange(11) / 10, '40': np.arange(1, 41) / 40}
+
+
+def Envelope(precision, recall):
+    # Returns (recall, envelope) sorted by recall, where envelope[i] is the
+    # best precision at recall >= recall[i].
+    precision = np.asarray(precision, dtype=np.float64)
+    recall = np.asarray(recall, dtype=np.float64)
+    order = np.argsort(recall, kind='stable')
+    envelope = np.maximum.accumulate(precision[order][::-1])[::-1]
+    return recall[order], envelope
+
+def AP(precision, recall, interpolation='40'):
+    # Average precision of a precision-recall curve, such as one returned by
+    # precisionrecall.PR.
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError("Unknown interpolation '{}', expected one of {}".format(interpolation, INTERPOLATIONS))
+    recall, envelope = Envelope(precision, recall)
+    if len(recall) == 0:
+        return 0.0
+    if interpolation == 'all':
+        return float(np.sum(np.diff(recall, prepend=0.0) * envelope))
+    index = np.searchsorted(recall, RECALL_POINTS[interpolation], side='left')
+    return float(np.where(index < len(recall), envelope[np.minimum(index, len(recall) - 1)], 0.0).mean())
+
+
+def Curve(tp, total):
+    # Precision and recall after each row of a sorted TPFP table, given which
+    # rows are TPs and the number of ground truth objects.
+    true_positives = np.cumsum(tp)
+    return true_positives / np.arange(1, len(tp) + 1), true_positives / total
+
+def _TableAP(tp, total, interpolation):
+    if total == 0 or len(tp) == 0:
+        return 0.0
+    return AP(*Curve(tp, total), interpolation)
+
+def TableAPs(table, gt_counts, gt_type_counts, interpolation='40', difficulties=('easy', 'medium', 'hard')):
+    # APs of a sorted TPFP table over all predictions ('all'), over the
+    # predictions matched to each difficulty, and for each orientation bin
+    # ('orientation': {bin: AP}). For an orientation, the predictions of that
+    # bin count, and only matches to ground truth of the same bin are TPs.
+    # gt_counts and gt_type_counts are the number of ground truth objects of
+    # each difficulty and orientation bin.
+    tp = table['tp']
+    aps = {'all': _TableAP(tp, sum(gt_counts.values()), interpolation)}
+    for difficulty in difficulties:
+        rows = table['difficulty'] == difficulty
+        aps[difficulty] = _TableAP(tp[rows], gt_counts.get(difficulty, 0), interpolation)
+
+    aps['orientation'] = {}
+    for orientation in sorted(set(gt_type_counts) | set(np.unique(table['pred_type']).tolist())):
+        rows = table['pred_type'] == orientation
+        aps['orientation'][orientation] = _TableAP(tp[rows] & (table['gt_type'][rows] == orientation),
+                                                   gt_type_counts.get(orientation, 0), interpolation)
+    return aps
@@ -0,0 +1,506 @@
+################################################################################
+#
+# End-to-end benchmarks on synthetic stereo data. Needs neither the KITTI
+# dataset nor a GPU: frames come from framesource.SyntheticSource at KITTI
+# resolution, with ground truth, and the detector is replaced by
+# StubDetector, which reports the ground truth boxes.
+#
+# Usage:
+# python evaluation/benchmark.py
+# python evaluation/benchmark.py --cars 10 --frames 40 --out bench.json
+# python evaluation/benchmark.py --only convert3d_fast,kalman,particle
+# python evaluation/benchmark.py --compare before.json after.json
+#
+# Benchmarks (see BENCHMARKS):
+#   convert3d_<preset>  stereo disparity and 3D box positions, per frame
+#   convert3d_roi       the same with ROI stereo
+#   kalman, particle    MultiOnlineKalman / MultiOnlineParticleFilter on noisy
+#                       ground truth positions, per frame
+#   store_write         framestore.FrameStoreWriter with the default
+#                       'detections' artifacts, per frame
+#   store_write_full    the same with 'full' artifacts (compressed images,
+#                       disparity and point cloud)
+#   store_read          framestore.FrameStore, all sections, per frame
+#   pickle_write/read   the old one pickle per frame format, all sections,
+#                       per frame
+#   pr_2d, pr_3d        precisionrecall.PR over --sequences sequences, without
+#                       the frame and result caches
+#   map                 precisionrecall.MAP on the pr_3d curves
+#   ap                  averageprecision APs of the pr_3d tables, per
+#                       interpolation
+#   pipeline_stream     NetworkModel.PredictStream, per frame
+#   pipeline_sequence   NetworkModel.PredictSequence from PNGs on disk, serial
+#                       and with pipeline=True, per frame
+#
+# Every benchmark runs once to warm up and then --repeats times. The report
+# (JSON, written to --out) holds the median, min and mean time per item for
+# each, along with the configuration, git commit and library versions.
+# --compare prints the change between two reports and exits with 1 if any
+# benchmark got more than --threshold (default 10%) slower.
+#
+################################################################################
+
+import sys
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+from contextlib import contextmanager
+import numpy as np
+import cv2
+from framesource import FrameSource, SyntheticSource
+from framestore import FrameStoreWriter, FrameStore, PickleFrameSink, PickleFrames, OpenFrameSink
+from StereoDepth import Convert3D
+from onlinekalman import MultiOnlineKalman
+from particlefilter import MultiOnlineParticleFilter
+import precisionrecall
+import averageprecision
+
+REPORT_VERSION = 1
+
+
+class StubDetector:
+    # Stands in for darkflow's TFNet in NetworkModel. return_predict reports
+    # the ground truth boxes of whichever rendered frame it is given, with a
+    # fixed made-up confidence per car, plus false_positives random boxes.
+    # Frames are recognised by a thumbnail, so the images can go through the
+    # pipeline unchanged.
+    def __init__(self, frames, false_positives=0, seed=0):
+        self.false_positives = false_positives
+        self.rng = np.random.default_rng(seed)
+        self.truth = {}
+        for frame in frames:
+            self.truth[self._Key(cv2.cvtColor(frame.image_l, cv2.COLOR_BGR2RGB))] = frame.truth
+
+    def _Key(self, rgb_image):
+        return rgb_image[::8, ::8].tobytes()
+
+    def return_predict(self, rgb_image):
+        boxes = []
+        for tracked_object in self.truth.get(self._Key(rgb_image), []):
+            bbox = tracked_object['bbox']
+            boxes.append({'label': tracked_object['type'],
+                          'confidence': 0.5 + 0.49 * ((tracked_object['track_id'] * 0.618) % 1),
+                          'topleft': {'x': bbox['left'], 'y': bbox['top']},
+                          'bottomright': {'x': bbox['right'], 'y': bbox['bottom']}})
+        height, width = rgb_image.shape[:2]
+        for _ in range(self.false_positives):
+            left, top = int(self.rng.integers(0, width - 60)), int(self.rng.integers(height // 3, height - 40))
+            boxes.append({'label': 'Car_0', 'confidence': float(self.rng.uniform(0.01, 0.5)),
+                          'topleft': {'x': left, 'y': top}, 'bottomright': {'x': left + 60, 'y': top + 40}})
+        return boxes
+
+
+class ListSource(FrameSource):
+    # Replays already rendered StereoFrames.
+    def __init__(self, frames, name='synthetic'):
+        super().__init__(name)
+        self.frames = frames
+
+    def __iter__(self):
+        return iter(self.frames)
+
+
+def _Detections(frame):
+    return [{'label': tracked_object['type'], 'confidence': 1.0,
+             'topleft': {'x': tracked_object['bbox']['left'], 'y': tracked_object['bbox']['top']},
+             'bottomright': {'x': tracked_object['bbox']['right'], 'y': tracked_object['bbox']['bottom']}}
+            for tracked_object in frame.truth]
+
+
+def _NoisyObservations(frames, rng, noise=0.3):
+    # Ground truth positions plus Gaussian noise, as the trackers see them.
+    observations = []
+    for frame in frames:
+        positions = np.array([tracked_object['3dbbox_loc'] for tracked_object in frame.truth]).reshape(-1, 3)
+        observations.append((positions + rng.normal(0, noise, positions.shape)).tolist())
+    return observations
+
+
+def _PredictionFrame(frame, rng, false_positives=2):
+    # A plausible prediction frame_data for the I/O and PR benchmarks: the
+    # ground truth, jittered, with some misses and false positives.
+    tracked_objects = []
+    for tracked_object in frame.truth:
+        if rng.random() < 0.1:
+            continue
+        bbox = {side: int(value + rng.integers(-3, 4)) for side, value in tracked_object['bbox'].items()}
+        tracked_objects.append({'bbox': bbox, 'confidence': float(rng.uniform(0.3, 1.0)), 'type': tracked_object['type'],
+                                '3dbbox_loc': list(np.array(tracked_object['3dbbox_loc']) + rng.normal(0, 1.0, 3))})
+    for _ in range(false_positives):
+        left, top = int(rng.integers(0, 1100)), int(rng.integers(120, 300))
+        tracked_objects.append({'bbox': {'left': left, 'top': top, 'right': left + 60, 'bottom': top + 40},
+                                'confidence': float(rng.uniform(0.0, 0.6)), 'type': 'Car_0',
+                                '3dbbox_loc': list(rng.uniform([-20, 0, 5], [20, 3, 60]))})
+    return {'tracked_objects': tracked_objects}
+
+
+def _GroundTruthObject(tracked_object):
+    # As groundtruth.GroundTruthParser writes it, without the track ID.
+    return {key: value for key, value in tracked_object.items() if key != 'track_id'}
+
+
+@contextmanager
+def _WorkingDirectory(path):
+    # precisionrecall.PR reads ./eval.
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+class Benchmarks:
+    # Holds the rendered data shared by the benchmarks. Each Bench* method
+    # returns (items, run): run() does the work once for `items` items.
+    def __init__(self, num_frames=30, num_cars=8, num_sequences=4, shape=(375, 1242), seed=0, directory=None):
+        self.num_frames = num_frames
+        self.num_cars = num_cars
+        self.num_sequences = num_sequences
+        self.seed = seed
+        self.directory = directory
+        self.frames = list(SyntheticSource(num_frames, num_cars, shape=shape, seed=seed))
+
+    def Config(self):
+        height, width = self.frames[0].image_l.shape[:2]
+        return {'frames': self.num_frames, 'cars': self.num_cars, 'sequences': self.num_sequences,
+                'width': width, 'height': height, 'seed': self.seed,
+                'visible_cars_per_frame': float(np.mean([len(frame.truth) for frame in self.frames]))}
+
+    def _Convert3D(self, **kwargs):
+        detections = [_Detections(frame) for frame in self.frames]
+
+        def run():
+            for frame, boxes in zip(self.frames, detections):
+                stereoPrediction = Convert3D(frame.image_l, frame.image_r, boxes, **kwargs)
+                stereoPrediction.depth_img
+                stereoPrediction.positions_3D
+        return len(self.frames), run
+
+    def BenchConvert3DFast(self):
+        return self._Convert3D(preset='fast')
+
+    def BenchConvert3DBalanced(self):
+        return self._Convert3D(preset='balanced')
+
+    def BenchConvert3DROI(self):
+        return self._Convert3D(preset='balanced', roi=True)
+
+    def _Tracker(self, tracker_class):
+        observations = _NoisyObservations(self.frames, np.random.default_rng(self.seed))
+        confidences = [[0.9] * len(frame_observations) for frame_observations in observations]
+
+        def run():
+            tracker = tracker_class('benchmark')
+            for frame_observations, frame_confidences in zip(observations, confidences):
+                tracker.take_multiple_observations(frame_observations, frame_confidences)
+        return len(observations), run
+
+    def BenchKalman(self):
+        return self._Tracker(MultiOnlineKalman)
+
+    def BenchParticle(self):
+        return self._Tracker(MultiOnlineParticleFilter)
+
+    def _FrameData(self):
+        # What NetworkModel writes with artifacts='full'.
+        rng = np.random.default_rng(self.seed)
+        frame_data = []
+        for frame in self.frames:
+            stereoPrediction = Convert3D(frame.image_l, frame.image_r, _Detections(frame), preset='fast')
+            data = _PredictionFrame(frame, rng)
+            data.update({'image_l': cv2.cvtColor(frame.image_l, cv2.COLOR_BGR2RGB), 'image_depth': stereoPrediction.depth_img,
+                         'point_cloud': stereoPrediction.point_cloud})
+            frame_data.append((frame.name, data))
+        return frame_data
+
+    def _StoreWrite(self, artifacts):
+        frame_data = self._FrameData()
+        path = os.path.join(self.directory, 'write.frames')
+
+        def run():
+            writer = FrameStoreWriter(path, artifacts=artifacts)
+            for frame_name, data in frame_data:
+                writer.Write(frame_name, data)
+            writer.Close()
+        return len(frame_data), run
+
+    def BenchStoreWrite(self):
+        return self._StoreWrite('detections')
+
+    def BenchStoreWriteFull(self):
+        return self._StoreWrite('full')
+
+    def BenchStoreRead(self):
+        frame_data = self._FrameData()
+        path = os.path.join(self.directory, 'read.frames')
+        writer = FrameStoreWriter(path, artifacts='full')
+        for frame_name, data in frame_data:
+            writer.Write(frame_name, data)
+        writer.Close()
+
+        def run():
+            store = FrameStore(path)
+            for frame_name in store.FrameNames():
+                frame = store.LoadFrame(frame_name)
+                np.asarray(frame['image_depth']).sum()
+        return len(frame_data), run
+
+    def BenchPickleWrite(self):
+        frame_data = self._FrameData()
+        directory = os.path.join(self.directory, 'pickle_write')
+
+        def run():
+            sink = PickleFrameSink(directory)
+            for frame_name, data in frame_data:
+                sink.Write(frame_name, data)
+            sink.Close()
+        return len(frame_data), run
+
+    def BenchPickleRead(self):
+        frame_data = self._FrameData()
+        directory = os.path.join(self.directory, 'pickle_read')
+        sink = PickleFrameSink(directory)
+        for frame_name, data in frame_data:
+            sink.Write(frame_name, data)
+        sink.Close()
+
+        def run():
+            frames = PickleFrames(directory)
+            for frame_name in frames.FrameNames():
+                frames.LoadFrame(frame_name)
+        return len(frame_data), run
+
+    def _EvalDirectory(self):
+        # eval/<seq>/{predictions,groundtruth}.frames for PR. Sequences reuse
+        # the rendered ground truth with different prediction noise.
+        directory = os.path.join(self.directory, 'pr')
+        if os.path.isdir(os.path.join(directory, 'eval')):
+            return directory
+        rng = np.random.default_rng(self.seed)
+        for sequence in range(self.num_sequences):
+            sequence_directory = os.path.join(directory, 'eval', str(sequence).zfill(4))
+            predictions = OpenFrameSink(os.path.join(sequence_directory, 'predictions'))
+            groundtruth = OpenFrameSink(os.path.join(sequence_directory, 'groundtruth'))
+            for frame in self.frames:
+                predictions.Write(frame.name, _PredictionFrame(frame, rng))
+                groundtruth.Write(frame.name, {'tracked_objects': [_GroundTruthObject(tracked_object) for tracked_object in frame.truth]})
+            predictions.Close()
+            groundtruth.Close()
+        return directory
+
+    def _PR(self, pr_type, threshold):
+        directory = self._EvalDirectory()
+
+        def run():
+            with _WorkingDirectory(directory), open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    # Without the caches, which would skip the work after the warm up.
+                    return precisionrecall.Evaluate({pr_type: [threshold]}, cache=False).PR(pr_type, threshold)
+                finally:
+                    sys.stdout = stdout
+        return self.num_sequences * len(self.frames), run
+
+    def BenchPR2D(self):
+        return self._PR('2D', 0.5)
+
+    def BenchPR3D(self):
+        return self._PR('3D', 5)
+
+    def BenchMAP(self):
+        _, pr = self._PR('3D', 5)
+        curves = pr()
+
+        def run():
+            for precision, recall in zip(curves[0:6:2], curves[1:6:2]):
+                precisionrecall.MAP(precision, recall)
+        return 3, run
+
+    def BenchAP(self):
+        directory = self._EvalDirectory()
+        with _WorkingDirectory(directory), open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                evaluation = precisionrecall.Evaluate({'3D': [5]}, cache=False)
+            finally:
+                sys.stdout = stdout
+
+        def run():
+            for interpolation in averageprecision.INTERPOLATIONS:
+                evaluation.AP('3D', 5, interpolation)
+        return len(averageprecision.INTERPOLATIONS), run
+
+    def _Model(self, **kwargs):
+        from neuralnetprediction import NetworkModel
+        model = NetworkModel(detector=StubDetector(self.frames), stereo_preset='fast', **kwargs)
+        model.vd_directory = self.directory
+        return model
+
+    def BenchPipelineStream(self):
+        model = self._Model()
+
+        def run():
+            for _ in model.PredictStream(ListSource(self.frames, 'stream')):
+                pass
+        return len(self.frames), run
+
+    def _KittiLayout(self):
+        # Writes the frames as a KITTI tracking sequence under self.directory.
+        sequence_name = 'synthetic'
+        for camera, index in (('image_02', 2), ('image_03', 3)):
+            directory = os.path.join(self.directory, 'data/KITTI-tracking/training', camera, sequence_name)
+            if os.path.isdir(directory):
+                continue
+            os.makedirs(directory)
+            for frame in self.frames:
+                cv2.imwrite(os.path.join(directory, frame.name + '.png'), frame[index])
+        return sequence_name
+
+    def BenchPipelineSequence(self):
+        sequence_name = self._KittiLayout()
+        model = self._Model()
+
+        def run():
+            model.filt = None
+            model.PredictSequence(sequence_name, show_progress=False)
+        return len(self.frames), run
+
+    def BenchPipelineSequencePipelined(self):
+        sequence_name = self._KittiLayout()
+        model = self._Model()
+
+        def run():
+            model.filt = None
+            model.PredictSequence(sequence_name, show_progress=False, pipeline=True)
+        return len(self.frames), run
+
+
+# (name, Benchmarks method, unit of the items)
+BENCHMARKS = [('convert3d_fast', 'BenchConvert3DFast', 'frame'),
+              ('convert3d_balanced', 'BenchConvert3DBalanced', 'frame'),
+              ('convert3d_roi', 'BenchConvert3DROI', 'frame'),
+              ('kalman', 'BenchKalman', 'frame'),
+              ('particle', 'BenchParticle', 'frame'),
+              ('store_write', 'BenchStoreWrite', 'frame'),
+              ('store_write_full', 'BenchStoreWriteFull', 'frame'),
+              ('store_read', 'BenchStoreRead', 'frame'),
+              ('pickle_write', 'BenchPickleWrite', 'frame'),
+              ('pickle_read', 'BenchPickleRead', 'frame'),
+              ('pr_2d', 'BenchPR2D', 'frame'),
+              ('pr_3d', 'BenchPR3D', 'frame'),
+              ('map', 'BenchMAP', 'curve'),
+              ('ap', 'BenchAP', 'curve'),
+              ('pipeline_stream', 'BenchPipelineStream', 'frame'),
+              ('pipeline_sequence', 'BenchPipelineSequence', 'frame'),
+              ('pipeline_sequence_pipelined', 'BenchPipelineSequencePipelined', 'frame')]
+
+
+def TimeBenchmark(items, run, repeats=3):
+    # Runs once to warm up, then `repeats` times. Times are ms per item.
+    run()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    per_item = 1000 * np.array(times) / items
+    return {'items': items, 'repeats': repeats, 'median_ms': float(np.median(per_item)), 'min_ms': float(per_item.min()),
+            'mean_ms': float(per_item.mean()), 'items_per_s': float(1000 / np.median(per_item))}
+
+
+def _Commit():
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def RunBenchmarks(only=None, repeats=3, show_progress=True, **kwargs):
+    # Returns the report dict. only is a list of benchmark names; kwargs go
+    # to Benchmarks.
+    names = [name for name, _, _ in BENCHMARKS]
+    for name in only or []:
+        if name not in names:
+            raise ValueError("Unknown benchmark '{}', expected some of {}".format(name, names))
+    directory = tempfile.mkdtemp(prefix='vd_benchmark_')
+    try:
+        benchmarks = Benchmarks(directory=directory, **kwargs)
+        report = {'version': REPORT_VERSION, 'commit': _Commit(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+                  'opencv': cv2.__version__, 'cpus': os.cpu_count(), 'config': benchmarks.Config(), 'results': {}}
+        for name, method, unit in BENCHMARKS:
+            if only and name not in only:
+                continue
+            items, run = getattr(benchmarks, method)()
+            result = TimeBenchmark(items, run, repeats)
+            result['unit'] = unit
+            report['results'][name] = result
+            if show_progress:
+                print("{:<28} {:>9.3f} ms/{}".format(name, result['median_ms'], unit), flush=True)
+        return report
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def CompareReports(before, after, threshold=0.1):
+    # Prints the change in median time for every benchmark in both reports.
+    # Returns the names that got more than `threshold` slower.
+    regressions = []
+    print("{:<28} {:>11} {:>11} {:>8}".format('benchmark', 'before ms', 'after ms', 'change'))
+    for name, result in after['results'].items():
+        if name not in before['results']:
+            print("{:<28} {:>11} {:>11.3f}".format(name, '-', result['median_ms']))
+            continue
+        old = before['results'][name]['median_ms']
+        change = result['median_ms'] / old - 1 if old > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print("{:<28} {:>11.3f} {:>11.3f} {:>+7.1f}%{}".format(name, old, result['median_ms'], 100 * change, flag))
+    if before.get('config') != after.get('config'):
+        print("Warning: the reports were made with different configs")
+    return regressions
+
+
+def _PopOption(argv, name, default):
+    # Removes "name value" from argv and returns (value, argv).
+    if name not in argv:
+        return default, argv
+    index = argv.index(name)
+    return argv[index + 1], argv[:index] + argv[index + 2:]
+
+
+def main(argv):
+    if '--compare' in argv:
+        threshold, argv = _PopOption(argv, '--threshold', 0.1)
+        index = argv.index('--compare')
+        with open(argv[index + 1]) as f:
+            before = json.load(f)
+        with open(argv[index + 2]) as f:
+            after = json.load(f)
+        return 1 if CompareReports(before, after, float(threshold)) else 0
+
+    out, argv = _PopOption(argv, '--out', 'benchmark.json')
+    frames, argv = _PopOption(argv, '--frames', 30)
+    cars, argv = _PopOption(argv, '--cars', 8)
+    sequences, argv = _PopOption(argv, '--sequences', 4)
+    repeats, argv = _PopOption(argv, '--repeats', 3)
+    seed, argv = _PopOption(argv, '--seed', 0)
+    only, argv = _PopOption(argv, '--only', None)
+
+    report = RunBenchmarks(only=only.split(',') if only else None, repeats=int(repeats), num_frames=int(frames),
+                           num_cars=int(cars), num_sequences=int(sequences), seed=int(seed))
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Wrote", out)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,115 @@
+################################################################################
+#
+# Loads the tracked objects of eval/<seq>/predictions and groundtruth as the
+# column arrays precisionrecall works on (see precisionrecall.FrameObjects),
+# several sequences at a time in a process pool.
+#
+# The arrays of each sequence are cached next to eval/, in
+# .eval_cache/<seq>-<key>.npz. The key hashes the path, mtime and size of
+# every file the sequence was read from, so a sequence that is regenerated
+# gets a new key and is read again, while repeated evaluation runs only load
+# the small cached arrays. Only the newest cache file of a sequence is kept.
+#
+################################################################################
+
+import os
+import hashlib
+import multiprocessing
+import numpy as np
+from framestore import OpenFrames, STORE_EXTENSION
+
+CACHE_DIRECTORY = '.eval_cache'
+# Bump when the cached arrays change.
+CACHE_VERSION = 1
+
+_KINDS = ['predictions', 'groundtruth']
+
+
+def _SourceFiles(path):
+    # The files OpenFrames(path) reads from.
+    if os.path.exists(path + STORE_EXTENSION):
+        return [path + STORE_EXTENSION]
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    return []
+
+def CacheKey(directory, sequence_name):
+    digest = hashlib.sha1('version {}\n'.format(CACHE_VERSION).encode())
+    for kind in _KINDS:
+        for path in _SourceFiles(os.path.join(directory, sequence_name, kind)):
+            stat = os.stat(path)
+            digest.update('{}\0{}\0{}\n'.format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size).encode())
+    return digest.hexdigest()
+
+
+def LoadSequence(directory, sequence_name):
+    # Returns (predictions, groundtruth) arrays for the frames that have
+    # predictions, read from the frames themselves.
+    from precisionrecall import FrameObjects
+    predictions = OpenFrames(os.path.join(directory, sequence_name, 'predictions'))
+    groundtruths = OpenFrames(os.path.join(directory, sequence_name, 'groundtruth'))
+    frame_names = predictions.FrameNames()
+    return FrameObjects(predictions, frame_names), FrameObjects(groundtruths, frame_names)
+
+def _ReadCache(path):
+    # Returns None if there is no usable cache file.
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {kind: {} for kind in _KINDS}
+            for name in data.files:
+                kind, key = name.split('.', 1)
+                arrays[kind][key] = data[name]
+        return arrays['predictions'], arrays['groundtruth']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _WriteCache(cache_directory, sequence_name, path, arrays):
+    os.makedirs(cache_directory, exist_ok=True)
+    columns = {'{}.{}'.format(kind, key): value for kind, kind_arrays in zip(_KINDS, arrays) for key, value in kind_arrays.items()}
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(temporary, path)
+    # Drop the entries of earlier versions of the sequence.
+    for name in os.listdir(cache_directory):
+        stale = os.path.join(cache_directory, name)
+        if name.startswith(sequence_name + '-') and len(name) == len(os.path.basename(path)) and stale != path:
+            os.remove(stale)
+
+
+def _LoadSequence(arguments):
+    return LoadSequence(*arguments)
+
+def CacheDirectory(directory):
+    # eval -> .eval_cache, next to it.
+    return os.path.join(os.path.dirname(os.path.normpath(directory)), CACHE_DIRECTORY)
+
+def LoadSequences(directory, sequence_names, workers=None, cache=True):
+    # Returns [(predictions, groundtruth)] for sequence_names, in order.
+    # Sequences that aren't cached are read by up to `workers` processes
+    # (default one per CPU) and then cached. With cache=False the cache is
+    # neither read nor written.
+    cache_directory = CacheDirectory(directory)
+    loaded = {}
+    misses = []
+    for sequence_name in sequence_names:
+        path = None
+        if cache:
+            path = os.path.join(cache_directory, '{}-{}.npz'.format(sequence_name, CacheKey(directory, sequence_name)))
+            loaded[sequence_name] = _ReadCache(path) if os.path.exists(path) else None
+        if loaded.get(sequence_name) is None:
+            misses.append((sequence_name, path))
+
+    workers = min(workers or os.cpu_count() or 1, len(misses))
+    arguments = [(directory, sequence_name) for sequence_name, _ in misses]
+    if workers > 1:
+        with multiprocessing.Pool(processes=workers) as pool:
+            results = pool.map(_LoadSequence, arguments)
+    else:
+        results = [_LoadSequence(argument) for argument in arguments]
+
+    for (sequence_name, path), arrays in zip(misses, results):
+        loaded[sequence_name] = arrays
+        if path is not None:
+            _WriteCache(cache_directory, sequence_name, path, arrays)
+    return [loaded[sequence_name] for sequence_name in sequence_names]
@@ -0,0 +1,281 @@
+################################################################################
+#
+# Sources of stereo frames for NetworkModel.PredictStream.
+#
+#   KittiSource:     a KITTI tracking sequence on disk.
+#   VideoSource:     a pair of recorded left/right video files, or one
+#                    side-by-side video.
+#   CaptureSource:   live stereo cameras, two devices or one side-by-side.
+#   SyntheticSource: generated stereo pairs of textured boxes at known depth,
+#                    with ground truth. Needs no data at all.
+#
+# Iterating over a source yields StereoFrames in order. Each frame carries a
+# timestamp in seconds, so downstream stages can tell how much time passed
+# when frames get dropped. Sources with live=True produce frames whether or
+# not anyone is keeping up, see pipeline.StreamReader for what happens then.
+#
+################################################################################
+
+import os
+import time
+import collections
+import numpy as np
+import cv2
+from StereoDepth import KITTI_Q
+from groundtruth import _DiscretizeAlpha
+
+# image_l and image_r are BGR, as cv2.imread returns them. truth is the
+# ground truth tracked objects for synthetic frames, otherwise None.
+StereoFrame = collections.namedtuple('StereoFrame', ['name', 'timestamp', 'image_l', 'image_r', 'truth'])
+StereoFrame.__new__.__defaults__ = (None,)
+
+KITTI_FPS = 10
+CAR_LENGTH = 3.0
+
+
+class FrameSource:
+    live = False
+
+    def __init__(self, name):
+        self.name = name
+
+    def __iter__(self):
+        raise NotImplementedError
+
+    def Close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+
+class KittiSource(FrameSource):
+    # Timestamps assume the KITTI recording rate.
+    def __init__(self, sequence_name, vd_directory=None, fps=KITTI_FPS):
+        super().__init__(sequence_name)
+        if vd_directory is None:
+            vd_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        self.directory_l = os.path.join(vd_directory, "data/KITTI-tracking/training/image_02/", sequence_name)
+        self.directory_r = os.path.join(vd_directory, "data/KITTI-tracking/training/image_03/", sequence_name)
+        self.fps = fps
+
+    def __iter__(self):
+        filenames = [filename for filename in sorted(os.listdir(self.directory_l)) if filename.endswith('.png')]
+        for filename in filenames:
+            frame_name = os.path.splitext(filename)[0]
+            yield StereoFrame(frame_name, int(frame_name) / self.fps,
+                              cv2.imread(os.path.join(self.directory_l, filename)),
+                              cv2.imread(os.path.join(self.directory_r, filename)))
+
+
+def _SplitSideBySide(image):
+    half = image.shape[1] // 2
+    return image[:, :half], image[:, half:2 * half]
+
+
+class VideoSource(FrameSource):
+    # Recorded stereo video. With one path the frames are side by side, left
+    # half first. Timestamps come from the container.
+    def __init__(self, path_l, path_r=None, name=None):
+        super().__init__(name if name is not None else os.path.splitext(os.path.basename(path_l))[0])
+        self.captures = [cv2.VideoCapture(path) for path in ([path_l] if path_r is None else [path_l, path_r])]
+        for capture, path in zip(self.captures, [path_l, path_r]):
+            if not capture.isOpened():
+                raise IOError("Could not open video {}".format(path))
+
+    def __iter__(self):
+        frame_number = 0
+        while True:
+            ok, image_l = self.captures[0].read()
+            if not ok:
+                return
+            timestamp = self.captures[0].get(cv2.CAP_PROP_POS_MSEC) / 1000
+            if len(self.captures) == 1:
+                image_l, image_r = _SplitSideBySide(image_l)
+            else:
+                ok, image_r = self.captures[1].read()
+                if not ok:
+                    return
+            yield StereoFrame(str(frame_number).zfill(6), timestamp, image_l, image_r)
+            frame_number += 1
+
+    def Close(self):
+        for capture in self.captures:
+            capture.release()
+
+
+class CaptureSource(FrameSource):
+    # Live stereo cameras. Both devices are grabbed before either is decoded
+    # so the pair is as close to simultaneous as the driver allows.
+    # Timestamps are time.monotonic() at grab. Runs until max_frames or Close.
+    live = True
+
+    def __init__(self, device_l=0, device_r=None, name='capture', max_frames=None):
+        super().__init__(name)
+        self.captures = [cv2.VideoCapture(device) for device in ([device_l] if device_r is None else [device_l, device_r])]
+        for capture, device in zip(self.captures, [device_l, device_r]):
+            if not capture.isOpened():
+                raise IOError("Could not open capture device {}".format(device))
+        self.max_frames = max_frames
+        self.closed = False
+
+    def __iter__(self):
+        frame_number = 0
+        while not self.closed and (self.max_frames is None or frame_number < self.max_frames):
+            if not all(capture.grab() for capture in self.captures):
+                return
+            timestamp = time.monotonic()
+            images = [capture.retrieve()[1] for capture in self.captures]
+            image_l, image_r = _SplitSideBySide(images[0]) if len(images) == 1 else images
+            yield StereoFrame(str(frame_number).zfill(6), timestamp, image_l, image_r)
+            frame_number += 1
+
+    def Close(self):
+        self.closed = True
+        for capture in self.captures:
+            capture.release()
+
+
+def _Difficulty(height, occlusion, truncation):
+    # The KITTI object benchmark difficulties, as groundtruth.py assigns them.
+    if height >= 40 and occlusion < 0.1 and truncation <= 0.15:
+        return 'easy'
+    if height >= 25 and occlusion < 0.5 and truncation <= 0.3:
+        return 'medium'
+    if height >= 25 and truncation <= 0.5:
+        return 'hard'
+    return 'very hard'
+
+
+class SyntheticSource(FrameSource):
+    # Textured boxes ("cars") driving in front of a textured wall, rendered
+    # into a rectified stereo pair with the KITTI calibration. Each car is a
+    # fronto-parallel plane (its rear) at an integer disparity, so the
+    # disparity is exact. truth holds one tracked object per visible car, in
+    # the same format as groundtruth.GroundTruthParser plus its 'track_id'.
+    # Like KITTI labels, 3dbbox_loc is the middle of the car, CAR_LENGTH/2
+    # behind the rear, at ground level. Occlusion and truncation are measured
+    # from the rendered frame and graded into difficulties with the KITTI
+    # rules.
+    # With live=True frames are paced at fps in real time.
+    def __init__(self, num_frames=100, num_cars=5, shape=(375, 1242), fps=KITTI_FPS, seed=0, live=False,
+                 name='synthetic', Q=KITTI_Q, background_depth=80.0):
+        super().__init__(name)
+        self.num_frames = num_frames
+        self.num_cars = num_cars
+        self.shape = shape
+        self.fps = fps
+        self.seed = seed
+        self.live = live
+        self.background_depth = background_depth
+        self.focal = float(Q[2, 3])
+        self.cx = -float(Q[0, 3])
+        self.cy = -float(Q[1, 3])
+        # disparity = focal_baseline / depth
+        self.focal_baseline = float(Q[2, 3] / -Q[3, 2])
+
+    def _Texture(self, rng, height, width):
+        # Blurred noise: enough structure for block matching at any offset.
+        noise = rng.integers(0, 256, (height, width), dtype=np.uint8)
+        return cv2.GaussianBlur(noise, (3, 3), 0)
+
+    def _Cars(self, rng):
+        # Start positions (x, y, z) in metres, velocities per frame, sizes.
+        z = rng.uniform(8, 40, self.num_cars)
+        x = rng.uniform(-0.6, 0.6, self.num_cars) * z * (self.shape[1] / 2) / self.focal
+        y = np.full(self.num_cars, 1.65)
+        velocities = np.column_stack([rng.normal(0, 0.05, self.num_cars), np.zeros(self.num_cars), rng.normal(0, 0.3, self.num_cars)])
+        sizes = np.column_stack([rng.uniform(1.5, 1.9, self.num_cars), rng.uniform(1.4, 1.7, self.num_cars)]) # width, height
+        return np.column_stack([x, y, z]), velocities, sizes
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed)
+        height, width = self.shape
+        background = self._Texture(rng, height, width + 256)
+        background_disparity = int(round(self.focal_baseline / self.background_depth))
+        car_textures = [self._Texture(rng, 400, 600) for _ in range(self.num_cars)]
+        positions, velocities, sizes = self._Cars(rng)
+        start = time.monotonic()
+
+        for frame_number in range(self.num_frames):
+            frame_positions = positions + velocities * frame_number
+            image_l = np.ascontiguousarray(background[:, :width])
+            image_r = np.ascontiguousarray(background[:, background_disparity:background_disparity + width])
+            # Which car is visible at each pixel of the left image.
+            owner = np.full((height, width), -1, dtype=np.int32)
+            painted = []
+            # Paint far to near so nearer cars occlude.
+            for car in np.argsort(-frame_positions[:, 2]):
+                x, y, z = frame_positions[car]
+                if z < 3:
+                    continue
+                car_width, car_height = sizes[car] * self.focal / z
+                bottom = self.cy + self.focal * y / z
+                left = self.cx + self.focal * (x - sizes[car][0] / 2) / z
+                box = [int(round(left)), int(round(bottom - car_height)), int(round(left + car_width)), int(round(bottom))]
+                disparity = int(round(self.focal_baseline / z))
+                # A car that only one camera sees is left out of both images,
+                # so every painted car is labelled.
+                if not self._Visible(image_l, box, 0) or not self._Visible(image_r, box, disparity):
+                    continue
+                self._Paint(image_l, car_textures[car], box, 0)
+                self._Paint(image_r, car_textures[car], box, disparity)
+                owner[max(box[1], 0):max(box[3], 0), max(box[0], 0):max(box[2], 0)] = car
+                painted.append((car, box, disparity))
+
+            truth = []
+            for car, box, disparity in painted:
+                x, y, _ = frame_positions[car]
+                depth = self.focal_baseline / disparity + CAR_LENGTH / 2
+                clipped = {'left': max(box[0], 0), 'top': max(box[1], 0), 'right': min(box[2], width - 1), 'bottom': min(box[3], height - 1)}
+                area = (box[2] - box[0]) * (box[3] - box[1])
+                clipped_area = (clipped['right'] - clipped['left']) * (clipped['bottom'] - clipped['top'])
+                visible = np.count_nonzero(owner[clipped['top']:clipped['bottom'], clipped['left']:clipped['right']] == car)
+                truncation = 1 - clipped_area / area
+                occlusion = 1 - visible / max(clipped_area, 1)
+                # Driving away from the camera. alpha is the angle as seen
+                # from the camera, as in the KITTI labels.
+                rotation_y = -np.pi / 2
+                alpha = rotation_y - np.arctan2(x, depth)
+                truth.append({'track_id': int(car),
+                              'frame_number': frame_number,
+                              'type': 'Car_' + _DiscretizeAlpha(alpha),
+                              'bbox': clipped,
+                              '3dbbox_loc': [float(x), float(y), float(depth)],
+                              '3dbbox_dim': [float(sizes[car][1]), float(sizes[car][0]), CAR_LENGTH],
+                              'rotation_y': rotation_y,
+                              'alpha': float(alpha),
+                              'occluded': 0 if occlusion < 0.1 else 1 if occlusion < 0.5 else 2,
+                              'truncated': 0 if truncation <= 0.15 else 1 if truncation <= 0.5 else 2,
+                              'difficulty': _Difficulty(clipped['bottom'] - clipped['top'], occlusion, truncation)})
+
+            if self.live:
+                delay = start + frame_number / self.fps - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            yield StereoFrame(str(frame_number).zfill(6), frame_number / self.fps,
+                              cv2.cvtColor(image_l, cv2.COLOR_GRAY2BGR), cv2.cvtColor(image_r, cv2.COLOR_GRAY2BGR), truth)
+
+    def _Visible(self, image, box, shift):
+        # Whether any of box, shifted left by `shift`, is inside the image.
+        height, width = image.shape
+        left, top, right, bottom = box[0] - shift, box[1], box[2] - shift, box[3]
+        return min(right, width) > max(left, 0) and min(bottom, height) > max(top, 0)
+
+    def _Paint(self, image, texture, box, shift):
+        # Pastes texture over box shifted left by `shift`, clipped to the
+        # image. Returns False if nothing of the box is visible.
+        height, width = image.shape
+        left, top, right, bottom = box[0] - shift, box[1], box[2] - shift, box[3]
+        clipped_left, clipped_top = max(left, 0), max(top, 0)
+        clipped_right, clipped_bottom = min(right, width), min(bottom, height)
+        if clipped_right <= clipped_left or clipped_bottom <= clipped_top:
+            return False
+        patch = cv2.resize(texture, (right - left, bottom - top), interpolation=cv2.INTER_NEAREST) if right > left and bottom > top else None
+        if patch is None:
+            return False
+        image[clipped_top:clipped_bottom, clipped_left:clipped_right] = patch[clipped_top - top:clipped_bottom - top, clipped_left - left:clipped_right - left]
+        return True
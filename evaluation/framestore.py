@@ -0,0 +1,393 @@
+################################################################################
+#
+# Compact single-file storage for a sequence of frames, used instead of one
+# pickle per frame in eval/<seq>/predictions and eval/<seq>/groundtruth.
+#
+# File layout:
+#   MAGIC
+#   data blocks (arrays and compressed per-frame blobs), 64-byte aligned
+#   JSON footer describing every block
+#   8 byte little-endian footer length
+#
+# Tracked objects are stored column-wise as typed arrays, one row per object,
+# and rows frame_offsets[i]:frame_offsets[i+1] belong to the i'th frame.
+# image_l, image_depth and point_cloud are optional sections, compressed per
+# frame so any single frame can be decoded without touching the others.
+# FrameStore memory-maps the file, so opening it is cheap and reading a frame
+# only touches that frame's bytes.
+#
+# OpenFrames() returns a reader for either layout, so callers don't need to
+# care whether a sequence was written as a store or as pickles.
+#
+# The artifact policy picks which sections are written at all (see
+# ARTIFACT_POLICIES). Players that need an image or point cloud a sequence
+# was written without get it from the source stereo pair instead, see
+# SourceImagePaths and PointClouds.
+#
+# cv2 and the stereo code are only imported by the functions that need them,
+# so reading tracked objects (all precisionrecall does) needs just numpy.
+#
+################################################################################
+
+import os
+import json
+import pickle
+import zlib
+import numpy as np
+
+MAGIC = b'VDFRAMES1\n'
+STORE_EXTENSION = '.frames'
+_ALIGNMENT = 64
+
+# Known tracked object fields: name -> (dtype, values per object, python type)
+# Labels (strings) are stored as int16 indexes into the footer's label table.
+OBJECT_COLUMNS = {
+    'bbox':         (np.int32,   4, None),
+    'confidence':   (np.float64, 1, float),
+    '3dbbox_loc':   (np.float64, 3, float),
+    '3dbbox_dim':   (np.float64, 3, float),
+    'rotation_y':   (np.float64, 1, float),
+    'alpha':        (np.float64, 1, float),
+    'occluded':     (np.int8,    1, int),
+    'truncated':    (np.int8,    1, int),
+    'frame_number': (np.int32,   1, int),
+    'type':         (np.int16,   1, 'label'),
+    'difficulty':   (np.int16,   1, 'label'),
+}
+BBOX_KEYS = ['left', 'top', 'right', 'bottom']
+
+# Optional per-frame sections and how they are compressed.
+SECTIONS = ['image_l', 'image_depth', 'point_cloud']
+
+# Which sections are kept besides tracked_objects:
+#   'detections': none. All PR() needs.
+#   'depth':      image_depth, keeping every DEPTH_DOWNSAMPLE'th pixel.
+#   'full':       everything, full resolution.
+ARTIFACT_POLICIES = {'detections': (), 'depth': ('image_depth',), 'full': tuple(SECTIONS)}
+DEPTH_DOWNSAMPLE = 4
+
+
+def ApplyArtifactPolicy(frame_data, artifacts='full'):
+    # Returns the part of frame_data that the policy keeps.
+    if artifacts not in ARTIFACT_POLICIES:
+        raise ValueError("Unknown artifact policy '{}', expected one of {}".format(artifacts, sorted(ARTIFACT_POLICIES)))
+    kept = {key: value for key, value in frame_data.items() if key not in SECTIONS or key in ARTIFACT_POLICIES[artifacts]}
+    if artifacts == 'depth' and kept.get('image_depth') is not None:
+        kept['image_depth'] = np.ascontiguousarray(kept['image_depth'][::DEPTH_DOWNSAMPLE, ::DEPTH_DOWNSAMPLE])
+    return kept
+
+
+def _EncodeSection(name, value):
+    if name == 'image_l':
+        # RGB uint8 image, stored as PNG.
+        import cv2
+        ok, encoded = cv2.imencode('.png', cv2.cvtColor(value, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        return encoded.tobytes(), {'shape': list(value.shape), 'dtype': 'uint8'}
+    array = np.ascontiguousarray(value)
+    return zlib.compress(array.tobytes(), 1), {'shape': list(array.shape), 'dtype': array.dtype.str}
+
+def _DecodeSection(name, data, meta):
+    if name == 'image_l':
+        import cv2
+        return cv2.cvtColor(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    return np.frombuffer(zlib.decompress(data), dtype=meta['dtype']).reshape(meta['shape'])
+
+
+class FrameStoreWriter:
+    # Streams frames into a store. Compressed sections are written as frames
+    # arrive; the object columns are small and written on Close(). The file
+    # only appears at `path` once Close() succeeds.
+    def __init__(self, path, artifacts='full'):
+        self.path = path
+        self.artifacts = artifacts
+        self.tmp_path = path + '.tmp'
+        self.file = open(self.tmp_path, 'wb')
+        self.file.write(MAGIC)
+        self.frame_numbers = []
+        self.object_counts = []
+        self.row_count = 0
+        self.columns = {}
+        self.labels = []
+        self.label_ids = {}
+        self.section_blobs = {name: [] for name in SECTIONS}
+
+    def _LabelId(self, label):
+        if label not in self.label_ids:
+            self.label_ids[label] = len(self.labels)
+            self.labels.append(label)
+        return self.label_ids[label]
+
+    def _WriteBlock(self, data):
+        padding = (-self.file.tell()) % _ALIGNMENT
+        self.file.write(b'\0' * padding)
+        offset = self.file.tell()
+        self.file.write(data)
+        return offset, len(data)
+
+    def Write(self, frame_name, frame_data):
+        frame_data = ApplyArtifactPolicy(frame_data, self.artifacts)
+        frame_index = len(self.frame_numbers)
+        tracked_objects = frame_data['tracked_objects']
+        self.frame_numbers.append(int(frame_name))
+        self.object_counts.append(len(tracked_objects))
+
+        for tracked_object in tracked_objects:
+            for key in tracked_object:
+                if key not in OBJECT_COLUMNS:
+                    raise KeyError("FrameStore has no column for tracked object field '{}'".format(key))
+                if key not in self.columns:
+                    # Objects written before this column appeared get a blank row.
+                    self.columns[key] = [None] * self.row_count
+            self.row_count += 1
+            for key, values in self.columns.items():
+                value = tracked_object.get(key)
+                if value is not None and key == 'bbox':
+                    value = [value[k] for k in BBOX_KEYS]
+                elif value is not None and OBJECT_COLUMNS[key][2] == 'label':
+                    value = self._LabelId(value)
+                values.append(value)
+
+        for name in SECTIONS:
+            value = frame_data.get(name)
+            if value is not None:
+                data, meta = _EncodeSection(name, value)
+                offset, length = self._WriteBlock(data)
+                self.section_blobs[name].append((frame_index, offset, length, meta))
+
+    def Close(self):
+        footer = {'frame_count': len(self.frame_numbers), 'labels': self.labels, 'arrays': {}, 'sections': {}}
+
+        def write_array(name, array):
+            array = np.ascontiguousarray(array)
+            offset, length = self._WriteBlock(array.tobytes())
+            footer['arrays'][name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+        write_array('frame_numbers', np.array(self.frame_numbers, dtype=np.int32))
+        write_array('frame_offsets', np.concatenate([[0], np.cumsum(self.object_counts)]).astype(np.int64))
+        for key, values in self.columns.items():
+            dtype, width, _ = OBJECT_COLUMNS[key]
+            blank = np.nan if np.issubdtype(dtype, np.floating) else -1
+            present = np.array([value is not None for value in values], dtype=bool)
+            filled = [value if value is not None else ([blank] * width if width > 1 else blank) for value in values]
+            array = np.array(filled, dtype=dtype).reshape(len(values), width) if width > 1 else np.array(filled, dtype=dtype)
+            write_array('column/' + key, array)
+            if not present.all():
+                write_array('present/' + key, present)
+        for name, blobs in self.section_blobs.items():
+            if blobs:
+                footer['sections'][name] = [[frame_index, offset, length, meta] for frame_index, offset, length, meta in blobs]
+
+        footer_bytes = json.dumps(footer).encode('utf-8')
+        self.file.write(footer_bytes)
+        self.file.write(len(footer_bytes).to_bytes(8, 'little'))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def Abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.Close()
+        else:
+            self.Abort()
+
+
+class FrameStore:
+    # Memory-mapped reader for a file written by FrameStoreWriter.
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise ValueError("{} is not a frame store".format(path))
+        footer_length = int.from_bytes(bytes(self.data[-8:]), 'little')
+        footer = json.loads(bytes(self.data[-8 - footer_length:-8]).decode('utf-8'))
+
+        self.labels = footer['labels']
+        self.arrays = {}
+        for name, info in footer['arrays'].items():
+            dtype = np.dtype(info['dtype'])
+            count = int(np.prod(info['shape'])) if info['shape'] else 1
+            block = self.data[info['offset']:info['offset'] + count * dtype.itemsize]
+            self.arrays[name] = block.view(dtype).reshape(info['shape'])
+        self.frame_numbers = self.arrays['frame_numbers']
+        self.frame_offsets = self.arrays['frame_offsets']
+        self.frame_index = {int(frame_number): i for i, frame_number in enumerate(self.frame_numbers)}
+        self.sections = {name: {frame_index: (offset, length, meta) for frame_index, offset, length, meta in blobs}
+                         for name, blobs in footer['sections'].items()}
+
+    def __len__(self):
+        return len(self.frame_numbers)
+
+    def FrameNames(self):
+        return [str(int(frame_number)).zfill(6) for frame_number in self.frame_numbers]
+
+    def ColumnNames(self):
+        return [name[len('column/'):] for name in self.arrays if name.startswith('column/')]
+
+    def Column(self, name):
+        # All rows of one object column, e.g. Column('confidence'). Label
+        # columns hold indexes into self.labels.
+        return self.arrays['column/' + name]
+
+    def FrameRows(self, index):
+        # Row range of the objects in the index'th frame (not frame number).
+        return slice(int(self.frame_offsets[index]), int(self.frame_offsets[index + 1]))
+
+    def LoadSection(self, name, index):
+        if index not in self.sections.get(name, {}):
+            return None
+        offset, length, meta = self.sections[name][index]
+        return _DecodeSection(name, bytes(self.data[offset:offset + length]), meta)
+
+    def LoadFrame(self, frame_name, sections=SECTIONS):
+        # Returns the frame as the same dict the pickle files held. Frames
+        # that were never written come back empty.
+        index = self.frame_index.get(int(frame_name))
+        if index is None:
+            return {'tracked_objects': []}
+
+        rows = self.FrameRows(index)
+        tracked_objects = [{} for _ in range(rows.stop - rows.start)]
+        for key in self.ColumnNames():
+            _, width, python_type = OBJECT_COLUMNS[key]
+            values = self.Column(key)[rows]
+            present = self.arrays['present/' + key][rows] if 'present/' + key in self.arrays else None
+            for i, tracked_object in enumerate(tracked_objects):
+                if present is not None and not present[i]:
+                    continue
+                if key == 'bbox':
+                    tracked_object[key] = {k: int(v) for k, v in zip(BBOX_KEYS, values[i])}
+                elif python_type == 'label':
+                    tracked_object[key] = self.labels[int(values[i])]
+                elif width > 1:
+                    tracked_object[key] = [python_type(v) for v in values[i]]
+                else:
+                    tracked_object[key] = python_type(values[i])
+
+        frame_data = {'tracked_objects': tracked_objects}
+        for name in sections:
+            if name in self.sections:
+                frame_data[name] = self.LoadSection(name, index)
+        return frame_data
+
+
+class PickleFrames:
+    # Reader for the old layout: one pickle per frame in a directory.
+    def __init__(self, directory):
+        self.directory = directory
+
+    def FrameNames(self):
+        return [name for name in sorted(os.listdir(self.directory)) if name != '.DS_Store']
+
+    def LoadFrame(self, frame_name, sections=SECTIONS):
+        if not isinstance(frame_name, str):
+            frame_name = str(frame_name).zfill(6)
+        path = os.path.join(self.directory, frame_name)
+        if not os.path.exists(path):
+            return {'tracked_objects': []}
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+class PickleFrameSink:
+    # Writes one pickle per frame into a directory, the old output layout.
+    def __init__(self, directory, artifacts='full'):
+        self.directory = directory
+        self.artifacts = artifacts
+        os.makedirs(directory, exist_ok=True)
+        # A store left over from an earlier run would shadow these pickles.
+        if os.path.exists(directory + STORE_EXTENSION):
+            os.remove(directory + STORE_EXTENSION)
+
+    def Write(self, frame_name, frame_data):
+        frame_data = ApplyArtifactPolicy(frame_data, self.artifacts)
+        with open(os.path.join(self.directory, frame_name), 'wb+') as out_file:
+            pickle.dump(frame_data, out_file, pickle.HIGHEST_PROTOCOL)
+
+    def Close(self):
+        pass
+
+    def Abort(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.Close()
+        else:
+            self.Abort()
+
+
+def OpenFrameSink(path, output_format='store', artifacts='full'):
+    # path is the old pickle directory, e.g. eval/0010/predictions. A store is
+    # written next to it as eval/0010/predictions.frames.
+    if output_format == 'store':
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return FrameStoreWriter(path + STORE_EXTENSION, artifacts)
+    elif output_format == 'pickle':
+        return PickleFrameSink(path, artifacts)
+    raise ValueError("Unknown output format '{}', expected 'store' or 'pickle'".format(output_format))
+
+def OpenFrames(path):
+    # Reader for eval/<seq>/predictions or groundtruth, whichever layout it
+    # was written in. Prefers the store if both exist.
+    if os.path.exists(path + STORE_EXTENSION):
+        return FrameStore(path + STORE_EXTENSION)
+    if os.path.isdir(path):
+        return PickleFrames(path)
+    raise FileNotFoundError("No frames at {}".format(path))
+
+
+def SourceImagePaths(vd_directory, sequence_name, frame_name):
+    # The KITTI stereo pair a frame was predicted from.
+    if not isinstance(frame_name, str):
+        frame_name = str(frame_name).zfill(6)
+    image_path_l = os.path.join(vd_directory, 'data/KITTI-tracking/training/image_02', sequence_name, frame_name + '.png')
+    image_path_r = os.path.join(vd_directory, 'data/KITTI-tracking/training/image_03', sequence_name, frame_name + '.png')
+    return image_path_l, image_path_r
+
+def LoadSourceImage(vd_directory, sequence_name, frame_name):
+    # RGB left image, the same as a frame's image_l.
+    import cv2
+    image_path_l, _ = SourceImagePaths(vd_directory, sequence_name, frame_name)
+    return cv2.cvtColor(cv2.imread(image_path_l), cv2.COLOR_BGR2RGB)
+
+
+class PointClouds:
+    # Point clouds for a sequence written without them. Each one is
+    # recomputed from the source stereo pair on first use. With cache=True it
+    # is also saved to eval/<seq>/point_clouds/<frame>.npy, so replaying the
+    # sequence only pays for stereo once.
+    def __init__(self, vd_directory, sequence_name, cache=True, preset='balanced'):
+        self.vd_directory = vd_directory
+        self.sequence_name = sequence_name
+        self.preset = preset
+        self.cache_directory = os.path.join(vd_directory, 'eval', sequence_name, 'point_clouds') if cache else None
+
+    def Load(self, frame_name, frame_data=None):
+        # Prefers the point cloud stored in frame_data, if there is one.
+        if frame_data is not None and frame_data.get('point_cloud') is not None:
+            return frame_data['point_cloud']
+        if not isinstance(frame_name, str):
+            frame_name = str(frame_name).zfill(6)
+
+        cache_path = os.path.join(self.cache_directory, frame_name + '.npy') if self.cache_directory else None
+        if cache_path and os.path.exists(cache_path):
+            return np.load(cache_path)
+
+        from StereoDepth import Convert3D
+        image_path_l, image_path_r = SourceImagePaths(self.vd_directory, self.sequence_name, frame_name)
+        point_cloud = Convert3D(image_path_l, image_path_r, preset=self.preset).point_cloud
+        if cache_path:
+            os.makedirs(self.cache_directory, exist_ok=True)
+            tmp_path = cache_path + '.tmp.npy'
+            np.save(tmp_path, point_cloud)
+            os.replace(tmp_path, cache_path)
+        return point_cloud
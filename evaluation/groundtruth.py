@@ -1,5 +1,5 @@
 import os
-import pickle
+from framestore import OpenFrameSink
 
 def _DiscretizeAlpha(alpha):
     pi = 3.14159
@@ -57,16 +57,16 @@ class GroundTruthParser:
                     sequence[tracked_object['frame_number']]['tracked_objects'].append(tracked_object)
         return sequence
 
-    def OutGroundTruthSequence(self, sequence_number, out_directory=None):
-        # Read objects ground truth sequence file. Write one file per frame.
+    def OutGroundTruthSequence(self, sequence_number, out_directory=None, output_format='store'):
+        # Read objects ground truth sequence file. Write it as a frame store
+        # (or one pickle per frame with output_format='pickle').
         if not out_directory:
             out_directory = os.path.join(self.vd_directory, 'eval', sequence_number, 'groundtruth')
         sequence = self.ReadGroundTruthSequence(sequence_number)
-        os.makedirs(out_directory, exist_ok=True)
-        for frame_number, frame in enumerate(sequence):
-            out_file_name = os.path.join(out_directory, str(frame_number).zfill(6))
-            with open(out_file_name, 'wb+') as out_file_frame:
-                pickle.dump(frame, out_file_frame, pickle.HIGHEST_PROTOCOL)
+        # A failed write aborts the sink, so no partial store is left behind.
+        with OpenFrameSink(out_directory, output_format) as sink:
+            for frame_number, frame in enumerate(sequence):
+                sink.Write(str(frame_number).zfill(6), frame)
 
 #OutGroundTruthSequence('/home/eric/vehicle-detection/data/KITTI-tracking/training/label_02/0010.txt', '0010/groundtruth')
 
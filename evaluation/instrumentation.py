@@ -0,0 +1,350 @@
+################################################################################
+#
+# Opt-in instrumentation for the whole pipeline.
+#
+# Library code marks its stages with instrumentation.Time('disparity') and
+# counts things with instrumentation.Count('births'). Both cost one global
+# lookup until a Recorder is enabled with instrumentation.Enable(), so they
+# can stay on hot paths.
+#
+# A Recorder is a pipeline.PipelineStats that also keeps:
+#   - the last `window` timings of every stage, for p50/p95/p99
+#   - a trace of every timed stage (frame, thread, start, duration), which
+#     ExportTrace writes as JSON (loads in chrome://tracing and Perfetto) or
+#     CSV
+#   - one row per frame with its duration, the counters it added (e.g.
+#     detections, births, deaths) and gauges (e.g. live_tracks)
+#   - optionally a profile of a range of frames, from cProfile (.prof, read
+#     it with pstats or snakeviz) or from a sampling profiler that looks at
+#     every thread's stack each few ms (.folded, for flamegraph.pl or
+#     speedscope)
+#
+# generate.py and the players take the same options, see PopOptions:
+#   --trace json|csv          write <name>_trace.json/.csv to eval/<seq>/
+#   --profile START:STOP      profile frames START up to STOP
+#   --profiler cprofile|sampling
+#
+################################################################################
+
+import os
+import sys
+import csv
+import json
+import time
+import cProfile
+import threading
+import collections
+from contextlib import contextmanager, nullcontext
+import numpy as np
+from pipeline import PipelineStats
+
+TRACE_FORMATS = ['json', 'csv']
+PROFILERS = ['cprofile', 'sampling']
+PERCENTILES = (50, 95, 99)
+
+_NULL_CONTEXT = nullcontext()
+_recorder = None
+
+
+class Recorder(PipelineStats):
+    # window:         timings kept per stage for the percentiles.
+    # trace:          keep every timed stage for ExportTrace. Costs one tuple
+    #                 per stage per frame.
+    # profile_frames: (start, stop) frame indexes to profile, counting frames
+    #                 as they are recorded from 0. The profile is written to
+    #                 profile_path when frame stop - 1 ends, or on Finish.
+    def __init__(self, window=1000, trace=True, profile_frames=None, profile_path=None, profiler='cprofile', sample_interval=0.005):
+        super().__init__()
+        if profiler not in PROFILERS:
+            raise ValueError("Unknown profiler '{}', expected one of {}".format(profiler, PROFILERS))
+        self.window = window
+        self.recent = {}
+        self.events = [] if trace else None
+        self.frames = []
+        self.gauges = {}
+        self.origin = time.perf_counter()
+        self.local = threading.local()
+        self.frame_index = 0
+        self.profile_frames = profile_frames
+        self.profile_path = profile_path
+        self.profiler = profiler
+        self.sample_interval = sample_interval
+        self._profile = None
+
+    def AddTime(self, stage, seconds):
+        end = time.perf_counter()
+        super().AddTime(stage, seconds)
+        with self.lock:
+            recent = self.recent.get(stage)
+            if recent is None:
+                recent = self.recent[stage] = collections.deque(maxlen=self.window)
+            recent.append(seconds)
+            if self.events is not None:
+                self.events.append((getattr(self.local, 'frame', None), stage, threading.current_thread().name,
+                                    end - seconds - self.origin, seconds))
+
+    def Gauge(self, name, value):
+        # Latest value of something, reported with the frame it was set in.
+        with self.lock:
+            self.gauges[name] = value
+
+    @contextmanager
+    def Label(self, frame_name):
+        # Attributes stages timed on this thread to frame_name, e.g. on a
+        # worker thread that handles one frame.
+        previous = getattr(self.local, 'frame', None)
+        self.local.frame = frame_name
+        try:
+            yield
+        finally:
+            self.local.frame = previous
+
+    @contextmanager
+    def Frame(self, frame_name, frames=1):
+        # Wraps everything done for one frame (or a batch of `frames`) on the
+        # calling thread, and adds a row to self.frames.
+        index = self.frame_index
+        self.frame_index += frames
+        if self.profile_frames is not None and self._profile is None and index <= self.profile_frames[0] < index + frames:
+            self._StartProfile()
+        with self.lock:
+            counters_before = dict(self.counters)
+        start = time.perf_counter()
+        try:
+            with self.Label(frame_name):
+                yield
+        finally:
+            duration = time.perf_counter() - start
+            self.AddTime('frame', duration / frames)
+            with self.lock:
+                row = {'frame': frame_name, 'index': index, 'start_ms': 1000 * (start - self.origin), 'duration_ms': 1000 * duration}
+                for name, count in self.counters.items():
+                    row[name] = count - counters_before.get(name, 0)
+                row.update(self.gauges)
+                self.frames.append(row)
+            if self._profile is not None and index + frames >= self.profile_frames[1]:
+                self._StopProfile()
+
+    def Summary(self):
+        # PipelineStats.Summary plus p50/p95/p99 (ms) over the recent timings.
+        summary = super().Summary()
+        with self.lock:
+            recent = {stage: np.array(timings) for stage, timings in self.recent.items()}
+            summary['gauges'] = dict(self.gauges)
+        for stage, timings in recent.items():
+            if len(timings) and stage in summary['stages']:
+                for percentile, value in zip(PERCENTILES, np.percentile(1000 * timings, PERCENTILES)):
+                    summary['stages'][stage]['p{}_ms'.format(percentile)] = float(value)
+        return summary
+
+    def __str__(self):
+        summary = self.Summary()
+        lines = ["{:<14} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}".format('stage', 'count', 'total s', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms')]
+        for stage, info in sorted(summary['stages'].items(), key=lambda x: -x[1]['total_s']):
+            lines.append("{:<14} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                stage, info['count'], info['total_s'], info['mean_ms'], info.get('p50_ms', np.nan), info.get('p95_ms', np.nan), info.get('p99_ms', np.nan)))
+        for name, info in sorted(summary['queues'].items()):
+            lines.append("{:<14} queue mean {:.2f} max {} of {}".format(name, info['mean'], info['max'], info['capacity']))
+        for name, count in sorted(summary['counters'].items()):
+            lines.append("{:<14} {:>7}".format(name, count))
+        for name, value in sorted(summary['gauges'].items()):
+            lines.append("{:<14} {:>7} (last)".format(name, value))
+        return '\n'.join(lines)
+
+    def ExportTrace(self, path):
+        # .json: the summary, per-frame rows and the stage events in Chrome
+        # trace event format. .csv: the stage events, with the per-frame rows
+        # in <path>_frames.csv next to it.
+        with self.lock:
+            events = list(self.events or [])
+            frames = list(self.frames)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['frame', 'stage', 'thread', 'start_ms', 'duration_ms'])
+                for frame_name, stage, thread, start, duration in events:
+                    writer.writerow([frame_name, stage, thread, '{:.3f}'.format(1000 * start), '{:.3f}'.format(1000 * duration)])
+            columns = []
+            for row in frames:
+                columns.extend(column for column in row if column not in columns)
+            with open(os.path.splitext(path)[0] + '_frames.csv', 'w', newline='') as f:
+                writer = csv.DictWriter(f, columns)
+                writer.writeheader()
+                writer.writerows(frames)
+            return
+
+        thread_ids = {}
+        trace_events = []
+        for frame_name, stage, thread, start, duration in events:
+            trace_events.append({'name': stage, 'ph': 'X', 'pid': 0, 'tid': thread_ids.setdefault(thread, len(thread_ids)),
+                                 'ts': 1e6 * start, 'dur': 1e6 * duration, 'args': {'frame': frame_name}})
+        for thread, thread_id in thread_ids.items():
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': thread_id, 'args': {'name': thread}})
+        with open(path, 'w') as f:
+            json.dump({'summary': self.Summary(), 'frames': frames, 'traceEvents': trace_events}, f, default=_JSONDefault)
+
+    def Finish(self):
+        # Stops a profile that is still running.
+        if self._profile is not None:
+            self._StopProfile()
+
+    def _StartProfile(self):
+        if self.profiler == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._profile = SamplingProfiler(self.sample_interval)
+            self._profile.start()
+
+    def _StopProfile(self):
+        profile, self._profile = self._profile, None
+        self.profile_frames = None
+        if self.profiler == 'cprofile':
+            profile.disable()
+            if self.profile_path is not None:
+                profile.dump_stats(self.profile_path)
+        else:
+            profile.Stop()
+            if self.profile_path is not None:
+                profile.Write(self.profile_path)
+
+
+class SamplingProfiler(threading.Thread):
+    # Every `interval` seconds, records the stack of every other thread.
+    # Much less overhead than cProfile on numpy/OpenCV heavy code, and it
+    # sees the pipeline's background threads too. Write() saves the samples
+    # as folded stacks: "thread;outer;...;inner count" per line.
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def Stop(self):
+        self.stopped.set()
+        self.join()
+
+    def Write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+
+def _JSONDefault(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+def Enable(recorder=None):
+    # Makes recorder (or a new Recorder) the process-wide one and returns it.
+    global _recorder
+    _recorder = recorder if recorder is not None else Recorder()
+    return _recorder
+
+
+def Disable():
+    # Returns the recorder that was active, with any profile stopped.
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.Finish()
+    return recorder
+
+
+def Active():
+    return _recorder
+
+
+def Time(stage):
+    recorder = _recorder
+    return _NULL_CONTEXT if recorder is None else recorder.Time(stage)
+
+
+def Count(name, count=1):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.Count(name, count)
+
+
+def Gauge(name, value):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.Gauge(name, value)
+
+
+def Frame(frame_name, frames=1):
+    recorder = _recorder
+    return _NULL_CONTEXT if recorder is None else recorder.Frame(frame_name, frames)
+
+
+def Label(frame_name):
+    recorder = _recorder
+    return _NULL_CONTEXT if recorder is None else recorder.Label(frame_name)
+
+
+def PopOptions(argv):
+    # Removes --trace, --profile and --profiler from argv. Returns
+    # (options, argv); options is a dict for Session, empty if none were given.
+    options = {}
+    for name in ('--trace', '--profile', '--profiler'):
+        if name in argv:
+            index = argv.index(name)
+            options[name[2:]] = argv[index + 1]
+            argv = argv[:index] + argv[index + 2:]
+    if options.get('trace', 'json') not in TRACE_FORMATS:
+        raise ValueError("Unknown trace format '{}', expected one of {}".format(options['trace'], TRACE_FORMATS))
+    if options.get('profiler', 'cprofile') not in PROFILERS:
+        raise ValueError("Unknown profiler '{}', expected one of {}".format(options['profiler'], PROFILERS))
+    return options, argv
+
+
+@contextmanager
+def Session(options, directory, name, show_summary=True):
+    # Records one run (e.g. one sequence) if options (from PopOptions) ask
+    # for it, then writes directory/<name>_trace.<format> and/or
+    # directory/<name>_profile.prof|.folded. Yields the Recorder, or None.
+    if not options:
+        yield None
+        return
+    profile_frames = None
+    profile_path = None
+    profiler = options.get('profiler', 'cprofile')
+    if 'profile' in options:
+        start, stop = options['profile'].split(':')
+        profile_frames = (int(start), int(stop))
+        profile_path = os.path.join(directory, '{}_profile.{}'.format(name, 'prof' if profiler == 'cprofile' else 'folded'))
+    os.makedirs(directory, exist_ok=True)
+    global _recorder
+    previous = _recorder
+    recorder = Enable(Recorder(trace='trace' in options, profile_frames=profile_frames, profile_path=profile_path, profiler=profiler))
+    try:
+        yield recorder
+    finally:
+        recorder.Finish()
+        _recorder = previous
+        if 'trace' in options:
+            recorder.ExportTrace(os.path.join(directory, '{}_trace.{}'.format(name, options['trace'])))
+        if show_summary:
+            print()
+            print(recorder)
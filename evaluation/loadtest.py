@@ -0,0 +1,202 @@
+################################################################################
+#
+# Client for service.py, and a load test built on it.
+#
+# Usage:
+# python evaluation/loadtest.py --unix /tmp/vd.sock
+# python evaluation/loadtest.py --tcp 127.0.0.1:7878 --streams 8 --frames 100
+# python evaluation/loadtest.py --unix /tmp/vd.sock --streams 4 --in-flight 2 --encoding png
+# python evaluation/loadtest.py --unix /tmp/vd.sock --streams 4 --fps 10
+#
+# Every stream replays its own framesource.SyntheticSource, so no data is
+# needed. A stream keeps up to --in-flight frames outstanding, and with
+# --fps it sends no faster than a camera would. At the end we print the
+# client side throughput and latency percentiles next to the server's own
+# stats.
+#
+################################################################################
+
+import sys
+import json
+import time
+import asyncio
+import itertools
+import numpy as np
+from service import EncodeImage, WriteMessage, ReadMessage
+from framesource import SyntheticSource
+
+
+class ServiceError(Exception):
+    pass
+
+
+class TrackingClient:
+    # One connection to a TrackingServer. Requests may be issued
+    # concurrently; replies are matched to them by id.
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.ids = itertools.count()
+        self.waiting = {}
+        self.write_lock = asyncio.Lock()
+        self.receiver = asyncio.ensure_future(self._Receive())
+
+    @classmethod
+    async def Connect(cls, host=None, port=None, path=None):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def Predict(self, stream_id, image_l, image_r, timestamp=None, frame_name=None, filter_type='kalman', encoding='raw'):
+        # Returns the reply, whose 'tracked_objects' are in the format of
+        # NetworkModel frame_data. image_l and image_r are BGR.
+        images = [EncodeImage(image, encoding) for image in (image_l, image_r)]
+        header = {'op': 'predict', 'stream': stream_id, 'frame': frame_name, 'timestamp': timestamp,
+                  'filter': filter_type, 'images': [description for description, _ in images]}
+        return await self._Request(header, [blob for _, blob in images])
+
+    async def CloseStream(self, stream_id):
+        return await self._Request({'op': 'close_stream', 'stream': stream_id})
+
+    async def Health(self):
+        return await self._Request({'op': 'health'})
+
+    async def Stats(self):
+        return await self._Request({'op': 'stats'})
+
+    async def Close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        self.receiver.cancel()
+        try:
+            await self.receiver
+        except asyncio.CancelledError:
+            pass
+
+    async def _Request(self, header, blobs=()):
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[request_id] = future
+        async with self.write_lock:
+            WriteMessage(self.writer, dict(header, id=request_id), blobs)
+            await self.writer.drain()
+        reply = await future
+        if 'error' in reply:
+            raise ServiceError(reply['error'])
+        return reply
+
+    async def _Receive(self):
+        try:
+            while True:
+                message = await ReadMessage(self.reader)
+                if message is None:
+                    break
+                reply, _ = message
+                future = self.waiting.pop(reply.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        finally:
+            for future in self.waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to the tracking service closed"))
+            self.waiting.clear()
+
+
+async def _RunStream(client, stream_id, frames, in_flight, fps, encoding, filter_type, latencies, errors):
+    # Sends one stream's frames in order with at most in_flight outstanding.
+    slots = asyncio.Semaphore(in_flight)
+    start = time.perf_counter()
+
+    async def send(frame):
+        sent = time.perf_counter()
+        try:
+            await client.Predict(stream_id, frame.image_l, frame.image_r, frame.timestamp, frame.name, filter_type, encoding)
+            latencies.append(time.perf_counter() - sent)
+        except (ServiceError, ConnectionError) as e:
+            errors.append(str(e))
+        finally:
+            slots.release()
+
+    tasks = []
+    for frame in frames:
+        if fps:
+            delay = start + frame.timestamp - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await slots.acquire()
+        tasks.append(asyncio.ensure_future(send(frame)))
+    await asyncio.gather(*tasks)
+    await client.CloseStream(stream_id)
+
+
+async def RunLoadTest(host=None, port=None, path=None, streams=4, frames=50, in_flight=1, fps=None,
+                      encoding='raw', filter_type='kalman', connections=None, num_cars=5):
+    # Replays `streams` synthetic streams of `frames` frames each against the
+    # server, over `connections` connections (default one per stream).
+    # With fps, frame timestamps are spaced at that rate and sending is paced
+    # to match. Returns a dict with the client side results and the server
+    # stats afterwards.
+    connections = streams if connections is None else connections
+    clients = [await TrackingClient.Connect(host, port, path) for _ in range(connections)]
+
+    # Render up front, so the client doesn't compete with the server for CPU
+    # while the test runs.
+    stream_frames = [list(SyntheticSource(frames, num_cars, fps=fps or 10, seed=stream)) for stream in range(streams)]
+
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*[_RunStream(clients[stream % connections], 'load{}'.format(stream), stream_frames[stream],
+                                      in_flight, fps, encoding, filter_type, latencies, errors)
+                           for stream in range(streams)])
+    elapsed = time.perf_counter() - start
+    server_stats = await clients[0].Stats()
+    for client in clients:
+        await client.Close()
+
+    latencies_ms = 1000 * np.array(latencies)
+    result = {'streams': streams, 'frames': len(latencies), 'errors': len(errors), 'elapsed_s': elapsed,
+              'frames_per_s': len(latencies) / elapsed if elapsed > 0 else 0.0,
+              'latency_ms': {}, 'server': server_stats}
+    if len(latencies_ms):
+        result['latency_ms'] = {'mean': float(latencies_ms.mean()), 'max': float(latencies_ms.max())}
+        for percentile in (50, 95, 99):
+            result['latency_ms']['p{}'.format(percentile)] = float(np.percentile(latencies_ms, percentile))
+    if errors:
+        result['first_error'] = errors[0]
+    return result
+
+
+def _PopOption(argv, name, default):
+    # Removes "name value" from argv and returns (value, argv).
+    if name not in argv:
+        return default, argv
+    index = argv.index(name)
+    return argv[index + 1], argv[:index] + argv[index + 2:]
+
+
+def main(argv):
+    tcp, argv = _PopOption(argv, '--tcp', None)
+    path, argv = _PopOption(argv, '--unix', None)
+    streams, argv = _PopOption(argv, '--streams', 4)
+    frames, argv = _PopOption(argv, '--frames', 50)
+    in_flight, argv = _PopOption(argv, '--in-flight', 1)
+    fps, argv = _PopOption(argv, '--fps', None)
+    encoding, argv = _PopOption(argv, '--encoding', 'raw')
+    filter_type, argv = _PopOption(argv, '--filter', 'kalman')
+    if tcp is None and path is None:
+        path = '/tmp/vd.sock'
+    host, port = (None, None) if tcp is None else (tcp.rsplit(':', 1)[0], int(tcp.rsplit(':', 1)[1]))
+
+    result = asyncio.run(RunLoadTest(host, port, path, int(streams), int(frames), int(in_flight),
+                                     None if fps is None else float(fps), encoding, filter_type))
+    print(json.dumps(result, indent=2))
+    return 1 if result['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -9,26 +9,66 @@ sys.path.append(os.path.join(vd_directory, 'darkflow'))
 sys.path.append(os.path.join(vd_directory, 'visualization'))
 
 
-from darkflow.net.build import TFNet
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pickle
+import queue
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from StereoDepth import *
+from pipeline import PipelineStats, StereoReader, StreamReader, FrameWriter, END_OF_STREAM
+from framestore import OpenFrameSink
 import visualization2d
-from onlinekalman import OnlineKalman, MultiOnlineKalman
-from particlefilter import ParticleFilter, MultiOnlineParticleFilter
+from onlinekalman import OnlineKalman, MultiOnlineKalman, KALMAN_LOG_FIELDS
+from particlefilter import ParticleFilter, MultiOnlineParticleFilter, PARTICLE_LOG_FIELDS
+from tracklog import TrackLog
+import instrumentation
 
 class NetworkModel:
-    def __init__(self):
+    def __init__(self, batch_size=1, roi_stereo=False, stereo_preset='balanced', output_format='store', artifacts='detections', log_tracks=False, detector=None, gpu_fraction=0.8):
         self.filt = None
+        # Number of frames PredictSequence stacks into one detector forward
+        # pass. Larger batches trade latency for throughput.
+        self.batch_size = batch_size
+        # Only match stereo around detected boxes. Much faster, but frames
+        # carry no point cloud.
+        self.roi_stereo = roi_stereo
+        # One of StereoDepth.STEREO_PRESETS.
+        self.stereo_preset = stereo_preset
+        # 'store' writes one eval/<seq>/predictions.frames file per sequence,
+        # 'pickle' the old one pickle per frame. See framestore.py.
+        self.output_format = output_format
+        # What PredictSequence saves besides tracked_objects, one of
+        # framestore.ARTIFACT_POLICIES. Point clouds are only computed for 'full'.
+        self.artifacts = artifacts
+        # Write every tracker state to eval/<seq>/tracks_<filter>.log, see
+        # tracklog.py. The trackers themselves only keep recent history.
+        self.log_tracks = log_tracks
+        # Share of GPU memory TensorFlow may take; 0 runs on the CPU. Processes
+        # sharing a GPU must split it between them (see generate.py --workers).
+        self.gpu_fraction = gpu_fraction
         self.vd_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
-        os.chdir(self.vd_directory)
-        os.chdir("darkflow")
+        # Anything with darkflow's return_predict can stand in for the
+        # network, e.g. benchmark.StubDetector. darkflow isn't needed then.
+        if detector is not None:
+            self.tfnet = detector
+            return
+
+        from darkflow.net.build import TFNet
+        # darkflow resolves its labels, checkpoints and weights relative to
+        # the working directory by default. Point it at darkflow/ explicitly
+        # instead of changing directory, so the model can live inside other
+        # programs (see service.py).
+        darkflow_directory = os.path.join(self.vd_directory, "darkflow")
         options = {"model": os.path.join(self.vd_directory, "network/cfg/kitti.cfg"),
                    "load": -1,
                    "threshold": 0.01,
-                   "gpu": 0.8}
+                   "gpu": gpu_fraction,
+                   "labels": os.path.join(darkflow_directory, "labels.txt"),
+                   "backup": os.path.join(darkflow_directory, "ckpt", ""),
+                   "binary": os.path.join(darkflow_directory, "bin", ""),
+                   "config": os.path.join(darkflow_directory, "cfg", "")}
 
         self.tfnet = TFNet(options)
 
@@ -36,17 +76,96 @@ class NetworkModel:
         #print("----------------------")
         #directory_l = os.path.join(self.vd_directory, "data/KITTI-tracking/training/image_02/", sequence_name)
         #directory_r = os.path.join(self.vd_directory, "data/KITTI-tracking/training/image_03/", sequence_name)
+        image_path_l, image_path_r = self._ImagePaths(sequence_name, image_name)
+
+        with instrumentation.Time('read'):
+            bgr_image = cv2.imread(image_path_l)
+            bgr_image_r = cv2.imread(image_path_r)
+            rgb_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
+        with instrumentation.Time('detect'):
+            yolo_prediction = self.tfnet.return_predict(rgb_image)
+        stereoPrediction = Convert3D(bgr_image, bgr_image_r, yolo_prediction, roi=self.roi_stereo, preset=self.stereo_preset)
+
+        with instrumentation.Time('track'):
+            return self._TrackDetections(sequence_name, rgb_image, yolo_prediction, stereoPrediction, filter_type, add_old_detections, filter_high_confidence_only)
+
+    def PredictBatch(self, sequence_name, frame_indices, filter_type='kalman', add_old_detections=True, filter_high_confidence_only=False):
+        # Same as calling PredictFrame for each frame in frame_indices, but the
+        # detector sees all frames in a single forward pass. frame_indices may
+        # hold ints or file names. Returns frame_data dicts in the given order.
+        rgb_images = []
+        bgr_pairs = []
+        for image_name in frame_indices:
+            image_path_l, image_path_r = self._ImagePaths(sequence_name, image_name)
+            with instrumentation.Time('read'):
+                bgr_image = cv2.imread(image_path_l)
+                bgr_pairs.append((bgr_image, cv2.imread(image_path_r)))
+                rgb_images.append(cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB))
+
+        with instrumentation.Time('detect'):
+            yolo_predictions = self._DetectBatch(rgb_images)
+
+        frames = []
+        for rgb_image, (bgr_image_l, bgr_image_r), yolo_prediction in zip(rgb_images, bgr_pairs, yolo_predictions):
+            stereoPrediction = Convert3D(bgr_image_l, bgr_image_r, yolo_prediction, roi=self.roi_stereo, preset=self.stereo_preset)
+            with instrumentation.Time('track'):
+                frames.append(self._TrackDetections(sequence_name, rgb_image, yolo_prediction, stereoPrediction, filter_type, add_old_detections, filter_high_confidence_only))
+        return frames
+
+    def _DetectBatch(self, rgb_images):
+        # Batched equivalent of tfnet.return_predict. Stacks the preprocessed
+        # images into one feed, then decodes the boxes per image.
+        if len(rgb_images) == 0:
+            return []
+        if not hasattr(self.tfnet, 'framework'):
+            # Not a darkflow network, so no batched forward pass.
+            return [self.tfnet.return_predict(rgb_image) for rgb_image in rgb_images]
+        framework = self.tfnet.framework
+        batch = np.stack([framework.resize_input(rgb_image) for rgb_image in rgb_images])
+        net_outs = self.tfnet.sess.run(self.tfnet.out, {self.tfnet.inp: batch})
+        threshold = self.tfnet.FLAGS.threshold
+
+        predictions = []
+        for rgb_image, net_out in zip(rgb_images, net_outs):
+            h, w, _ = rgb_image.shape
+            boxes_info = []
+            for box in framework.findboxes(net_out):
+                tmp_box = framework.process_box(box, h, w, threshold)
+                if tmp_box is None:
+                    continue
+                boxes_info.append({'label': tmp_box[4],
+                                   'confidence': tmp_box[6],
+                                   'topleft': {'x': tmp_box[0], 'y': tmp_box[1]},
+                                   'bottomright': {'x': tmp_box[2], 'y': tmp_box[3]}})
+            predictions.append(boxes_info)
+        return predictions
+
+    def _ImagePaths(self, sequence_name, image_name):
         if type(image_name) == int:
             image_name = str(image_name).zfill(6) + '.png'
         image_path_l = os.path.join(self.vd_directory, "data/KITTI-tracking/training/image_02/", sequence_name, image_name)
         image_path_r = os.path.join(self.vd_directory, "data/KITTI-tracking/training/image_03/", sequence_name, image_name)
+        return image_path_l, image_path_r
 
-        bgr_image = cv2.imread(image_path_l)
-        rgb_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
-        yolo_prediction = self.tfnet.return_predict(rgb_image)
-        stereoPrediction = Convert3D(image_path_l, image_path_r, yolo_prediction)
+    def NewTracker(self, sequence_name, filter_type='kalman'):
+        # A fresh multi-object tracker of filter_type, logging to
+        # eval/<sequence_name>/ if log_tracks is set.
+        if filter_type == 'kalman':
+            return MultiOnlineKalman(sequence_name, track_log=self._OpenTrackLog(sequence_name, filter_type, KALMAN_LOG_FIELDS))
+        if filter_type == 'particle':
+            return MultiOnlineParticleFilter(sequence_name, track_log=self._OpenTrackLog(sequence_name, filter_type, PARTICLE_LOG_FIELDS))
+        raise ValueError("Unknown filter type '{}', expected 'kalman' or 'particle'".format(filter_type))
 
-        frame_data = {'tracked_objects': [], 'image_l': rgb_image, 'image_depth': stereoPrediction.depth_img, 'point_cloud': stereoPrediction.point_cloud}
+    def _TrackDetections(self, sequence_name, rgb_image, yolo_prediction, stereoPrediction, filter_type='kalman', add_old_detections=True, filter_high_confidence_only=False, timestamp=None, tracker=None):
+        # Feed one frame's detections and 3D positions through the tracker and
+        # build the frame_data dict. Must be called in frame order. timestamp
+        # (seconds) lets the tracker account for skipped frames.
+        # By default self.filt tracks one sequence at a time. Pass a tracker
+        # from NewTracker to track several streams side by side.
+        instrumentation.Count('detections', len(yolo_prediction))
+        frame_data = {'tracked_objects': [], 'image_l': rgb_image, 'image_depth': stereoPrediction.depth_img}
+        if self.artifacts == 'full':
+            frame_data['point_cloud'] = stereoPrediction.point_cloud
 
         raw_object_3d_positions = []
         raw_confidences = []
@@ -60,14 +179,13 @@ class NetworkModel:
                 high_confidence_indexes.append(index)
             index += 1
 
-        if filter_type == 'kalman':
-            if self.filt is None or self.filt.sequence_name != sequence_name:
-                self.filt = MultiOnlineKalman(sequence_name)
-            filtered_object_3d_positions, confidences = self.filt.take_multiple_observations(raw_object_3d_positions, raw_confidences)
-        elif filter_type == 'particle':
-            if self.filt is None or self.filt.sequence_name != sequence_name:
-                self.filt = MultiOnlineParticleFilter(sequence_name)
-            filtered_object_3d_positions, confidences = self.filt.take_multiple_observations(raw_object_3d_positions, raw_confidences)
+        if filter_type is not None:
+            if tracker is None:
+                if self.filt is None or self.filt.sequence_name != sequence_name:
+                    self._CloseTrackLog()
+                    self.filt = self.NewTracker(sequence_name, filter_type)
+                tracker = self.filt
+            filtered_object_3d_positions, confidences = tracker.take_multiple_observations(raw_object_3d_positions, raw_confidences, timestamp)
 
         index = 0
         filtered_positions_index = 0
@@ -110,35 +228,229 @@ class NetworkModel:
         return frame_data
 
 
-    def PredictSequence(self, sequence_name = '0010', visualize=False):
+    def PredictStream(self, source, filter_type='kalman', queue_size=2, drop_policy=None):
+        # Generator yielding frame_data for every frame of a
+        # framesource.FrameSource as soon as it is ready, e.g. from a live
+        # camera or a video file. frame_data also holds the frame's
+        # 'frame_name' and 'timestamp'.
+        # Frames are read on a background thread into a queue of queue_size.
+        # drop_policy (see pipeline.StreamReader) decides what happens when
+        # we fall behind; by default recorded sources block and live ones drop
+        # their oldest frames. Timestamps go to the tracker, so tracks are
+        # predicted across dropped frames. Per-stage timings and the number
+        # of dropped frames end up in self.stream_stats.
+        # Every stream starts with a fresh tracker, even if an earlier stream
+        # had the same name, and leaves self.filt alone.
+        if drop_policy is None:
+            drop_policy = 'drop_oldest' if source.live else 'block'
+        stats = instrumentation.Active() or PipelineStats()
+        self.stream_stats = stats
+        frame_queue = queue.Queue(maxsize=queue_size)
+        tracker = self.NewTracker(source.name, filter_type) if filter_type is not None else None
+        reader = StreamReader(source, frame_queue, stats, drop_policy)
+        reader.start()
+        try:
+            while True:
+                with stats.Time('read_wait'):
+                    frame = frame_queue.get()
+                if frame is END_OF_STREAM:
+                    break
+                if isinstance(frame, Exception):
+                    raise frame
+
+                with instrumentation.Frame(frame.name):
+                    rgb_image = cv2.cvtColor(frame.image_l, cv2.COLOR_BGR2RGB)
+                    with stats.Time('detect'):
+                        yolo_prediction = self.tfnet.return_predict(rgb_image)
+                    with stats.Time('stereo'):
+                        stereoPrediction = Convert3D(frame.image_l, frame.image_r, yolo_prediction, roi=self.roi_stereo,
+                                                     fields=('positions_3D',), preset=self.stereo_preset)
+                    with stats.Time('track'):
+                        frame_data = self._TrackDetections(source.name, rgb_image, yolo_prediction, stereoPrediction, filter_type,
+                                                           timestamp=frame.timestamp, tracker=tracker)
+                frame_data['frame_name'] = frame.name
+                frame_data['timestamp'] = frame.timestamp
+                stats.Count('frames')
+                yield frame_data
+        finally:
+            reader.Stop()
+            source.Close()
+            if tracker is not None and tracker.track_log is not None:
+                tracker.track_log.Close()
+
+    def _OpenTrackLog(self, sequence_name, filter_type, fields):
+        if not self.log_tracks:
+            return None
+        directory = os.path.join(self.vd_directory, 'eval', sequence_name)
+        os.makedirs(directory, exist_ok=True)
+        return TrackLog(os.path.join(directory, 'tracks_' + filter_type + '.log'), fields)
+
+    def _CloseTrackLog(self):
+        if self.filt is not None and self.filt.track_log is not None:
+            self.filt.track_log.Close()
+
+    def PredictSequence(self, sequence_name = '0010', visualize=False, show_progress=True, pipeline=False, prefetch=4, stereo_workers=2):
+        # With pipeline=True, image decode, stereo disparity and pickling run
+        # on background threads alongside the detector. See _PredictSequencePipelined.
+        # Otherwise frames go through the detector self.batch_size at a time.
+        if pipeline:
+            return self._PredictSequencePipelined(sequence_name, visualize, show_progress, prefetch, stereo_workers)
+
         directory_l = os.path.join(self.vd_directory, "data/KITTI-tracking/training/image_02/", sequence_name)
         directory_r = os.path.join(self.vd_directory, "data/KITTI-tracking/training/image_03/", sequence_name)
 
-        out_directory = os.path.join(self.vd_directory, 'eval', sequence_name, 'predictions')
-        os.makedirs(out_directory, exist_ok=True)
+        sink = OpenFrameSink(os.path.join(self.vd_directory, 'eval', sequence_name, 'predictions'), self.output_format, self.artifacts)
         # Iterate over images
 
-        _, ax = plt.subplots(figsize=(20, 10))
+        if visualize:
+            _, ax = plt.subplots(figsize=(20, 10))
         im = None
 
-        for i, filename in enumerate(sorted(os.listdir(directory_l))):
-            if filename.endswith('.png'):
-                print("Sequence: ", sequence_name, "  ", i, "/", len(os.listdir(directory_l)), end='\r', flush=True)
-                frame_data = self.PredictFrame(sequence_name, filename)
-                out_file_name = os.path.join(out_directory, os.path.splitext(filename)[0])
+        filenames = [filename for filename in sorted(os.listdir(directory_l)) if filename.endswith('.png')]
+        batch_size = max(1, self.batch_size)
 
-                if visualize:
-                    img = visualization2d.Draw2DBoxes(frame_data)
-                    if not im:
-                        im = ax.imshow(img)
+        try:
+            for batch_start in range(0, len(filenames), batch_size):
+                batch_filenames = filenames[batch_start:batch_start + batch_size]
+                if show_progress:
+                    print("Sequence: ", sequence_name, "  ", batch_start, "/", len(filenames), end='\r', flush=True)
+                with instrumentation.Frame(os.path.splitext(batch_filenames[0])[0], len(batch_filenames)):
+                    if batch_size == 1:
+                        batch_frames = [self.PredictFrame(sequence_name, batch_filenames[0])]
                     else:
-                        im.set_data(img)
-                    plt.pause(0.01)
-                    plt.draw()
+                        batch_frames = self.PredictBatch(sequence_name, batch_filenames)
+
+                    for filename, frame_data in zip(batch_filenames, batch_frames):
+                        if visualize:
+                            im = self._ShowFrame(ax, im, frame_data)
+
+                        with instrumentation.Time('write'):
+                            sink.Write(os.path.splitext(filename)[0], frame_data)
+        except BaseException:
+            sink.Abort()
+            raise
+        sink.Close()
+        if self.filt is not None and self.filt.track_log is not None:
+            self.filt.track_log.Flush()
+        if visualize:
+            plt.close()
+
+    def _ShowFrame(self, ax, im, frame_data):
+        img = visualization2d.Draw2DBoxes(frame_data)
+        if not im:
+            im = ax.imshow(img)
+        else:
+            im.set_data(img)
+        plt.pause(0.01)
+        plt.draw()
+        return im
+
+    def _PredictSequencePipelined(self, sequence_name, visualize=False, show_progress=True, prefetch=4, stereo_workers=2):
+        # A reader thread decodes up to `prefetch` stereo pairs ahead. Disparity
+        # for up to `stereo_workers` frames runs in a thread pool (OpenCV
+        # releases the GIL) while the detector runs on this thread. Frames are
+        # handed to the tracker strictly in order and written by a writer
+        # thread. Per-stage timings and queue depths end up in self.pipeline_stats.
+        # ROI stereo needs the boxes first, so with roi_stereo it runs inline
+        # after the detector instead of ahead of it.
+        directory_l = os.path.join(self.vd_directory, "data/KITTI-tracking/training/image_02/", sequence_name)
+        directory_r = os.path.join(self.vd_directory, "data/KITTI-tracking/training/image_03/", sequence_name)
+
+        sink = OpenFrameSink(os.path.join(self.vd_directory, 'eval', sequence_name, 'predictions'), self.output_format, self.artifacts)
+
+        filenames = [filename for filename in sorted(os.listdir(directory_l)) if filename.endswith('.png')]
+        frames = [(filename, os.path.join(directory_l, filename), os.path.join(directory_r, filename)) for filename in filenames]
+
+        # Shares the instrumentation recorder if there is one.
+        stats = instrumentation.Active() or PipelineStats()
+        self.pipeline_stats = stats
+        read_queue = queue.Queue(maxsize=prefetch)
+        write_queue = queue.Queue(maxsize=prefetch)
+        reader = StereoReader(frames, read_queue, stats)
+        writer = FrameWriter(write_queue, sink, stats)
+
+        stereo_fields = ('depth_img', 'point_cloud') if self.artifacts == 'full' else ('depth_img',)
+
+        def stereo_task(frame_name, bgr_l, bgr_r):
+            # Convert3D is lazy; make the pool thread do the expensive part.
+            with instrumentation.Label(frame_name), stats.Time('stereo'):
+                return Convert3D(bgr_l, bgr_r, fields=stereo_fields, preset=self.stereo_preset)
+
+        if visualize:
+            _, ax = plt.subplots(figsize=(20, 10))
+        im = None
+
+        reader.start()
+        writer.start()
+        pending = collections.deque()
+        read_done = False
+        i = 0
+        try:
+            with ThreadPoolExecutor(max_workers=stereo_workers) as stereo_pool:
+                while True:
+                    # Keep the stereo pool busy with the frames after this one.
+                    while not read_done and len(pending) <= stereo_workers:
+                        stats.SampleQueue('read', read_queue.qsize(), prefetch)
+                        with stats.Time('read_wait'):
+                            item = read_queue.get()
+                        if item is END_OF_STREAM:
+                            read_done = True
+                        elif isinstance(item, Exception):
+                            raise item
+                        else:
+                            filename, bgr_l, bgr_r = item
+                            stereo_future = None if self.roi_stereo else stereo_pool.submit(stereo_task, os.path.splitext(filename)[0], bgr_l, bgr_r)
+                            pending.append((filename, bgr_l, bgr_r, stereo_future))
+                    if not pending:
+                        break
+
+                    filename, bgr_l, bgr_r, stereo_future = pending.popleft()
+                    if show_progress:
+                        print("Sequence: ", sequence_name, "  ", i, "/", len(frames), end='\r', flush=True)
+
+                    with instrumentation.Frame(os.path.splitext(filename)[0]):
+                        rgb_image = cv2.cvtColor(bgr_l, cv2.COLOR_BGR2RGB)
+                        with stats.Time('detect'):
+                            yolo_prediction = self.tfnet.return_predict(rgb_image)
+                        if stereo_future is None:
+                            with stats.Time('stereo'):
+                                stereoPrediction = Convert3D(bgr_l, bgr_r, yolo_prediction, roi=True, preset=self.stereo_preset)
+                        else:
+                            with stats.Time('stereo_wait'):
+                                stereoPrediction = stereo_future.result()
+                            with stats.Time('positions'):
+                                stereoPrediction.SetPrediction(yolo_prediction)
+                        with stats.Time('track'):
+                            frame_data = self._TrackDetections(sequence_name, rgb_image, yolo_prediction, stereoPrediction)
+
+                        if visualize:
+                            im = self._ShowFrame(ax, im, frame_data)
+
+                        stats.SampleQueue('write', write_queue.qsize(), prefetch)
+                        with stats.Time('write_wait'):
+                            write_queue.put((os.path.splitext(filename)[0], frame_data))
+                    i += 1
+        except BaseException:
+            reader.Stop()
+            write_queue.put(END_OF_STREAM)
+            writer.join()
+            sink.Abort()
+            raise
+        finally:
+            if visualize:
+                plt.close()
 
-                with open(out_file_name, 'wb+') as out_file:
-                    pickle.dump(frame_data, out_file, pickle.HIGHEST_PROTOCOL)
-        plt.close()
+        write_queue.put(END_OF_STREAM)
+        writer.join()
+        if writer.error is not None:
+            sink.Abort()
+            raise writer.error
+        sink.Close()
+        if self.filt is not None and self.filt.track_log is not None:
+            self.filt.track_log.Flush()
+        if show_progress and stats is not instrumentation.Active():
+            print()
+            print(stats)
 
 
 """
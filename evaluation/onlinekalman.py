@@ -4,90 +4,242 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import axes3d, Axes3D #<-- Note the capitalization!
 from pykalman import KalmanFilter
 import math
+import collections
+from association import Association
+import instrumentation
 
-class MultiOnlineKalman:
-    def __init__(self, sequence_name):
-        self.filter_list = []
-        self.sequence_name = sequence_name
+# Constant velocity model shared by OnlineKalman and KalmanBank. The state is
+# [x, x_dot, y, y_dot, z, z_dot] and we observe x, y and z. Like pykalman's
+# defaults, the transition and observation covariances are identity.
+TRANSITION_MATRIX = np.array([[1, 1, 0, 0, 0, 0],
+                              [0, 1, 0, 0, 0, 0],
+                              [0, 0, 1, 1, 0, 0],
+                              [0, 0, 0, 1, 0, 0],
+                              [0, 0, 0, 0, 1, 1],
+                              [0, 0, 0, 0, 0, 1]], dtype=np.float64)
+OBSERVED_STATES = [0, 2, 4]
+TRANSITION_COVARIANCE = np.eye(6)
+OBSERVATION_COVARIANCE = np.eye(3)
+INITIAL_STATE_COVARIANCE = np.diag([1., 50., 1., 50., 1., 50.])
 
-    def distance(self, pos1, pos2):
-        return math.sqrt((pos1[0]-pos2[0])**2+(pos1[1]-pos2[1])**2+(pos1[2]-pos2[2])**2)
+# Filtered states kept in memory per track. Older ones are dropped, or
+# written to a tracklog.TrackLog if one is given.
+HISTORY_DEPTH = 8
+# Fields of a Kalman track log: the state, then the covariance row by row.
+KALMAN_LOG_FIELDS = ['x', 'x_dot', 'y', 'y_dot', 'z', 'z_dot'] + ['cov_{}{}'.format(i, j) for i in range(6) for j in range(6)]
 
-    def take_multiple_observations(self, observations, detection_confidences):
 
-        taken_filter_set = set()
-        corrected_results = []
-        corrected_confidences = []
+def _TransitionMatrix(steps):
+    transition = TRANSITION_MATRIX.copy()
+    transition[OBSERVED_STATES, [1, 3, 5]] = steps
+    return transition
 
-        for idx, observation in enumerate(observations):
-            matching_filter_index = self.find_matching_filter_index(observation, taken_filter_set)
-            if matching_filter_index is None:
-                new_filter = OnlineKalman()
-                corrected_state, _ = new_filter.take_observation(observation[0], observation[1], observation[2])
 
-                new_filter.detection_confidence = detection_confidences[idx]
+class KalmanBank:
+    # All live tracks' Kalman filters in contiguous arrays: means (N,6),
+    # covariances (N,6,6), plus per-track detection confidence and miss count.
+    # Predict and Update work on any subset of tracks at once, selected by
+    # index. Storage grows by doubling and Remove compacts it, so a sequence
+    # only ever holds memory for the tracks alive at its busiest frame.
+    # Every track also gets a unique id, stable across Remove.
+    def __init__(self, capacity=16):
+        self.count = 0
+        self.next_id = 0
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._means = np.zeros((capacity, 6))
+        self._covariances = np.zeros((capacity, 6, 6))
+        self._confidences = np.zeros(capacity)
+        self._misses = np.zeros(capacity, dtype=np.int32)
 
-                self.filter_list.append(new_filter)
-                taken_filter_set.add(new_filter)
-                corrected_results.append(observation)
-                corrected_confidences.append(detection_confidences[idx])
-            else:
-                taken_filter_set.add(self.filter_list[matching_filter_index])
-                corrected_state, _ = self.filter_list[matching_filter_index].take_observation(observation[0], observation[1], observation[2])
-                self.filter_list[matching_filter_index].detection_confidence = detection_confidences[idx]
-                if False:#self.distance([corrected_state[0], corrected_state[2], corrected_state[4]], observation) > 4:
-                    corrected_results.append(observation)
-                else:
-                    corrected_results.append([corrected_state[0], corrected_state[2], corrected_state[4]])
-                corrected_confidences.append(detection_confidences[idx])
+    def __len__(self):
+        return self.count
+
+    @property
+    def ids(self):
+        return self._ids[:self.count]
 
-        #print("Percentage of filters matched: {}; {}/{}".format(len(taken_filter_set)/len(self.filter_list),len(taken_filter_set), len(self.filter_list)))
+    @property
+    def means(self):
+        return self._means[:self.count]
 
+    @property
+    def covariances(self):
+        return self._covariances[:self.count]
 
+    @property
+    def confidences(self):
+        return self._confidences[:self.count]
 
-        filters_to_remove = set()
-        for idx, filt in enumerate(self.filter_list):
-            if filt not in taken_filter_set:
-                filt.detection_confidence *= 0.3
+    @property
+    def misses(self):
+        return self._misses[:self.count]
 
-            if filt.time_since_last_update > 3:
-                filters_to_remove.add(filt)
-        for filt in filters_to_remove:
-            self.filter_list.remove(filt)
+    def Positions(self):
+        # (N,3) filtered x, y, z of every track.
+        return self.means[:, OBSERVED_STATES]
 
+    def PositionCovariances(self):
+        # (N,3,3) covariance of an observation of each track's position,
+        # H P H^T + R.
+        return self.covariances[:, OBSERVED_STATES][:, :, OBSERVED_STATES] + OBSERVATION_COVARIANCE
 
-        for idx, filt in enumerate(self.filter_list):
-            if filt not in taken_filter_set:
-                corrected_state, _ = self.filter_list[idx].take_observation(None, None, None)
-                corrected_results.append([corrected_state[0], corrected_state[2], corrected_state[4]])
-                corrected_confidences.append(filt.detection_confidence)
+    def _Reserve(self, count):
+        if count <= len(self._means):
+            return
+        capacity = max(count, 2 * len(self._means))
+        for name in ('_ids', '_means', '_covariances', '_confidences', '_misses'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
 
+    def Add(self, positions, confidences):
+        # Starts a track at each (x, y, z) with zero velocity. Returns the new
+        # tracks' indexes.
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        indexes = np.arange(self.count, self.count + len(positions))
+        self._Reserve(self.count + len(positions))
+        self.count += len(positions)
+        self.ids[indexes] = np.arange(self.next_id, self.next_id + len(positions))
+        self.next_id += len(positions)
+        self.means[indexes] = 0
+        self.means[indexes[:, None], OBSERVED_STATES] = positions
+        self.covariances[indexes] = INITIAL_STATE_COVARIANCE
+        self.confidences[indexes] = confidences
+        self.misses[indexes] = 0
+        return indexes
 
-        return corrected_results, corrected_confidences
+    def Remove(self, indexes):
+        # Drops the given tracks. The remaining tracks keep their order but
+        # move down to fill the gaps, so earlier indexes are invalidated.
+        keep = np.ones(self.count, dtype=bool)
+        keep[indexes] = False
+        kept = int(keep.sum())
+        for name in ('_ids', '_means', '_covariances', '_confidences', '_misses'):
+            array = getattr(self, name)
+            array[:kept] = array[:self.count][keep]
+        self.count = kept
 
-    def find_matching_filter_index(self, observation, taken_filter_set, distance_cap=1):
-        closest_index = None
-        closest_dist = math.inf
+    def Predict(self, indexes, steps=1):
+        # Advances the given tracks by `steps` frames, which needn't be whole
+        # when frames were dropped. Process noise grows linearly with time.
+        transition = TRANSITION_MATRIX if steps == 1 else _TransitionMatrix(steps)
+        means = self.means[indexes]
+        covariances = self.covariances[indexes]
+        self.means[indexes] = means @ transition.T
+        self.covariances[indexes] = transition @ covariances @ transition.T + TRANSITION_COVARIANCE * steps
 
-        for idx, some_filter in enumerate(self.filter_list):
-            if idx in taken_filter_set:
-                continue
-            filter_position = some_filter.get_last_position()
-            distance = math.sqrt((filter_position[0]-observation[0])**2 + (filter_position[1]-observation[1])**2 + (filter_position[2]-observation[2])**2)
-            if distance < closest_dist and distance < distance_cap:
-                closest_index = idx
-                closest_dist = distance
+    def Correct(self, indexes, observations):
+        # Folds one (x, y, z) observation into each of the given tracks.
+        observations = np.asarray(observations, dtype=np.float64).reshape(-1, 3)
+        means = self.means[indexes]
+        covariances = self.covariances[indexes]
+        # H P H^T and P H^T, with H picking the observed states.
+        innovation_covariances = covariances[:, OBSERVED_STATES][:, :, OBSERVED_STATES] + OBSERVATION_COVARIANCE
+        cross_covariances = covariances[:, :, OBSERVED_STATES]
+        gains = cross_covariances @ np.linalg.inv(innovation_covariances)
+        innovations = observations - means[:, OBSERVED_STATES]
+        self.means[indexes] = means + (gains @ innovations[:, :, None])[:, :, 0]
+        self.covariances[indexes] = covariances - gains @ cross_covariances.transpose(0, 2, 1)
 
-        #print("Closest dist: {}".format(closest_dist))
+    def Update(self, indexes, observations, steps=1):
+        # One filter step for the given tracks with an observation each, the
+        # same as pykalman's filter_update(mean, covariance, observation).
+        self.Predict(indexes, steps)
+        self.Correct(indexes, observations)
 
-        return closest_index
+
+class MultiOnlineKalman:
+    def __init__(self, sequence_name, distance_cap=1, max_misses=3, association=None, track_log=None, frame_interval=0.1):
+        self.bank = KalmanBank()
+        self.sequence_name = sequence_name
+        # Optional tracklog.TrackLog with KALMAN_LOG_FIELDS. Every live
+        # track's state is appended to it once per frame.
+        self.track_log = track_log
+        self.frame = 0
+        # Seconds per filter step; KITTI is recorded at 10 Hz. Only used when
+        # take_multiple_observations gets timestamps.
+        self.frame_interval = frame_interval
+        self.last_timestamp = None
+        # How observations are matched to tracks, see association.py.
+        self.association = association if association is not None else Association(distance_cap)
+        # Tracks are dropped once they have gone unmatched more than this
+        # many times.
+        self.max_misses = max_misses
+
+    def distance(self, pos1, pos2):
+        return math.sqrt((pos1[0]-pos2[0])**2+(pos1[1]-pos2[1])**2+(pos1[2]-pos2[2])**2)
+
+    def take_multiple_observations(self, observations, detection_confidences, timestamp=None):
+        # Returns one position and confidence per observation, in order,
+        # followed by the predicted positions of the tracks that went
+        # unmatched this frame.
+        # With timestamps (seconds), tracks are advanced by the time since
+        # the previous call instead of one frame, e.g. across dropped frames.
+        bank = self.bank
+        steps = self._Steps(timestamp)
+        observations = np.asarray(observations, dtype=np.float64).reshape(-1, 3)
+        detection_confidences = np.asarray(detection_confidences, dtype=np.float64).reshape(-1)
+
+        matches = self.match_observations(observations)
+        matched = matches >= 0
+
+        with instrumentation.Time('filter_update'):
+            bank.Update(matches[matched], observations[matched], steps)
+            bank.confidences[matches[matched]] = detection_confidences[matched]
+            corrected_results = observations.copy()
+            corrected_results[matched] = bank.Positions()[matches[matched]]
+
+            taken = np.zeros(len(bank), dtype=bool)
+            taken[matches[matched]] = True
+            new_tracks = bank.Add(observations[~matched], detection_confidences[~matched])
+            taken = np.concatenate([taken, np.ones(len(new_tracks), dtype=bool)])
+
+            # Unmatched tracks fade and coast on their velocity until they
+            # have missed too many frames.
+            bank.confidences[~taken] *= 0.3
+            stale = bank.misses > self.max_misses
+            bank.Remove(np.flatnonzero(stale))
+            unmatched = np.flatnonzero(~taken[~stale])
+            bank.Predict(unmatched, steps)
+            bank.misses[unmatched] += 1
+        instrumentation.Count('births', len(new_tracks))
+        instrumentation.Count('deaths', int(stale.sum()))
+        instrumentation.Gauge('live_tracks', len(bank))
+
+        corrected_results = np.concatenate([corrected_results, bank.Positions()[unmatched]])
+        corrected_confidences = np.concatenate([detection_confidences, bank.confidences[unmatched]])
+        if self.track_log is not None:
+            self.track_log.AppendMany(bank.ids, self.frame, np.hstack([bank.means, bank.covariances.reshape(-1, 36)]))
+        self.frame += 1
+        return corrected_results.tolist(), corrected_confidences.tolist()
+
+    def _Steps(self, timestamp):
+        # Filter steps since the previous frame.
+        steps = 1
+        if timestamp is not None and self.last_timestamp is not None and timestamp > self.last_timestamp:
+            steps = (timestamp - self.last_timestamp) / self.frame_interval
+        if timestamp is not None:
+            self.last_timestamp = timestamp
+        return steps
+
+    def match_observations(self, observations):
+        # Track index per observation, or -1 for a new track.
+        covariances = self.bank.PositionCovariances() if self.association.metric == 'mahalanobis' else None
+        return self.association.match(observations, self.bank.Positions(), covariances)
 
 class OnlineKalman:
-    def __init__(self):
+    def __init__(self, history_depth=HISTORY_DEPTH, track_log=None):
         self.kalman_filter = None
         self.detection_confidence = None
-        self.filtered_state_means = []
-        self.filtered_state_covariances = []
+        # Ring buffers of the latest history_depth states. Only the newest is
+        # needed to filter; give a tracklog.TrackLog (KALMAN_LOG_FIELDS) to
+        # keep them all on disk.
+        self.filtered_state_means = collections.deque(maxlen=history_depth)
+        self.filtered_state_covariances = collections.deque(maxlen=history_depth)
+        self.track_log = track_log
+        self.track_id = track_log.NewTrackId() if track_log is not None else None
+        self.steps = 0
         self.time_since_last_update = 0
         # Encode the model:
         # x(k) = x(k-1) + dt*x_dot(k-1)
@@ -123,6 +275,13 @@ class OnlineKalman:
         last_state = self.filtered_state_means[-1]
         return (last_state[0], last_state[2], last_state[4])
 
+    def _record(self, mean, covariance):
+        self.filtered_state_means.append(mean)
+        self.filtered_state_covariances.append(covariance)
+        if self.track_log is not None:
+            self.track_log.Append(self.track_id, self.steps, np.concatenate([np.ravel(mean), np.ravel(covariance)]))
+        self.steps += 1
+
     def take_observation(self, x, y, z):
         if self.kalman_filter is None:
             initial_state_mean = [x, 0, y, 0, z, 0]
@@ -133,8 +292,7 @@ class OnlineKalman:
                                                 initial_state_covariance = self.initial_state_covariance
                                                 #transition_covariance = self.Q
                                                 )
-            self.filtered_state_means.append(initial_state_mean)
-            self.filtered_state_covariances.append(self.initial_state_covariance)
+            self._record(initial_state_mean, self.initial_state_covariance)
             return (initial_state_mean, self.initial_state_covariance)
         else:
             if x is not None and y is not None and z is not None:
@@ -152,6 +310,5 @@ class OnlineKalman:
                     self.filtered_state_covariances[-1])
                 )
                 #print("Got here {}".format(self.get_last_position()))
-            self.filtered_state_means.append(new_mean.tolist())
-            self.filtered_state_covariances.append(new_cov)
+            self._record(new_mean.tolist(), new_cov)
             return (new_mean.tolist(), new_cov)
@@ -1,13 +1,19 @@
 import numpy as np
-from scipy.stats import multivariate_normal
-import random
-from typing import List, Any
 from statistics import mean
 import math
+import collections
+from association import Association
+import instrumentation
+
+# Filtered positions kept in memory per ParticleFilter; must cover the
+# frames average_recent_velocity looks at. Older ones are dropped, or written
+# to a tracklog.TrackLog if one is given.
+HISTORY_DEPTH = 8
+PARTICLE_LOG_FIELDS = ['x', 'y', 'z']
 
 
 class MultiOnlineParticleFilter:
-    def __init__(self, sequence_name):
+    def __init__(self, sequence_name, association=None, seed=None, track_log=None, frame_interval=0.1):
 
         # Tunables
         self.num_frames_to_keep_stale_filters = 3
@@ -15,139 +21,365 @@ class MultiOnlineParticleFilter:
         self.num_particles = 100
         self.initial_particle_radius=1
         self.gaussian_stdev=9
+        self.resampling='systematic'
         # End of tunables
-        self.filter_list = []
+        self.bank = ParticleBank(num_particles=self.num_particles, initial_particle_radius=self.initial_particle_radius,
+                                 gaussian_stdev=self.gaussian_stdev, resampling=self.resampling, seed=seed)
         self.sequence_name = sequence_name
-        
+        # How observations are matched to filters, see association.py.
+        self.association = association if association is not None else Association(self.filter_match_distance_cap)
+        # Optional tracklog.TrackLog with PARTICLE_LOG_FIELDS. Every live
+        # track's position is appended to it once per frame.
+        self.track_log = track_log
+        self.frame = 0
+        # Seconds per filter step; KITTI is recorded at 10 Hz. Only used when
+        # take_multiple_observations gets timestamps.
+        self.frame_interval = frame_interval
+        self.last_timestamp = None
+
 
     def distance(self, pos1, pos2):
         return math.sqrt((pos1[0]-pos2[0])**2+(pos1[1]-pos2[1])**2+(pos1[2]-pos2[2])**2)
 
-    def take_multiple_observations(self, observations, detection_confidences):
-
-        taken_filter_set = set()
-        corrected_results = []
-        corrected_confidences = []
-
-        for idx, observation in enumerate(observations):
-            matching_filter_index = self.find_matching_filter_index(observation, taken_filter_set)
-            if matching_filter_index is None:
-                print("Found no matching filter for {}".format(observation))
-                new_filter = ParticleFilter(num_particles=self.num_particles, initial_particle_radius=self.initial_particle_radius, gaussian_stdev=self.gaussian_stdev)
-                corrected_state = new_filter.take_observation(observation[0], observation[1], observation[2])
-
-                new_filter.detection_confidence = detection_confidences[idx]
-
-                self.filter_list.append(new_filter)
-                taken_filter_set.add(new_filter)
-
-                if not None in list(observation):
-                    corrected_results.append(list(observation))
-                    corrected_confidences.append(detection_confidences[idx])
-            else:
-                taken_filter_set.add(self.filter_list[matching_filter_index])
-                corrected_state = self.filter_list[matching_filter_index].take_observation(observation[0], observation[1], observation[2])
-                self.filter_list[matching_filter_index].detection_confidence = detection_confidences[idx]
-                if False and not None in list(observation):#self.distance([corrected_state[0], corrected_state[2], corrected_state[4]], observation) > 4:
-                    corrected_results.append(list(observation))
-                    corrected_confidences.append(detection_confidences[idx])
-                elif not None in list(corrected_state):
-                    corrected_results.append(list(corrected_state))
-                    corrected_confidences.append(detection_confidences[idx])
-                
-
-        #print("Percentage of filters matched: {}; {}/{}".format(len(taken_filter_set)/len(self.filter_list),len(taken_filter_set), len(self.filter_list)))
-
-
-
-        filters_to_remove = set()
-        for idx, filt in enumerate(self.filter_list):
-            if filt not in taken_filter_set:
-                filt.detection_confidence -= 0.00
-                if filt.detection_confidence < 0:
-                    filt.detection_confidence = 0
-                    filters_to_remove.add(filt)
-
-            if filt.time_since_last_update > self.num_frames_to_keep_stale_filters:
-                filters_to_remove.add(filt)
-        for filt in filters_to_remove:
-            self.filter_list.remove(filt)
-
-
-        for idx, filt in enumerate(self.filter_list):
-            if filt not in taken_filter_set:
-                corrected_state = self.filter_list[idx].take_observation(None, None, None)
-                if not None in list(corrected_state):
-                    corrected_results.append(list(corrected_state))
-                    corrected_confidences.append(0.01)
-
-
-        return corrected_results, corrected_confidences
-
-    def find_matching_filter_index(self, observation, taken_filter_set):
-        distance_cap = self.filter_match_distance_cap
-        closest_index = None
-        closest_dist = math.inf
-
-        for idx, some_filter in enumerate(self.filter_list):
-            if idx in taken_filter_set:
-                continue
-            filter_position = some_filter.get_last_position()
-            distance = math.sqrt((filter_position[0]-observation[0])**2 + (filter_position[1]-observation[1])**2 + (filter_position[2]-observation[2])**2)
-            if distance < closest_dist and distance < distance_cap:
-                closest_index = idx
-                closest_dist = distance
-
-        #print("Closest dist: {}".format(closest_dist))
-
-        return closest_index
-
-
-def weighted_sample(choices: List[Any], probs: List[float]):
+    def take_multiple_observations(self, observations, detection_confidences, timestamp=None):
+        # Returns one position and confidence per observation, in order,
+        # followed by the predicted positions of the tracks that went
+        # unmatched this frame and have particles.
+        # With timestamps (seconds), motion covers the time since the
+        # previous call instead of one frame, e.g. across dropped frames.
+        bank = self.bank
+        steps = 1
+        if timestamp is not None and self.last_timestamp is not None and timestamp > self.last_timestamp:
+            steps = (timestamp - self.last_timestamp) / self.frame_interval
+        if timestamp is not None:
+            self.last_timestamp = timestamp
+        observations = np.array(observations, dtype=np.float64).reshape(-1, 3)
+        detection_confidences = np.asarray(detection_confidences, dtype=np.float64).reshape(-1)
+
+        matches = self.match_observations(observations)
+        matched = matches >= 0
+
+        with instrumentation.Time('filter_update'):
+            corrected_results = observations.copy()
+            corrected_results[matched] = bank.Step(matches[matched], observations[matched], steps)
+            bank.confidences[matches[matched]] = detection_confidences[matched]
+
+            taken = np.zeros(len(bank), dtype=bool)
+            taken[matches[matched]] = True
+            new_tracks = bank.Add(observations[~matched], detection_confidences[~matched])
+            taken = np.concatenate([taken, np.ones(len(new_tracks), dtype=bool)])
+
+            stale = bank.misses > self.num_frames_to_keep_stale_filters
+            bank.Remove(np.flatnonzero(stale))
+            unmatched = np.flatnonzero(~taken[~stale])
+            predicted = bank.Step(unmatched, np.full((len(unmatched), 3), np.nan), steps)
+            predicted = predicted[np.all(np.isfinite(predicted), axis=1)]
+        instrumentation.Count('births', len(new_tracks))
+        instrumentation.Count('deaths', int(stale.sum()))
+        instrumentation.Gauge('live_tracks', len(bank))
+
+        corrected_results = np.concatenate([corrected_results, predicted])
+        corrected_confidences = np.concatenate([detection_confidences, np.full(len(predicted), 0.01)])
+        if self.track_log is not None:
+            self.track_log.AppendMany(bank.ids, self.frame, bank.Positions())
+        self.frame += 1
+        return corrected_results.tolist(), corrected_confidences.tolist()
+
+    def match_observations(self, observations):
+        # Track index per observation, or -1 for a new track.
+        covariances = self.track_covariances() if self.association.metric == 'mahalanobis' else None
+        return self.association.match(observations, self.bank.Positions(), covariances)
+
+    def track_covariances(self):
+        # Spread of each track's particles plus the observation noise.
+        return self.bank.ParticleCovariances() + np.eye(3) * self.gaussian_stdev**2
+
+
+class ParticleBank:
+    # ParticleFilter for many tracks at once. All particles live in one
+    # (tracks, num_particles, 3) array, and motion, weighting and resampling
+    # for every stepped track are single array operations. Each track also
+    # keeps its last num_recent_frames + 1 filtered positions, newest last,
+    # and the time (in frames, on the track's own clock) each was taken,
+    # which is all the velocity estimate needs.
+    # A track steps through the same phases as ParticleFilter: it starts from
+    # one position, scatters particles at its second observation, and from
+    # then on is a particle filter. Storage grows by doubling and Remove
+    # compacts it.
+    def __init__(self, num_particles=100, initial_particle_radius=1, gaussian_stdev=9, resampling='systematic',
+                 num_recent_frames=3, seed=None, capacity=16):
+        self.num_particles = num_particles
+        self.initial_particle_radius = initial_particle_radius
+        self.gaussian_stdev = gaussian_stdev
+        self.resampling = resampling
+        self.num_recent_frames = num_recent_frames
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        self.next_id = 0
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._particles = np.zeros((capacity, num_particles, 3))
+        self._has_particles = np.zeros(capacity, dtype=bool)
+        self._history = np.full((capacity, num_recent_frames + 1, 3), np.nan)
+        self._history_count = np.zeros(capacity, dtype=np.int64)
+        self._history_times = np.zeros((capacity, num_recent_frames + 1))
+        self._clocks = np.zeros(capacity)
+        self._confidences = np.zeros(capacity)
+        self._misses = np.zeros(capacity, dtype=np.int32)
+
+    _ARRAYS = ('_ids', '_particles', '_has_particles', '_history', '_history_count', '_history_times', '_clocks', '_confidences', '_misses')
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def ids(self):
+        # Unique per track, stable across Remove.
+        return self._ids[:self.count]
+
+    @property
+    def particles(self):
+        return self._particles[:self.count]
+
+    @property
+    def has_particles(self):
+        return self._has_particles[:self.count]
+
+    @property
+    def history(self):
+        return self._history[:self.count]
+
+    @property
+    def history_count(self):
+        return self._history_count[:self.count]
+
+    @property
+    def history_times(self):
+        return self._history_times[:self.count]
+
+    @property
+    def clocks(self):
+        return self._clocks[:self.count]
+
+    @property
+    def confidences(self):
+        return self._confidences[:self.count]
+
+    @property
+    def misses(self):
+        return self._misses[:self.count]
+
+    def Positions(self):
+        # (T,3) latest filtered position of every track.
+        return self.history[:, -1]
+
+    def ParticleCovariances(self):
+        # (T,3,3) sample covariance of each track's particles, zero for
+        # tracks that have none yet.
+        centered = self.particles - self.particles.mean(axis=1, keepdims=True)
+        covariances = np.einsum('tpi,tpj->tij', centered, centered) / max(self.num_particles - 1, 1)
+        covariances[~self.has_particles] = 0
+        return covariances
+
+    def _Reserve(self, count):
+        if count <= len(self._particles):
+            return
+        capacity = max(count, 2 * len(self._particles))
+        for name in self._ARRAYS:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def Add(self, positions, confidences):
+        # Starts a track at each position. Returns the new tracks' indexes.
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        indexes = np.arange(self.count, self.count + len(positions))
+        self._Reserve(self.count + len(positions))
+        self.count += len(positions)
+        self.ids[indexes] = np.arange(self.next_id, self.next_id + len(positions))
+        self.next_id += len(positions)
+        self.has_particles[indexes] = False
+        self.history_count[indexes] = 0
+        self.clocks[indexes] = 0
+        self._Push(indexes, positions)
+        self.confidences[indexes] = confidences
+        self.misses[indexes] = 0
+        return indexes
+
+    def Remove(self, indexes):
+        # Drops the given tracks. The remaining tracks keep their order but
+        # move down to fill the gaps, so earlier indexes are invalidated.
+        keep = np.ones(self.count, dtype=bool)
+        keep[indexes] = False
+        kept = int(keep.sum())
+        for name in self._ARRAYS:
+            array = getattr(self, name)
+            array[:kept] = array[:self.count][keep]
+        self.count = kept
+
+    def _Push(self, indexes, positions):
+        self.history[indexes, :-1] = self.history[indexes, 1:]
+        self.history[indexes, -1] = positions
+        self.history_times[indexes, :-1] = self.history_times[indexes, 1:]
+        self.history_times[indexes, -1] = self.clocks[indexes]
+        self.history_count[indexes] += 1
+
+    def _Scatter(self, indexes, centers):
+        # Fresh particles, uniform in a cube around each center.
+        radius = self.initial_particle_radius
+        self.particles[indexes] = centers[:, None, :] + self.rng.uniform(-radius, radius, (len(indexes), self.num_particles, 3))
+        self.has_particles[indexes] = True
+
+    def Step(self, indexes, observations, steps=1):
+        # One filter step for each of the given tracks. observations is (k,3)
+        # with a NaN row for tracks that were not observed this frame.
+        # steps is the number of frames since the last step, which needn't be
+        # whole when frames were dropped.
+        # Returns the (k,3) corrected positions, NaN where a track has no
+        # estimate yet.
+        indexes = np.asarray(indexes, dtype=np.int64)
+        observations = np.asarray(observations, dtype=np.float64).reshape(-1, 3)
+        observed = np.all(np.isfinite(observations), axis=1)
+        results = np.full((len(indexes), 3), np.nan)
+        self.misses[indexes[~observed]] += 1
+        self.clocks[indexes] += steps
+
+        # Second observation: start the particles around it.
+        starting = ~self.has_particles[indexes] & observed
+        self._Push(indexes[starting], observations[starting])
+        self._Scatter(indexes[starting], observations[starting])
+        results[starting] = observations[starting]
+
+        running = np.flatnonzero(self.has_particles[indexes] & ~starting)
+        if len(running) == 0:
+            return results
+        tracks = indexes[running]
+        track_observations = observations[running]
+        track_observed = observed[running]
+
+        # Velocity averaged over the recent positions, including this frame's
+        # observation. The mean of n consecutive differences telescopes to
+        # (newest - oldest) / (time between them). A track restarted last
+        # frame that coasts now has a single position, so no velocity.
+        history = self.history[tracks]
+        window = self.history.shape[1]
+        differences = np.minimum(self.history_count[tracks] + track_observed - 1, self.num_recent_frames)
+        oldest_index = window - differences - (~track_observed)
+        newest = np.where(track_observed[:, None], track_observations, history[:, -1])
+        oldest = history[np.arange(len(tracks)), oldest_index]
+        newest_time = np.where(track_observed, self.clocks[tracks], self.history_times[tracks, -1])
+        oldest_time = self.history_times[tracks, oldest_index]
+        elapsed = newest_time - oldest_time
+        velocities = np.where((elapsed > 0)[:, None], (newest - oldest) / np.where(elapsed > 0, elapsed, 1)[:, None], 0)
+        motion = velocities * steps
+
+        moved = self.particles[tracks] + motion[:, None, :]
+        centers = np.where(track_observed[:, None], track_observations, history[:, -1] + motion)
+        weights = isotropic_gaussian_pdf(centers[:, None, :], self.gaussian_stdev, moved)
+        weight_sums = weights.sum(axis=1)
+        resampled = weight_sums != 0
+
+        if np.any(resampled):
+            picks = resample_indexes(weights[resampled] / weight_sums[resampled, None], self.num_particles, self.resampling, self.rng)
+            particles = np.take_along_axis(moved[resampled], picks[:, :, None], axis=1)
+            self.particles[tracks[resampled]] = particles
+            positions = particles.mean(axis=1)
+            self._Push(tracks[resampled], positions)
+            results[running[resampled]] = positions
+
+        # The observation is really far away from all the particles. Start
+        # over around it.
+        restart = ~resampled & track_observed
+        self.history_count[tracks[restart]] = 0
+        self.clocks[tracks[restart]] = 0
+        self._Push(tracks[restart], track_observations[restart])
+        self._Scatter(tracks[restart], track_observations[restart])
+        results[running[restart]] = track_observations[restart]
+
+        # Coasting tracks whose weights all underflowed just drift.
+        drifting = ~resampled & ~track_observed
+        self.particles[tracks[drifting]] = moved[drifting]
+        results[running[drifting]] = moved[drifting].mean(axis=1)
+        return results
+
+
+RESAMPLING_METHODS = ['systematic', 'stratified', 'multinomial']
+
+def resample_indexes(weights, count, method='systematic', rng=np.random):
     """
-    Sample from `choices` with probability according to `probs`
+    Draw `count` indexes into `weights` (normalized) with probability
+    proportional to the weights. Systematic and stratified resampling use one
+    draw per stratum of the cumulative weights, which has lower variance than
+    independent multinomial draws. All three are O(N log N) via searchsorted.
+    weights may also be (T,N), one distribution per row, giving (T,count)
+    indexes from a single searchsorted.
     """
-    probs = np.concatenate(([0], np.cumsum(probs)))
-    r = random.random()
-    for j in range(len(choices) + 1):
-        if probs[j] < r <= probs[j + 1]:
-            return choices[j]
-
-def get_3d_gaussian_pdf(mean_xyz, sig, test_xyz):
-
-
-    mu = np.array(mean_xyz)
-
-    sigma = np.array([sig, sig, sig])
-    covariance = np.diag(sigma**2)
-
-    z = multivariate_normal.pdf([test_xyz], mean=mu, cov=covariance)
-    return z
+    weights = np.asarray(weights)
+    rows = weights.reshape(-1, weights.shape[-1])
+    num_rows, num_weights = rows.shape
+    cumulative = np.cumsum(rows, axis=1)
+    cumulative[:, -1] = 1.0 # Guard against rounding leaving the last bin short.
+    if method == 'systematic':
+        positions = (rng.random((num_rows, 1)) + np.arange(count)) / count
+    elif method == 'stratified':
+        positions = (rng.random((num_rows, count)) + np.arange(count)) / count
+    elif method == 'multinomial':
+        positions = rng.random((num_rows, count))
+    else:
+        raise ValueError("Unknown resampling method '{}', expected one of {}".format(method, RESAMPLING_METHODS))
+    # Offsetting row i by i keeps the flattened rows sorted.
+    offsets = np.arange(num_rows)[:, None]
+    indexes = np.searchsorted((cumulative + offsets).ravel(), (positions + offsets).ravel(), side='right')
+    indexes = (indexes.reshape(num_rows, count) - offsets * num_weights).clip(0, num_weights - 1)
+    return indexes.reshape(weights.shape[:-1] + (count,))
+
+def isotropic_gaussian_pdf(mean_xyz, sig, test_xyz):
+    """
+    Density of N(mean_xyz, sig^2 I) at every row of test_xyz (N,3).
+    """
+    squared_distances = np.sum((np.asarray(test_xyz) - np.asarray(mean_xyz))**2, axis=-1)
+    return np.exp(-0.5 * squared_distances / sig**2) / (2 * np.pi * sig**2)**1.5
 
 class ParticleFilter:
-    def __init__(self, num_particles=100, initial_particle_radius=1, gaussian_stdev=9):
-        self.filtered_positions = []
-        self.particle_locations = []
-        self.particle_weights = []
+    def __init__(self, num_particles=100, initial_particle_radius=1, gaussian_stdev=9, resampling='systematic', seed=None,
+                 history_depth=HISTORY_DEPTH, track_log=None, num_recent_frames=3):
+        if history_depth < num_recent_frames + 1:
+            raise ValueError("history_depth must be at least num_recent_frames + 1 = {}".format(num_recent_frames + 1))
+        # Ring buffer of the latest history_depth positions. Give a
+        # tracklog.TrackLog (PARTICLE_LOG_FIELDS) to keep them all on disk.
+        self.filtered_positions = collections.deque(maxlen=history_depth)
+        self.num_recent_frames = num_recent_frames
+        self.track_log = track_log
+        self.track_id = track_log.NewTrackId() if track_log is not None else None
+        self.steps = 0
+        # (num_particles, 3) positions and their weights. Empty until the
+        # filter has seen two observations.
+        self.particle_locations = np.zeros((0, 3))
+        self.particle_weights = np.zeros(0)
         self.initial_particle_radius = initial_particle_radius
         self.time_since_last_update = 0
         self.detection_confidence = None
         self.num_particles = num_particles
         self.gaussian_stdev = gaussian_stdev
+        self.resampling = resampling
+        self.rng = np.random.default_rng(seed)
 
     def generate_random_particles(self, center_xyz, radius):
-        for _ in range(self.num_particles):
-            x_pos = random.uniform(center_xyz[0]-radius, center_xyz[0]+radius)
-            y_pos = random.uniform(center_xyz[1]-radius, center_xyz[1]+radius)
-            z_pos = random.uniform(center_xyz[2]-radius, center_xyz[2]+radius)
-            self.particle_locations.append([x_pos, y_pos, z_pos])
-            self.particle_weights.append(1.0/self.num_particles)
+        # Uniform in the cube of half-width radius around center_xyz.
+        self.particle_locations = np.asarray(center_xyz, dtype=np.float64) + self.rng.uniform(-radius, radius, (self.num_particles, 3))
+        self.particle_weights = np.full(self.num_particles, 1.0/self.num_particles)
 
     def get_last_position(self):
         if len(self.filtered_positions) == 0:
             return None
         return self.filtered_positions[-1]
 
+    def _record(self, position):
+        self.filtered_positions.append(position)
+        if self.track_log is not None:
+            self.track_log.Append(self.track_id, self.steps, position)
+        self.steps += 1
+
     def average_recent_velocity(self, velocity_list, num_recent_frames=3):
         if len(velocity_list) == 0 or len(velocity_list) == 1:
             return [0, 0, 0]
@@ -176,65 +408,43 @@ class ParticleFilter:
             return [x,y,z]
 
         if len(self.filtered_positions) == 1:
-            self.filtered_positions.append([x, y, z])
+            self._record([x, y, z])
             self.generate_random_particles([x, y, z], self.initial_particle_radius)
             return [x, y, z]
         elif len(self.filtered_positions) == 0:
-            self.filtered_positions.append([x, y, z])
+            self._record([x, y, z])
             return [x, y, z]
         
         # Move all of the particles based on velocity
-        new_particles = []
-        new_weights = []
-
         prev_location = self.get_last_position()
+        # Only the last num_recent_frames + 1 positions matter for velocity.
+        location_history = list(self.filtered_positions)[-(self.num_recent_frames + 1):]
         if x is not None and y is not None and z is not None:
-            location_history = self.filtered_positions+[[x,y,z]]
+            location_history.append([x, y, z])
         else:
-            location_history = self.filtered_positions
             self.time_since_last_update += 1
-        velocity = self.average_recent_velocity(location_history)
-        for prev_particle in self.particle_locations:
-            particle_new_location = [prev_particle[0]+velocity[0], prev_particle[1]+velocity[1], prev_particle[2]+velocity[2]]
-            new_particles.append(particle_new_location)
-            if x is not None and y is not None and z is not None:
-                new_weights.append(get_3d_gaussian_pdf([x, y, z], self.gaussian_stdev, particle_new_location))
-            else:
-                new_weights.append(get_3d_gaussian_pdf([prev_location[0]+velocity[0], prev_location[1]+velocity[1], prev_location[2]+velocity[2]], self.gaussian_stdev, particle_new_location))
-
-
-        if sum(new_weights) != 0:
-            new_weights_norm = [float(i)/sum(new_weights) for i in new_weights]
+        velocity = np.array(self.average_recent_velocity(location_history, self.num_recent_frames))
+        new_particles = self.particle_locations + velocity
+        if x is not None and y is not None and z is not None:
+            new_weights = isotropic_gaussian_pdf([x, y, z], self.gaussian_stdev, new_particles)
+        else:
+            new_weights = isotropic_gaussian_pdf(np.array(prev_location) + velocity, self.gaussian_stdev, new_particles)
 
-            # Sample from new_particles according to new_weights_norm
-            self.particle_locations = []
-            self.particle_weights = []
-            for _ in range(self.num_particles):
-                self.particle_locations.append(weighted_sample(new_particles, new_weights_norm))
+        weight_sum = new_weights.sum()
+        if weight_sum != 0:
+            # Sample from new_particles according to the normalized weights
+            indexes = resample_indexes(new_weights / weight_sum, self.num_particles, self.resampling, self.rng)
+            self.particle_locations = new_particles[indexes]
+            self.particle_weights = np.full(self.num_particles, 1.0/self.num_particles)
 
-            particle_locations_np = np.array(self.particle_locations)
-            adjusted_position = np.mean(particle_locations_np, axis=0)
-            self.filtered_positions.append(list(adjusted_position))
+            adjusted_position = np.mean(self.particle_locations, axis=0)
+            self._record(list(adjusted_position))
 
             return adjusted_position
         else:
             # The observation is really far away from all previously observed values. We should just
             # regenerate new particles around the new observation.
-            self.particle_locations = []
-            self.particle_weights = []
-            self.filtered_positions = []
-            self.filtered_positions.append([x, y, z])
+            self.filtered_positions.clear()
+            self._record([x, y, z])
             self.generate_random_particles([x, y, z], self.initial_particle_radius)
             return [x, y, z]
-        
-
-
-        
-
-            
-
-        
-        
-        
-
-    
\ No newline at end of file
@@ -0,0 +1,212 @@
+################################################################################
+#
+# Helpers for running NetworkModel.PredictSequence as a streaming pipeline.
+# A reader thread decodes stereo pairs ahead of the detector, a thread pool
+# computes disparity while the detector runs, and a writer thread serializes
+# finished frames. StreamReader does the reading for PredictStream, where
+# frames may arrive faster than they can be processed. PipelineStats records
+# per-stage timings, queue depths and counters so we can see which stage is
+# the bottleneck.
+#
+################################################################################
+
+import threading
+import queue
+import time
+from contextlib import contextmanager
+import cv2
+
+# Marks the end of a stream on a queue.
+END_OF_STREAM = None
+# How often a reader waiting on a full queue checks whether it was stopped.
+STOP_POLL_S = 0.1
+
+class PipelineStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_times = {}
+        self.stage_counts = {}
+        self.queue_depths = {}
+        self.queue_capacities = {}
+        self.counters = {}
+
+    def AddTime(self, stage, seconds):
+        with self.lock:
+            self.stage_times[stage] = self.stage_times.get(stage, 0.0) + seconds
+            self.stage_counts[stage] = self.stage_counts.get(stage, 0) + 1
+
+    @contextmanager
+    def Time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.AddTime(stage, time.perf_counter() - start)
+
+    def Count(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def SampleQueue(self, name, depth, capacity=0):
+        with self.lock:
+            self.queue_depths.setdefault(name, []).append(depth)
+            self.queue_capacities[name] = capacity
+
+    def Summary(self):
+        with self.lock:
+            stages = {}
+            for stage, total in self.stage_times.items():
+                count = self.stage_counts[stage]
+                stages[stage] = {'count': count, 'total_s': total, 'mean_ms': 1000 * total / count}
+            queues = {}
+            for name, depths in self.queue_depths.items():
+                queues[name] = {'mean': sum(depths) / len(depths), 'max': max(depths), 'capacity': self.queue_capacities[name]}
+            counters = dict(self.counters)
+        return {'stages': stages, 'queues': queues, 'counters': counters}
+
+    def __str__(self):
+        summary = self.Summary()
+        lines = ["{:<12} {:>7} {:>10} {:>10}".format('stage', 'frames', 'total s', 'mean ms')]
+        for stage, info in sorted(summary['stages'].items(), key=lambda x: -x[1]['total_s']):
+            lines.append("{:<12} {:>7} {:>10.2f} {:>10.2f}".format(stage, info['count'], info['total_s'], info['mean_ms']))
+        lines.append("{:<12} {:>7} {:>10} {:>10}".format('queue', 'cap', 'mean', 'max'))
+        for name, info in sorted(summary['queues'].items()):
+            lines.append("{:<12} {:>7} {:>10.2f} {:>10}".format(name, info['capacity'], info['mean'], info['max']))
+        for name, count in sorted(summary['counters'].items()):
+            lines.append("{:<12} {:>7}".format(name, count))
+        return '\n'.join(lines)
+
+
+def _PutUnlessStopped(out_queue, item, stopped):
+    # Blocking put that gives up once stopped is set, so a reader never waits
+    # forever on a consumer that has gone away. Returns whether item was put.
+    while not stopped.is_set():
+        try:
+            out_queue.put(item, timeout=STOP_POLL_S)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _StopReader(reader):
+    # Stops a reader thread, unblocks it and waits for it to exit.
+    reader.stopped.set()
+    try:
+        while True:
+            reader.out_queue.get_nowait()
+    except queue.Empty:
+        pass
+    reader.join()
+
+
+class StereoReader(threading.Thread):
+    # Decodes stereo pairs ahead of the consumer. Items on out_queue are
+    # (filename, bgr_l, bgr_r), followed by END_OF_STREAM. If decoding fails
+    # the exception is put on the queue in place of END_OF_STREAM.
+    def __init__(self, frames, out_queue, stats):
+        super().__init__(daemon=True)
+        self.frames = frames
+        self.out_queue = out_queue
+        self.stats = stats
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            for filename, image_path_l, image_path_r in self.frames:
+                if self.stopped.is_set():
+                    break
+                with self.stats.Time('read'):
+                    bgr_l = cv2.imread(image_path_l)
+                    bgr_r = cv2.imread(image_path_r)
+                if not _PutUnlessStopped(self.out_queue, (filename, bgr_l, bgr_r), self.stopped):
+                    return
+            _PutUnlessStopped(self.out_queue, END_OF_STREAM, self.stopped)
+        except Exception as e:
+            _PutUnlessStopped(self.out_queue, e, self.stopped)
+
+    def Stop(self):
+        # For a consumer that bails out early. Returns once the thread is gone.
+        _StopReader(self)
+
+
+DROP_POLICIES = ['block', 'drop_oldest', 'drop_newest']
+
+class StreamReader(threading.Thread):
+    # Pulls StereoFrames from a framesource.FrameSource into out_queue,
+    # followed by END_OF_STREAM (or the exception that stopped it).
+    # drop_policy says what to do when the queue is full:
+    #   block:       wait for the consumer, which also pauses the source.
+    #   drop_oldest: discard the oldest waiting frame, so the consumer always
+    #                gets the freshest ones. For live sources.
+    #   drop_newest: discard the incoming frame.
+    # Dropped frames are counted in stats as 'dropped'.
+    def __init__(self, source, out_queue, stats, drop_policy='block'):
+        super().__init__(daemon=True)
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError("Unknown drop policy '{}', expected one of {}".format(drop_policy, DROP_POLICIES))
+        self.source = source
+        self.out_queue = out_queue
+        self.stats = stats
+        self.drop_policy = drop_policy
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            frames = iter(self.source)
+            while not self.stopped.is_set():
+                with self.stats.Time('read'):
+                    frame = next(frames, END_OF_STREAM)
+                if frame is END_OF_STREAM:
+                    break
+                self._Put(frame)
+            _PutUnlessStopped(self.out_queue, END_OF_STREAM, self.stopped)
+        except Exception as e:
+            _PutUnlessStopped(self.out_queue, e, self.stopped)
+
+    def _Put(self, frame):
+        if self.drop_policy == 'block':
+            _PutUnlessStopped(self.out_queue, frame, self.stopped)
+            return
+        while True:
+            try:
+                self.out_queue.put_nowait(frame)
+                return
+            except queue.Full:
+                pass
+            if self.drop_policy == 'drop_newest':
+                self.stats.Count('dropped')
+                return
+            try:
+                self.out_queue.get_nowait()
+                self.stats.Count('dropped')
+            except queue.Empty:
+                pass
+
+    def Stop(self):
+        _StopReader(self)
+
+
+class FrameWriter(threading.Thread):
+    # Writes (frame_name, frame_data) items from in_queue to a frame sink
+    # (see framestore.OpenFrameSink) until END_OF_STREAM. The first error is
+    # kept in self.error.
+    def __init__(self, in_queue, sink, stats):
+        super().__init__(daemon=True)
+        self.in_queue = in_queue
+        self.sink = sink
+        self.stats = stats
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.in_queue.get()
+            if item is END_OF_STREAM:
+                break
+            if self.error is not None:
+                continue
+            frame_name, frame_data = item
+            try:
+                with self.stats.Time('write'):
+                    self.sink.Write(frame_name, frame_data)
+            except Exception as e:
+                self.error = e
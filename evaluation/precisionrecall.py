@@ -1,12 +1,198 @@
 import pickle
 import numpy as np
 import os
+from framestore import OpenFrames, FrameStore, BBOX_KEYS
+from frameloader import LoadSequences, CacheKey
+from averageprecision import Envelope, Curve, TableAPs
 
 def loadFrameData(filename):
     with open(filename, 'rb') as f:
         return pickle.load(f)
 
 
+# One row per prediction: its confidence, whether it was a true positive,
+# the IOU or distance to the ground truth it was matched to, and that ground
+# truth's difficulty ('missing' if there was no ground truth left).
+# pred_type is the prediction's orientation bin (the N in 'Car_N') and
+# gt_type that of a TP's ground truth, 0 for FPs.
+TPFP_DTYPE = np.dtype([('confidence', np.float64), ('tp', np.bool_), ('metric', np.float64),
+                       ('difficulty', 'U9'), ('gt_type', np.int64), ('pred_type', np.int64)])
+
+# Pairwise metrics are computed for this many (frame, prediction, ground
+# truth) triples at a time.
+_MATCH_CHUNK = 1 << 22
+
+
+def _TypeNumber(label):
+    # 'Car_3' -> 3
+    try:
+        return int(label.split('_')[1])
+    except (IndexError, ValueError):
+        return -1
+
+def _ObjectArrays(frames_objects):
+    # Columns of the tracked objects of several frames, given as lists of
+    # tracked object dicts. Rows offsets[i]:offsets[i+1] are the i'th frame's.
+    objects = [tracked_object for tracked_objects in frames_objects for tracked_object in tracked_objects]
+    return {'offsets': np.cumsum([0] + [len(tracked_objects) for tracked_objects in frames_objects]),
+            'confidence': np.array([o.get('confidence', 0.0) for o in objects], dtype=np.float64),
+            'bbox': np.array([[o['bbox'][key] for key in BBOX_KEYS] if 'bbox' in o else [0] * 4 for o in objects],
+                             dtype=np.float64).reshape(-1, 4),
+            '3dbbox_loc': np.array([o.get('3dbbox_loc', [np.nan] * 3) for o in objects], dtype=np.float64).reshape(-1, 3),
+            'type': np.array([_TypeNumber(o.get('type', '')) for o in objects], dtype=np.int64),
+            'difficulty': np.array([o.get('difficulty', '') for o in objects], dtype=TPFP_DTYPE['difficulty'])}
+
+def FrameObjects(frames, frame_names):
+    # Same as _ObjectArrays for the given frames of a reader from
+    # framestore.OpenFrames. Stores are read column-wise without building
+    # the per-object dicts. Frames that don't exist have no objects.
+    if not isinstance(frames, FrameStore):
+        return _ObjectArrays([frames.LoadFrame(frame_name, sections=())['tracked_objects'] for frame_name in frame_names])
+
+    indexes = [frames.frame_index.get(int(frame_name)) for frame_name in frame_names]
+    starts = np.array([0 if i is None else frames.frame_offsets[i] for i in indexes], dtype=np.int64)
+    lengths = np.array([0 if i is None else frames.frame_offsets[i + 1] - frames.frame_offsets[i] for i in indexes], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    rows = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+
+    columns = frames.ColumnNames()
+    def column(name, default, width=1):
+        if name not in columns:
+            return np.full((len(rows), width) if width > 1 else len(rows), default)
+        return np.asarray(frames.Column(name)[rows])
+
+    labels = frames.labels + ['']
+    label_types = np.array([_TypeNumber(label) for label in labels], dtype=np.int64)
+    label_names = np.array(labels, dtype=TPFP_DTYPE['difficulty'])
+    return {'offsets': offsets,
+            'confidence': column('confidence', 0.0).astype(np.float64),
+            'bbox': column('bbox', 0, 4).astype(np.float64),
+            '3dbbox_loc': column('3dbbox_loc', np.nan, 3).astype(np.float64),
+            'type': label_types[column('type', len(labels) - 1)],
+            'difficulty': label_names[column('difficulty', len(labels) - 1)]}
+
+
+def _PairwiseIOU(boxes_a, boxes_b):
+    # IOU of every pair of boxes in (..., 4) arrays of left, top, right,
+    # bottom, broadcast against each other. Same arithmetic as IOU().
+    area_a = (boxes_a[..., 2] - boxes_a[..., 0]) * (boxes_a[..., 3] - boxes_a[..., 1])
+    area_b = (boxes_b[..., 2] - boxes_b[..., 0]) * (boxes_b[..., 3] - boxes_b[..., 1])
+    left = np.maximum(boxes_a[..., 0], boxes_b[..., 0])
+    top = np.maximum(boxes_a[..., 1], boxes_b[..., 1])
+    right = np.minimum(boxes_a[..., 2], boxes_b[..., 2])
+    bottom = np.minimum(boxes_a[..., 3], boxes_b[..., 3])
+    inter_area = np.maximum(0, right - left) * np.maximum(0, bottom - top)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return inter_area / (area_a + area_b - inter_area)
+
+def _PairwiseDistance(locations_a, locations_b):
+    # Euclidean distance of every pair of (..., 3) locations. Taken as
+    # sqrt(dot(d, d)), which is what np.linalg.norm does for one vector, so the
+    # distances are bit for bit those of EuclideanDistance().
+    d = locations_a - locations_b
+    return np.sqrt((d[..., None, :] @ d[..., :, None])[..., 0, 0])
+
+
+def MatchFrames(predictions, groundtruth, type='2D', threshold=0.5):
+    # Vectorized TPFP2D/TPFP3D over many frames at once. predictions and
+    # groundtruth are FrameObjects/_ObjectArrays of the same frames. Returns
+    # a TPFP_DTYPE table with the rows of each frame in turn, in the order
+    # TPFP2D/TPFP3D would give them.
+    return MatchThresholds(predictions, groundtruth, type, [threshold])[0]
+
+def MatchThresholds(predictions, groundtruth, type='2D', thresholds=(0.5,)):
+    # MatchFrames for several thresholds, computing the IOUs or distances
+    # only once. Returns one table per threshold.
+    #
+    # Every frame's predictions are sorted by descending confidence, and
+    # predictions are padded into a (frames, predictions, ground truths)
+    # matrix of IOUs or distances. The greedy matching then goes one
+    # confidence rank at a time, for all frames together. Ties pick the same
+    # ground truth the tuple max/min did: the last one for IOU, the first
+    # one for distance.
+    pred_offsets, gt_offsets = predictions['offsets'], groundtruth['offsets']
+    num_frames = len(pred_offsets) - 1
+    pred_counts, gt_counts = np.diff(pred_offsets), np.diff(gt_offsets)
+    pred_frames = np.repeat(np.arange(num_frames), pred_counts)
+    gt_frames = np.repeat(np.arange(num_frames), gt_counts)
+    # lexsort is stable, as sorted() was.
+    order = np.lexsort((-predictions['confidence'], pred_frames))
+    pred_ranks = np.arange(len(order)) - pred_offsets[pred_frames]
+    gt_ranks = np.arange(len(gt_frames)) - gt_offsets[gt_frames]
+
+    matched = np.full((len(thresholds), len(order)), -1, dtype=np.int64)
+    metric = np.zeros((len(thresholds), len(order)))
+    tp = np.zeros((len(thresholds), len(order)), dtype=np.bool_)
+    max_preds = int(pred_counts.max()) if num_frames else 0
+    max_gts = int(gt_counts.max()) if num_frames else 0
+    chunk = max(1, _MATCH_CHUNK // max(1, max_preds * max_gts))
+    for first in range(0, num_frames, chunk):
+        frames = slice(first, min(first + chunk, num_frames))
+        num_preds, num_gts = int(pred_counts[frames].max()), int(gt_counts[frames].max())
+        if num_preds == 0 or num_gts == 0:
+            # Nothing to match; every prediction is already a 'missing' FP.
+            continue
+
+        # Padded indexes of the chunk's (sorted) predictions and ground truths.
+        pred_index = np.full((frames.stop - first, num_preds), -1, dtype=np.int64)
+        in_chunk = (pred_frames[order] >= first) & (pred_frames[order] < frames.stop)
+        pred_index[pred_frames[order][in_chunk] - first, pred_ranks[in_chunk]] = order[in_chunk]
+        gt_index = np.full((frames.stop - first, num_gts), -1, dtype=np.int64)
+        in_chunk = (gt_frames >= first) & (gt_frames < frames.stop)
+        gt_index[gt_frames[in_chunk] - first, gt_ranks[in_chunk]] = np.nonzero(in_chunk)[0]
+
+        if type == '2D':
+            scores = _PairwiseIOU(predictions['bbox'][pred_index][:, :, None], groundtruth['bbox'][gt_index][:, None, :])
+        else:
+            scores = _PairwiseDistance(predictions['3dbbox_loc'][pred_index][:, :, None], groundtruth['3dbbox_loc'][gt_index][:, None, :])
+
+        for t, threshold in enumerate(thresholds):
+            available = gt_index >= 0
+            for rank in range(num_preds):
+                rows = np.nonzero(pred_index[:, rank] >= 0)[0]
+                row_available = available[rows]
+                if type == '2D':
+                    row_scores = np.where(row_available, scores[rows, rank], -np.inf)
+                    best = num_gts - 1 - np.argmax(row_scores[:, ::-1], axis=1)
+                else:
+                    row_scores = np.where(row_available, scores[rows, rank], np.inf)
+                    best = np.argmin(row_scores, axis=1)
+                found = row_available.any(axis=1)
+                value = row_scores[np.arange(len(rows)), best]
+                is_tp = found & (value >= threshold if type == '2D' else value <= threshold)
+                available[rows[is_tp], best[is_tp]] = False
+
+                predicted = pred_index[rows, rank]
+                matched[t, predicted] = np.where(found, gt_index[rows, best], -1)
+                metric[t, predicted] = np.where(found, value, 0)
+                tp[t, predicted] = is_tp
+
+    tables = []
+    for t in range(len(thresholds)):
+        table = np.zeros(len(order), dtype=TPFP_DTYPE)
+        table['confidence'] = predictions['confidence']
+        table['tp'] = tp[t]
+        table['metric'] = metric[t]
+        table['difficulty'] = 'missing'
+        table['difficulty'][matched[t] >= 0] = groundtruth['difficulty'][matched[t][matched[t] >= 0]]
+        table['gt_type'][tp[t]] = groundtruth['type'][matched[t][tp[t]]]
+        table['pred_type'] = predictions['type']
+        tables.append(table[order])
+    return tables
+
+def _TableTuples(table):
+    # The TPFP table as the tuples TPFP2D/TPFP3D return.
+    results = []
+    for confidence, tp, metric, difficulty, gt_type, pred_type in table.tolist():
+        if tp:
+            results.append((confidence, 'TP', metric, difficulty, gt_type, pred_type))
+        elif difficulty == 'missing':
+            results.append((confidence, 'FP', 0, 'missing'))
+        else:
+            results.append((confidence, 'FP', metric, difficulty))
+    return results
+
+
 def TPFP2D(predictions, groundtruth, iou_threshold=0.5):
     # Labels each predicted 2D bounding box for a given image with
     # True Positive or False Positive.
@@ -16,21 +202,8 @@ def TPFP2D(predictions, groundtruth, iou_threshold=0.5):
     # that we don't 'reuse' ground truth boxes; if we have a double prediction
     # on a car, only one will be a true positive. The other will be a false
     # positive.
-    results = []
-    gt_objects = set(range(len(groundtruth['tracked_objects'])))
-    for tracked_object in sorted(predictions['tracked_objects'], key=lambda x: x['confidence'], reverse=True):
-
-        if not gt_objects:
-            results.append((tracked_object['confidence'], 'FP', 0, 'missing'))
-            continue
-        min_distance, gt_object = max([(IOU(tracked_object, groundtruth['tracked_objects'][gt_object]), gt_object) for gt_object in gt_objects])
-
-        if min_distance >= iou_threshold:
-            gt_objects.remove(gt_object)
-            results.append((tracked_object['confidence'], 'TP', min_distance, groundtruth['tracked_objects'][gt_object]['difficulty'], int(groundtruth['tracked_objects'][gt_object]['type'].split('_')[1]), int(tracked_object['type'].split('_')[1])))
-        else:
-            results.append((tracked_object['confidence'], 'FP', min_distance, groundtruth['tracked_objects'][gt_object]['difficulty']))
-    return results
+    return _TableTuples(MatchFrames(_ObjectArrays([predictions['tracked_objects']]),
+                                    _ObjectArrays([groundtruth['tracked_objects']]), '2D', iou_threshold))
 
 def TPFP3D(predictions, groundtruth, distance_threshold=5):
     # Labels each predicted 3D bounding box for a given image with
@@ -41,23 +214,8 @@ def TPFP3D(predictions, groundtruth, distance_threshold=5):
     # that we don't 'reuse' ground truth locations; if we have a double prediction
     # on a car, only one will be a true positive. The other will be a false
     # positive.
-
-    results = []
-    gt_objects = set(range(len(groundtruth['tracked_objects'])))
-
-    for tracked_object in sorted(predictions['tracked_objects'], key=lambda x: x['confidence'], reverse=True):
-        if not gt_objects:
-            results.append((tracked_object['confidence'], 'FP', 0, 'missing'))
-            continue
-        min_distance, gt_object = min([(EuclideanDistance(tracked_object, groundtruth['tracked_objects'][gt_object]), gt_object) for gt_object in gt_objects])
-
-        if min_distance <= distance_threshold:
-            gt_objects.remove(gt_object)
-            #used_gt_objects.add(gt_index)
-            results.append((tracked_object['confidence'], 'TP', min_distance, groundtruth['tracked_objects'][gt_object]['difficulty'], int(groundtruth['tracked_objects'][gt_object]['type'].split('_')[1]), int(tracked_object['type'].split('_')[1])))
-        else:
-            results.append((tracked_object['confidence'], 'FP', min_distance, groundtruth['tracked_objects'][gt_object]['difficulty']))
-    return results
+    return _TableTuples(MatchFrames(_ObjectArrays([predictions['tracked_objects']]),
+                                    _ObjectArrays([groundtruth['tracked_objects']]), '3D', distance_threshold))
 
 def EuclideanDistance(groundtruth_object, predicted_object):
     # TODO: Create another version of this function for filtered bounding box location
@@ -85,137 +243,188 @@ def IOU(A, B):
 # https://research.mapillary.com/img/publications/MonoDIS.pdf
 # Calculate according to MonoDIS paper and KITTI readme
 def MAP(precision, recall):
-
-    pr_list = zip(precision, recall)
-    pr_list = sorted(pr_list, reverse = True, key = lambda x: x[1]) # Reversed?
-
-    max_p_so_far = 0
-
-    rolling_sum = 0
-
+    # 11 point interpolated AP as we have always reported it: the best
+    # precision at a recall strictly above 1, 0.9, ..., 0, so the point at
+    # recall 1 is always 0. averageprecision.AP has the KITTI definitions.
+    recall, envelope = Envelope(precision, recall)
 
     recall_values = [1, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0]
-    recall_length = len(recall_values)
-    precision_values = []
-
-
-    for recall_value in recall_values:
-        index = 0
-        while index < len(pr_list) and pr_list[index][1] > recall_value:
-            max_p_so_far = max(pr_list[index][0], max_p_so_far)
-            index += 1
-        precision_values.append(max_p_so_far)
-
+    precision_values = [float(envelope[index]) if index < len(recall) else 0
+                        for index in np.searchsorted(recall, recall_values, side='right')]
 
     assert(len(precision_values) == 11)
     return sum(precision_values)/len(precision_values)
 
 
-def PR(type='2D', threshold=0.5, track_difficulty = True):
-        units = str(threshold*100) + ' %' if type == '2D' else str(threshold) + ' m'
-
-        TPFP_table = []
-        easy_counts = 0
-        medium_counts = 0
-        hard_counts = 0
-        counts = 0
-
-        for sequence_name in os.listdir('eval'):
-            if sequence_name == '.DS_Store':
-                continue
-
-            print ("Sequence: ", sequence_name, " Type: ", type, " Threshold: ", units)
-            for i, filename in enumerate(sorted(os.listdir(os.path.join('eval',sequence_name,'predictions')))):
-                prediction = loadFrameData(os.path.join('eval', sequence_name, 'predictions', filename))
-                groundtruth = loadFrameData(os.path.join('eval', sequence_name, 'groundtruth', filename))
-                for gt_object in groundtruth['tracked_objects']:
-                    if gt_object['difficulty'] == 'easy':
-                        easy_counts += 1
-                    elif gt_object['difficulty'] == 'medium':
-                        medium_counts += 1
-                    elif gt_object['difficulty'] == 'hard':
-                        hard_counts += 1
-                    counts += 1
-
-                if type == '2D': # Image space precision-recall
-                    TPFP_table += TPFP2D(prediction, groundtruth, threshold)
-                else: # 3d position precision-recall
-                    TPFP_table += TPFP3D(prediction, groundtruth, threshold)
-
-        TPFP_table.sort(reverse=True) # Sort by descending confidence
-        TP_easy = 0 # True positive counts
-        FP_easy = 0 # False positive counts
-        TP_medium = 0
-        FP_medium = 0
-        TP_hard = 0
-        FP_hard = 0
-        TP = 0
-        FP = 0
-        precision_easy = []
-        precision_medium = []
-        precision_hard = []
-        recall_easy = []
-        recall_medium = []
-        recall_hard = []
-        precision = []
-        recall = []
-
-        y_true = []
-        y_pred = []
-
-        for pred in TPFP_table:
-            # Difficulty adds
-            if track_difficulty == True:
-                if pred[3] == 'easy':
-                    if pred[1] == 'TP':
-                        TP_easy += 1
-                    else:
-                        FP_easy += 1
-                    p_easy = TP_easy / (TP_easy + FP_easy)
-                    r_easy = TP_easy / easy_counts
-
-                    precision_easy.append(p_easy)
-                    recall_easy.append(r_easy)
-                elif pred[3] == 'medium':
-                    if pred[1] == 'TP':
-                        TP_medium += 1
-                    else:
-                        FP_medium += 1
-                    p_medium = TP_medium / (TP_medium + FP_medium)
-                    r_medium = TP_medium / medium_counts
-
-                    precision_medium.append(p_medium)
-                    recall_medium.append(r_medium)
-                elif pred[3] == 'hard':
-                    if pred[1] == 'TP':
-                        TP_hard += 1
-                    else:
-                        FP_hard += 1
-                    p_hard = TP_hard / (TP_hard + FP_hard)
-                    r_hard = TP_hard / hard_counts
-
-                    precision_hard.append(p_hard)
-                    recall_hard.append(r_hard)
-
-            # Regular adds
-            else:
-                if pred[1] == 'TP':
-                    TP += 1
-                else:
-                    FP += 1
-
-                p = TP / (TP + FP)
-                r = TP / counts
-
-                precision.append(p)
-                recall.append(r)
-
-            # For confusion matrix
-            if pred[1] == 'TP':
-                y_true.extend([pred[4]])
-                y_pred.extend([pred[5]])
-
+def SortTable(table):
+    # Sorts a TPFP table the way sorting its tuples in reverse did: by
+    # confidence, then TPs first, then by metric, difficulty and types, all
+    # descending. (FPs used to stop at difficulty; those that differ only in
+    # pred_type give the same curves in either order.)
+    _, difficulty = np.unique(table['difficulty'], return_inverse=True)
+    return table[np.lexsort((-table['pred_type'], -table['gt_type'], -difficulty.reshape(-1),
+                             -table['metric'], -table['tp'].astype(np.int8), -table['confidence']))]
+
+def _Curve(tp, total):
+    precision, recall = Curve(tp, total)
+    return precision.tolist(), recall.tolist()
+
+
+class Evaluation:
+    # TPFP tables for every (type, threshold) of a sweep over eval/, see
+    # Evaluate(). Precision-recall curves, APs and orientation labels for
+    # any difficulty come from the tables without touching the frames again.
+    def __init__(self, tables, gt_counts, gt_type_counts):
+        # tables: {(type, threshold): sorted TPFP table}
+        # gt_counts: {difficulty: number of ground truth objects}
+        # gt_type_counts: {orientation bin: number of ground truth objects}
+        self.tables = tables
+        self.gt_counts = gt_counts
+        self.gt_type_counts = gt_type_counts
+
+    def Thresholds(self, type):
+        return sorted(threshold for table_type, threshold in self.tables if table_type == type)
+
+    def Table(self, type, threshold):
+        if (type, threshold) not in self.tables:
+            raise ValueError("{} at threshold {} was not evaluated, have {}".format(type, threshold, sorted(self.tables)))
+        return self.tables[(type, threshold)]
+
+    def Curve(self, type, threshold, difficulty=None):
+        # (precision, recall) over the predictions matched to ground truth of
+        # the given difficulty, or over all predictions if None.
+        table = self.Table(type, threshold)
+        if difficulty is None:
+            return _Curve(table['tp'], sum(self.gt_counts.values()))
+        rows = table['difficulty'] == difficulty
+        return _Curve(table['tp'][rows], self.gt_counts.get(difficulty, 0))
+
+    def MAP(self, type, threshold, difficulty=None):
+        return MAP(*self.Curve(type, threshold, difficulty))
+
+    def AP(self, type, threshold, interpolation='40'):
+        # {'all', 'easy', 'medium', 'hard': AP, 'orientation': {bin: AP}},
+        # see averageprecision.TableAPs.
+        return TableAPs(self.Table(type, threshold), self.gt_counts, self.gt_type_counts, interpolation)
+
+    def Orientations(self, type, threshold):
+        # (y_true, y_pred) orientation bins of the true positives, for the
+        # confusion matrix.
+        table = self.Table(type, threshold)
+        return table['gt_type'][table['tp']].tolist(), table['pred_type'][table['tp']].tolist()
+
+    def PR(self, type, threshold, track_difficulty=True):
+        # Same as PR(type, threshold, track_difficulty).
         if track_difficulty == True:
-            return precision_easy, recall_easy, precision_medium, recall_medium, precision_hard, recall_hard, (y_true, y_pred)
+            curves = []
+            for difficulty in ['easy', 'medium', 'hard']:
+                curves += self.Curve(type, threshold, difficulty)
+            return tuple(curves) + (self.Orientations(type, threshold),)
         else:
-            return precision, recall, (y_true, y_pred)
+            precision, recall = self.Curve(type, threshold)
+            return precision, recall, self.Orientations(type, threshold)
+
+
+def _Units(type, threshold):
+    return str(threshold*100) + ' %' if type == '2D' else str(threshold) + ' m'
+
+# Per-sequence results are kept in eval/<seq>/RESULTS_FILE. Bump
+# RESULTS_VERSION when the TPFP tables change.
+RESULTS_FILE = 'tpfp.npz'
+RESULTS_VERSION = 2
+
+def _TableName(type, threshold):
+    return 'table {} {!r}'.format(type, float(threshold))
+
+def _ReadResults(path, fingerprint):
+    # Returns ({table name: TPFP table}, {difficulty: count},
+    # {orientation bin: count}) from a results file, or None if there is
+    # none for these inputs.
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['fingerprint']) != fingerprint:
+                return None
+            tables = {name: data[name] for name in data.files if name.startswith('table ')}
+            gt_counts = dict(zip(data['gt_difficulties'].tolist(), data['gt_counts'].tolist()))
+            gt_type_counts = dict(zip(data['gt_types'].tolist(), data['gt_type_counts'].tolist()))
+        return tables, gt_counts, gt_type_counts
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _WriteResults(path, fingerprint, tables, gt_counts, gt_type_counts):
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temporary, 'wb') as f:
+            np.savez(f, fingerprint=np.array(fingerprint), gt_difficulties=np.array(list(gt_counts), dtype=TPFP_DTYPE['difficulty']),
+                     gt_counts=np.array(list(gt_counts.values()), dtype=np.int64),
+                     gt_types=np.array(list(gt_type_counts), dtype=np.int64),
+                     gt_type_counts=np.array(list(gt_type_counts.values()), dtype=np.int64), **tables)
+        os.replace(temporary, path)
+    except OSError as e:
+        print("Could not save results to {}: {}".format(path, e))
+
+def Evaluate(thresholds, directory='eval', workers=None, cache=True):
+    # Evaluates every sequence in directory once for a whole sweep.
+    # thresholds maps a type to the thresholds to evaluate it at, e.g.
+    # {'2D': [0.5, 0.7], '3D': [10, 5, 3, 1.5]}. Each frame is read once and
+    # its IOUs/distances are computed once per type. Sequences are loaded by
+    # frameloader.LoadSequences, with `workers` processes and its cache.
+    #
+    # The TPFP tables and ground truth counts of each sequence are saved in
+    # eval/<seq>/tpfp.npz along with a fingerprint of its frames (see
+    # frameloader.CacheKey). Later runs reuse them, so only sequences that
+    # were regenerated, or thresholds that weren't evaluated before, are
+    # computed again. cache=False ignores and doesn't write both caches.
+    sequence_names = [sequence_name for sequence_name in os.listdir(directory) if sequence_name != '.DS_Store']
+    names = {(type, threshold): _TableName(type, threshold) for type, type_thresholds in thresholds.items() for threshold in type_thresholds}
+
+    results = {}
+    fingerprints = {}
+    for sequence_name in sequence_names:
+        fingerprints[sequence_name] = 'version {} {}'.format(RESULTS_VERSION, CacheKey(directory, sequence_name))
+        results[sequence_name] = _ReadResults(os.path.join(directory, sequence_name, RESULTS_FILE), fingerprints[sequence_name]) if cache else None
+        if results[sequence_name] is None:
+            results[sequence_name] = ({}, None, None)
+    stale = [sequence_name for sequence_name in sequence_names
+             if results[sequence_name][1] is None or not set(names.values()) <= set(results[sequence_name][0])]
+    if len(stale) < len(sequence_names):
+        print("Reusing saved results of {} of {} sequences".format(len(sequence_names) - len(stale), len(sequence_names)))
+
+    for sequence_name, (prediction, groundtruth) in zip(stale, LoadSequences(directory, stale, workers, cache)):
+        sequence_tables = results[sequence_name][0]
+        missing = [key for key, name in names.items() if name not in sequence_tables]
+        print ("Sequence: ", sequence_name, " Thresholds: ", ', '.join(_Units(type, threshold) for type, threshold in sorted(missing)))
+        for type in thresholds:
+            type_thresholds = [threshold for missing_type, threshold in missing if missing_type == type]
+            for threshold, table in zip(type_thresholds, MatchThresholds(prediction, groundtruth, type, type_thresholds)):
+                sequence_tables[names[(type, threshold)]] = table
+        difficulties, counts = np.unique(groundtruth['difficulty'], return_counts=True)
+        gt_counts = dict(zip(difficulties.tolist(), counts.tolist()))
+        types, counts = np.unique(groundtruth['type'], return_counts=True)
+        gt_type_counts = dict(zip(types.tolist(), counts.tolist()))
+        results[sequence_name] = (sequence_tables, gt_counts, gt_type_counts)
+        if cache:
+            _WriteResults(os.path.join(directory, sequence_name, RESULTS_FILE), fingerprints[sequence_name],
+                          sequence_tables, gt_counts, gt_type_counts)
+
+    tables = {}
+    for key, name in names.items():
+        sequence_tables = [results[sequence_name][0][name] for sequence_name in sequence_names]
+        tables[key] = SortTable(np.concatenate(sequence_tables) if sequence_tables else np.zeros(0, dtype=TPFP_DTYPE))
+    gt_counts = {}
+    gt_type_counts = {}
+    for sequence_name in sequence_names:
+        for difficulty, count in results[sequence_name][1].items():
+            gt_counts[difficulty] = gt_counts.get(difficulty, 0) + count
+        for type, count in results[sequence_name][2].items():
+            gt_type_counts[type] = gt_type_counts.get(type, 0) + count
+    return Evaluation(tables, gt_counts, gt_type_counts)
+
+
+def PR(type='2D', threshold=0.5, track_difficulty = True):
+    # Precision-recall of every sequence in eval/ at one threshold. With
+    # track_difficulty, returns (precision, recall) for easy, medium and
+    # hard, then (y_true, y_pred); without, (precision, recall) over all
+    # predictions and (y_true, y_pred). For more than one threshold use
+    # Evaluate(), which reads the frames only once.
+    return Evaluate({type: [threshold]}).PR(type, threshold, track_difficulty)
@@ -0,0 +1,132 @@
+################################################################################
+#
+# Regression check for precisionrecall.PR and MAP. Builds a small fixed
+# synthetic eval/ tree (one sequence as a frame store, one as pickles) with
+# tied confidences, duplicate detections and unmatched boxes, and compares PR
+# and MAP against the values the original per-box implementation gave.
+#
+# Usage:
+# python evaluation/precisionrecall_test.py
+#
+# Prints the results and exits with 1 if any of them changed. Only needs
+# numpy.
+#
+################################################################################
+
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+from framestore import FrameStoreWriter, PickleFrameSink
+import precisionrecall
+
+DIFFICULTIES = ['easy', 'medium', 'hard', 'very hard']
+
+def _Frames(rng, num_frames=40):
+    # (predictions, groundtruth) frame dicts of one sequence.
+    frames = []
+    for frame_number in range(num_frames):
+        groundtruth = []
+        for _ in range(rng.randint(0, 7)):
+            left, top = rng.randint(0, 1100), rng.randint(100, 300)
+            groundtruth.append({'bbox': {'left': left, 'top': top, 'right': left + rng.randint(20, 120), 'bottom': top + rng.randint(20, 80)},
+                                '3dbbox_loc': [float(v) for v in rng.uniform([-20, 0, 5], [20, 3, 60])],
+                                'type': 'Car_{}'.format(rng.randint(0, 4)), 'difficulty': DIFFICULTIES[rng.randint(0, 4)]})
+        predictions = []
+        for gt_object in groundtruth:
+            # Most cars are found, some twice. Two decimal confidences tie.
+            for _ in range(rng.choice([0, 1, 1, 1, 2])):
+                box = {key: int(value + rng.randint(-8, 9)) for key, value in gt_object['bbox'].items()}
+                predictions.append({'bbox': box, 'confidence': round(float(rng.uniform(0.2, 1.0)), 2),
+                                    '3dbbox_loc': [float(v) for v in np.array(gt_object['3dbbox_loc']) + rng.normal(0, 1.5, 3)],
+                                    'type': 'Car_{}'.format(rng.randint(0, 4) if rng.rand() < 0.3 else gt_object['type'][-1])})
+        for _ in range(rng.randint(0, 3)):
+            left, top = rng.randint(0, 1100), rng.randint(100, 300)
+            predictions.append({'bbox': {'left': left, 'top': top, 'right': left + 50, 'bottom': top + 30},
+                                'confidence': round(float(rng.uniform(0.0, 0.6)), 2),
+                                '3dbbox_loc': [float(v) for v in rng.uniform([-20, 0, 5], [20, 3, 60])], 'type': 'Car_0'})
+        frames.append((str(frame_number).zfill(6), {'tracked_objects': predictions}, {'tracked_objects': groundtruth}))
+    return frames
+
+def WriteEval(directory, seed=0):
+    # Writes eval/0000 as a frame store and eval/0001 as pickles.
+    rng = np.random.RandomState(seed)
+    for sequence_name, sink_type in [('0000', FrameStoreWriter), ('0001', PickleFrameSink)]:
+        path = os.path.join(directory, 'eval', sequence_name)
+        os.makedirs(path, exist_ok=True)
+        if sink_type is FrameStoreWriter:
+            predictions = FrameStoreWriter(os.path.join(path, 'predictions.frames'))
+            groundtruth = FrameStoreWriter(os.path.join(path, 'groundtruth.frames'))
+        else:
+            predictions = PickleFrameSink(os.path.join(path, 'predictions'))
+            groundtruth = PickleFrameSink(os.path.join(path, 'groundtruth'))
+        for frame_name, prediction, gt in _Frames(rng):
+            predictions.Write(frame_name, prediction)
+            groundtruth.Write(frame_name, gt)
+        predictions.Close()
+        groundtruth.Close()
+
+
+def Summary(curves):
+    # Compact fingerprint of a PR() result: per curve its length, sums, last
+    # point and MAP, then the TP orientation pairs.
+    *curves, (y_true, y_pred) = curves
+    summary = []
+    for precision, recall in zip(curves[0::2], curves[1::2]):
+        summary.append((len(precision), sum(precision), sum(recall), precision[-1] if precision else None,
+                        recall[-1] if recall else None, precisionrecall.MAP(precision, recall)))
+    pairs = {}
+    for pair in zip(y_true, y_pred):
+        pairs[pair] = pairs.get(pair, 0) + 1
+    return summary, sorted(pairs.items())
+
+# What the original implementation gave for WriteEval(seed=0).
+EXPECTED = {
+    ('2D', 0.5, True): ([(50, 46.18684037398733, 19.771929824561408, 0.78, 0.6842105263157895, 0.6057979625754562),
+                         (65, 59.68890935676947, 29.24242424242424, 0.8307692307692308, 0.8181818181818182, 0.767808899319233),
+                         (66, 49.66480074956846, 27.03636363636364, 0.5757575757575758, 0.6909090909090909, 0.5280994274542661)],
+                        [((0, 0), 40), ((0, 1), 6), ((0, 2), 1), ((0, 3), 7), ((1, 1), 43), ((1, 2), 3), ((1, 3), 2), ((2, 0), 3), ((2, 1), 1), ((2, 2), 30), ((2, 3), 4), ((3, 0), 3), ((3, 1), 1), ((3, 2), 4), ((3, 3), 37)]),
+    ('2D', 0.7, False): ([(295, 165.95855857256333, 92.57024793388435, 0.423728813559322, 0.5165289256198347, 0.3512533722927285)],
+                         [((0, 0), 25), ((0, 1), 5), ((0, 2), 1), ((0, 3), 6), ((1, 1), 31), ((1, 2), 2), ((1, 3), 1), ((2, 0), 1), ((2, 1), 1), ((2, 2), 20), ((2, 3), 2), ((3, 0), 3), ((3, 1), 1), ((3, 2), 4), ((3, 3), 22)]),
+    ('3D', 1.5, False): ([(295, 54.40151777547636, 31.219008264462794, 0.1423728813559322, 0.17355371900826447, 0.055425219941348976)],
+                         [((0, 0), 7), ((0, 3), 4), ((1, 1), 8), ((1, 3), 1), ((2, 1), 1), ((2, 2), 10), ((2, 3), 1), ((3, 0), 2), ((3, 2), 1), ((3, 3), 7)]),
+    ('3D', 1.5, True): ([(64, 7.316561260032207, 4.140350877192979, 0.078125, 0.08771929824561403, 0.016835016835016835),
+                         (84, 12.948355791089625, 8.469696969696969, 0.15476190476190477, 0.19696969696969696, 0.06363636363636363),
+                         (57, 15.401739660499699, 7.290909090909091, 0.21052631578947367, 0.21818181818181817, 0.1422077922077922)],
+                        [((0, 0), 7), ((0, 3), 4), ((1, 1), 8), ((1, 3), 1), ((2, 1), 1), ((2, 2), 10), ((2, 3), 1), ((3, 0), 2), ((3, 2), 1), ((3, 3), 7)]),
+    ('3D', 5, True): ([(52, 47.06441291054788, 20.64912280701755, 0.7307692307692307, 0.6666666666666666, 0.6024872213093383),
+                       (68, 63.88807937477881, 32.45454545454546, 0.8235294117647058, 0.8484848484848485, 0.785245817503882),
+                       (59, 48.6400261633483, 24.181818181818187, 0.6610169491525424, 0.7090909090909091, 0.632145127599673)],
+                      [((0, 0), 40), ((0, 1), 6), ((0, 2), 1), ((0, 3), 7), ((1, 0), 1), ((1, 1), 42), ((1, 2), 3), ((1, 3), 2), ((2, 0), 6), ((2, 1), 1), ((2, 2), 31), ((2, 3), 4), ((3, 0), 3), ((3, 1), 1), ((3, 2), 3), ((3, 3), 39)]),
+}
+
+def Close(a, b):
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(Close(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) and isinstance(b, float):
+        return abs(a - b) <= 1e-12
+    return a == b
+
+
+def main(argv):
+    directory = tempfile.mkdtemp()
+    previous = os.getcwd()
+    failures = 0
+    try:
+        WriteEval(directory)
+        os.chdir(directory)
+        # The second pass reads the saved per-sequence results.
+        for attempt in ['fresh', 'cached']:
+            for key, expected in EXPECTED.items():
+                result = Summary(precisionrecall.PR(*key))
+                ok = Close(result, expected)
+                failures += not ok
+                print(attempt, key, 'ok' if ok else 'CHANGED\n  got      {}\n  expected {}'.format(result, expected))
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(directory)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,484 @@
+################################################################################
+#
+# Runs NetworkModel as a local service, so other processes can send it stereo
+# frames and get tracked objects back.
+#
+# Usage:
+# python evaluation/service.py --unix /tmp/vd.sock
+# python evaluation/service.py --tcp 127.0.0.1:7878 --batch-size 8 --batch-delay-ms 5
+# python evaluation/service.py --unix /tmp/vd.sock --stereo fast roi
+#
+# Clients tag every frame with a stream ID, and each stream gets its own
+# tracker, so one server can follow many cameras. Frames from all streams
+# that arrive within --batch-delay-ms of each other share one detector
+# forward pass (up to --batch-size frames). Disparity is computed on a
+# thread pool while frames wait for the detector. Tracking runs on one
+# thread, so every stream sees its frames in the order they arrived.
+# See loadtest.py for a client. --stereo takes any StereoDepth.STEREO_PRESETS
+# name, e.g. balanced-pyramid.
+#
+# Wire format, in both directions: a 4 byte big-endian length, a JSON
+# header of that length, then the binary blobs whose byte lengths the header
+# lists under 'blobs', back to back. Requests carry an 'id' that the reply
+# echoes, so a client may have many requests in flight on one connection.
+#
+#   {'op': 'predict', 'stream': ..., 'frame': ..., 'timestamp': ...,
+#    'filter': 'kalman', 'images': [image_l, image_r]}
+#       + two image blobs, see EncodeImage
+#     -> {'tracked_objects': [...], 'latency_ms': ...}
+#   {'op': 'close_stream', 'stream': ...}  forget a stream's tracker
+#   {'op': 'health'}                       -> liveness and load
+#   {'op': 'stats'}                        -> stage timings, latencies, counters
+#
+# Errors come back as {'id': ..., 'error': message}.
+#
+################################################################################
+
+import sys
+import os
+import re
+import json
+import time
+import struct
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from pipeline import PipelineStats
+from StereoDepth import Convert3D
+
+IMAGE_ENCODINGS = ['raw', 'png', 'jpg']
+FILTER_TYPES = ['kalman', 'particle', None]
+
+# Stream IDs name track log directories, so keep them to safe characters.
+STREAM_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+# Refuse absurd messages instead of trying to allocate them.
+MAX_HEADER_BYTES = 1 << 20
+MAX_BLOB_BYTES = 1 << 28
+
+_LENGTH = struct.Struct('>I')
+
+
+def EncodeImage(image, encoding='raw'):
+    # Returns (description, blob). raw is fastest on a local socket, png and
+    # jpg trade CPU for bandwidth.
+    if encoding not in IMAGE_ENCODINGS:
+        raise ValueError("Unknown image encoding '{}', expected one of {}".format(encoding, IMAGE_ENCODINGS))
+    if encoding == 'raw':
+        image = np.ascontiguousarray(image)
+        return {'encoding': 'raw', 'shape': list(image.shape), 'dtype': str(image.dtype)}, image.tobytes()
+    ok, encoded = cv2.imencode('.' + encoding, image)
+    if not ok:
+        raise ValueError("Could not encode image as {}".format(encoding))
+    return {'encoding': encoding}, encoded.tobytes()
+
+
+def DecodeImage(description, blob):
+    if description.get('encoding') == 'raw':
+        return np.frombuffer(blob, dtype=np.dtype(description['dtype'])).reshape(description['shape'])
+    image = cv2.imdecode(np.frombuffer(blob, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode {} image".format(description.get('encoding')))
+    return image
+
+
+def _JSONDefault(value):
+    # Tracked objects hold numpy arrays and scalars.
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+def WriteMessage(writer, header, blobs=()):
+    # Queues one message on an asyncio StreamWriter. Await writer.drain()
+    # afterwards for backpressure.
+    header = dict(header, blobs=[len(blob) for blob in blobs])
+    encoded = json.dumps(header, default=_JSONDefault).encode('utf-8')
+    writer.write(_LENGTH.pack(len(encoded)) + encoded)
+    for blob in blobs:
+        writer.write(blob)
+
+
+async def ReadMessage(reader):
+    # Returns (header, blobs), or None if the peer closed the connection.
+    try:
+        prefix = await reader.readexactly(_LENGTH.size)
+    except asyncio.IncompleteReadError as e:
+        if len(e.partial) == 0:
+            return None
+        raise
+    length, = _LENGTH.unpack(prefix)
+    if length > MAX_HEADER_BYTES:
+        raise ValueError("Message header of {} bytes is too large".format(length))
+    header = json.loads((await reader.readexactly(length)).decode('utf-8'))
+    blob_lengths = header.pop('blobs', [])
+    if any(blob_length > MAX_BLOB_BYTES for blob_length in blob_lengths):
+        raise ValueError("Message blob is too large")
+    blobs = [await reader.readexactly(blob_length) for blob_length in blob_lengths]
+    return header, blobs
+
+
+class _Frame:
+    # One predict request on its way through the server.
+    def __init__(self, stream_id, frame_name, timestamp, filter_type, bgr_l, bgr_r):
+        self.stream_id = stream_id
+        self.frame_name = frame_name
+        self.timestamp = timestamp
+        self.filter_type = filter_type
+        self.bgr_l = bgr_l
+        self.bgr_r = bgr_r
+        self.received = time.perf_counter()
+        self.stereo = None
+        self.prediction = None
+
+
+class _Stream:
+    def __init__(self, tracker, filter_type):
+        self.tracker = tracker
+        self.filter_type = filter_type
+        self.frames = 0
+        self.last_seen = time.monotonic()
+
+
+class TrackingServer:
+    # Serves one NetworkModel. Use Serve() to run it, or Start() and Close()
+    # from an already running event loop.
+    # max_batch_size frames at most share a forward pass. The batcher waits
+    # up to max_batch_delay seconds after the first frame for more to arrive.
+    # max_pending bounds the frames waiting for the detector; further predict
+    # requests wait on their connection (backpressure to the client).
+    # Streams that send nothing for stream_timeout seconds are forgotten.
+    # The last latency_window latencies are kept for the percentiles.
+    def __init__(self, model, max_batch_size=8, max_batch_delay=0.005, stereo_workers=2, max_pending=64,
+                 stream_timeout=300, latency_window=1000):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.max_pending = max_pending
+        self.stream_timeout = stream_timeout
+        self.stats = PipelineStats()
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.batch_sizes = collections.deque(maxlen=latency_window)
+        # Only the tracking thread touches self.streams.
+        self.streams = {}
+        # The network is driven from one thread, tracking from another; both
+        # are FIFO, which keeps each stream's frames in arrival order.
+        self.detector = ThreadPoolExecutor(max_workers=1, thread_name_prefix='detect')
+        self.tracking = ThreadPoolExecutor(max_workers=1, thread_name_prefix='track')
+        self.stereo_pool = ThreadPoolExecutor(max_workers=stereo_workers, thread_name_prefix='stereo')
+        self.server = None
+        self.pending = None
+        self.batcher = None
+        self.in_flight = 0
+        self.started = None
+
+    async def Start(self, host=None, port=None, path=None):
+        # Listens on a Unix socket at path, or on host:port.
+        self.pending = asyncio.Queue(maxsize=self.max_pending)
+        self.batcher = asyncio.ensure_future(self._Batcher())
+        if path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.server = await asyncio.start_unix_server(self._HandleConnection, path=path)
+        else:
+            self.server = await asyncio.start_server(self._HandleConnection, host=host, port=port)
+        self.started = time.monotonic()
+        return self.server
+
+    async def Serve(self, host=None, port=None, path=None):
+        await self.Start(host, port, path)
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.Close()
+
+    async def Close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.batcher is not None:
+            self.batcher.cancel()
+            try:
+                await self.batcher
+            except asyncio.CancelledError:
+                pass
+        self.detector.shutdown()
+        self.stereo_pool.shutdown()
+        self.tracking.submit(self._CloseStreams).result()
+        self.tracking.shutdown()
+
+    async def _HandleConnection(self, reader, writer):
+        write_lock = asyncio.Lock()
+        tasks = set()
+        self.stats.Count('connections')
+        try:
+            while True:
+                try:
+                    message = await ReadMessage(reader)
+                except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+                    self.stats.Count('bad_messages')
+                    break
+                if message is None:
+                    break
+                header, blobs = message
+                if header.get('op') == 'predict':
+                    # Admit the frame before reading the next message, so
+                    # frames of one stream keep their order.
+                    try:
+                        frame = self._Admit(header, blobs)
+                    except (ValueError, KeyError, TypeError) as e:
+                        self.stats.Count('errors')
+                        await self._Reply(writer, write_lock, {'id': header.get('id'), 'error': str(e)})
+                        continue
+                    future = asyncio.get_running_loop().create_future()
+                    self.in_flight += 1
+                    await self.pending.put((frame, future))
+                    task = asyncio.ensure_future(self._AnswerPredict(writer, write_lock, header.get('id'), frame, future))
+                else:
+                    task = asyncio.ensure_future(self._AnswerControl(writer, write_lock, header))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer.close()
+
+    def _Admit(self, header, blobs):
+        stream_id = str(header['stream'])
+        if not STREAM_ID_PATTERN.match(stream_id):
+            raise ValueError("Invalid stream ID '{}'".format(stream_id))
+        filter_type = header.get('filter', 'kalman')
+        if filter_type not in FILTER_TYPES:
+            raise ValueError("Unknown filter type '{}', expected one of {}".format(filter_type, FILTER_TYPES))
+        images = header['images']
+        if len(images) != 2 or len(blobs) != 2:
+            raise ValueError("A predict request needs exactly two images")
+        bgr_l, bgr_r = [DecodeImage(description, blob) for description, blob in zip(images, blobs)]
+        if bgr_l.shape != bgr_r.shape or bgr_l.ndim != 3:
+            raise ValueError("Left and right images must be BGR images of the same size")
+        timestamp = header.get('timestamp')
+        frame = _Frame(stream_id, header.get('frame'), None if timestamp is None else float(timestamp), filter_type, bgr_l, bgr_r)
+        if not self.model.roi_stereo:
+            # Full frame disparity doesn't need the boxes, start it now.
+            frame.stereo = self.stereo_pool.submit(self._Disparity, frame)
+        return frame
+
+    async def _AnswerPredict(self, writer, write_lock, request_id, frame, future):
+        try:
+            tracked_objects = await future
+            latency = time.perf_counter() - frame.received
+            self.latencies.append(latency)
+            self.stats.AddTime('total', latency)
+            reply = {'id': request_id, 'stream': frame.stream_id, 'frame': frame.frame_name,
+                     'tracked_objects': tracked_objects, 'latency_ms': 1000 * latency}
+        except Exception as e:
+            self.stats.Count('errors')
+            reply = {'id': request_id, 'error': "{}: {}".format(type(e).__name__, e)}
+        finally:
+            self.in_flight -= 1
+        await self._Reply(writer, write_lock, reply)
+
+    async def _AnswerControl(self, writer, write_lock, header):
+        op = header.get('op')
+        reply = {'id': header.get('id')}
+        if op == 'health':
+            reply.update(self.Health())
+        elif op == 'stats':
+            reply.update(self.Stats())
+        elif op == 'close_stream':
+            loop = asyncio.get_running_loop()
+            reply['closed'] = await loop.run_in_executor(self.tracking, self._CloseStream, str(header.get('stream')))
+        else:
+            reply['error'] = "Unknown op '{}'".format(op)
+        await self._Reply(writer, write_lock, reply)
+
+    async def _Reply(self, writer, write_lock, reply):
+        async with write_lock:
+            try:
+                WriteMessage(writer, reply)
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    def Health(self):
+        return {'status': 'ok' if self.batcher is not None and not self.batcher.done() else 'down',
+                'uptime_s': time.monotonic() - self.started if self.started is not None else 0.0,
+                'streams': len(self.streams),
+                'pending': self.pending.qsize() if self.pending is not None else 0,
+                'in_flight': self.in_flight}
+
+    def Stats(self):
+        # Latency percentiles over the last latency_window frames, in ms,
+        # next to PipelineStats' per-stage timings and counters.
+        latencies = 1000 * np.array(self.latencies)
+        latency = {}
+        if len(latencies):
+            latency = {'count': len(latencies), 'mean': float(latencies.mean()), 'max': float(latencies.max())}
+            for percentile in (50, 95, 99):
+                latency['p{}'.format(percentile)] = float(np.percentile(latencies, percentile))
+        summary = self.stats.Summary()
+        summary['latency_ms'] = latency
+        summary['mean_batch_size'] = float(np.mean(self.batch_sizes)) if len(self.batch_sizes) else 0.0
+        summary.update(self.Health())
+        return summary
+
+    async def _Batcher(self):
+        loop = asyncio.get_running_loop()
+        # Frames of the batch being detected. Once handed to the tracking
+        # thread they are answered from there.
+        batch = []
+        try:
+            while True:
+                batch = [await self.pending.get()]
+                deadline = loop.time() + self.max_batch_delay
+                while len(batch) < self.max_batch_size:
+                    if not self.pending.empty():
+                        batch.append(self.pending.get_nowait())
+                        continue
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.pending.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                self.batch_sizes.append(len(batch))
+                self.stats.Count('batches')
+                frames = [frame for frame, _ in batch]
+                try:
+                    predictions = await loop.run_in_executor(self.detector, self._Detect, frames)
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+
+                # Hand the batch over to the tracking thread and go straight
+                # back to collecting the next one.
+                for (frame, future), prediction in zip(batch, predictions):
+                    frame.prediction = prediction
+                    if frame.stereo is None:
+                        frame.stereo = self.stereo_pool.submit(self._ROIStereo, frame)
+                    tracked = asyncio.wrap_future(self.tracking.submit(self._Track, frame), loop=loop)
+                    tracked.add_done_callback(lambda tracked, future=future: self._Resolve(future, tracked))
+                batch = []
+        except asyncio.CancelledError:
+            # Closing: answer everything that will never reach the detector.
+            while not self.pending.empty():
+                batch.append(self.pending.get_nowait())
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(ConnectionError('server closing'))
+            raise
+
+    def _Resolve(self, future, tracked):
+        if future.done():
+            return
+        if tracked.cancelled():
+            future.set_exception(ConnectionError('server closing'))
+        elif tracked.exception() is not None:
+            future.set_exception(tracked.exception())
+        else:
+            future.set_result(tracked.result())
+
+    def _Detect(self, frames):
+        queued = time.perf_counter()
+        for frame in frames:
+            self.stats.AddTime('queue_wait', queued - frame.received)
+        with self.stats.Time('detect'):
+            rgb_images = [cv2.cvtColor(frame.bgr_l, cv2.COLOR_BGR2RGB) for frame in frames]
+            predictions = self.model._DetectBatch(rgb_images)
+        self.stats.Count('detections', sum(len(prediction) for prediction in predictions))
+        return predictions
+
+    def _Disparity(self, frame):
+        with self.stats.Time('stereo'):
+            return Convert3D(frame.bgr_l, frame.bgr_r, fields=('depth_img',), preset=self.model.stereo_preset)
+
+    def _ROIStereo(self, frame):
+        with self.stats.Time('stereo'):
+            return Convert3D(frame.bgr_l, frame.bgr_r, frame.prediction, roi=True, fields=('depth_img', 'positions_3D'),
+                             preset=self.model.stereo_preset)
+
+    def _Track(self, frame):
+        # Runs on the tracking thread, in arrival order.
+        with self.stats.Time('stereo_wait'):
+            stereoPrediction = frame.stereo.result()
+        with self.stats.Time('track'):
+            if not self.model.roi_stereo:
+                stereoPrediction.SetPrediction(frame.prediction)
+            stream = self._StreamFor(frame)
+            tracker = stream.tracker if frame.filter_type is not None else None
+            frame_data = self.model._TrackDetections(frame.stream_id, None, frame.prediction, stereoPrediction,
+                                                     frame.filter_type, timestamp=frame.timestamp, tracker=tracker)
+        stream.frames += 1
+        self.stats.Count('frames')
+        return frame_data['tracked_objects']
+
+    def _StreamFor(self, frame):
+        now = time.monotonic()
+        for stream_id in [stream_id for stream_id, stream in self.streams.items() if now - stream.last_seen > self.stream_timeout]:
+            self._CloseStream(stream_id)
+            self.stats.Count('streams_expired')
+
+        stream = self.streams.get(frame.stream_id)
+        if stream is None or stream.filter_type != frame.filter_type:
+            self._CloseStream(frame.stream_id)
+            tracker = self.model.NewTracker(frame.stream_id, frame.filter_type) if frame.filter_type is not None else None
+            stream = _Stream(tracker, frame.filter_type)
+            self.streams[frame.stream_id] = stream
+            self.stats.Count('streams_opened')
+        stream.last_seen = now
+        return stream
+
+    def _CloseStream(self, stream_id):
+        stream = self.streams.pop(stream_id, None)
+        if stream is None:
+            return False
+        if stream.tracker is not None and stream.tracker.track_log is not None:
+            stream.tracker.track_log.Close()
+        return True
+
+    def _CloseStreams(self):
+        for stream_id in list(self.streams):
+            self._CloseStream(stream_id)
+
+
+def _PopOption(argv, name, default):
+    # Removes "name value" from argv and returns (value, argv).
+    if name not in argv:
+        return default, argv
+    index = argv.index(name)
+    return argv[index + 1], argv[:index] + argv[index + 2:]
+
+
+def main(argv):
+    from neuralnetprediction import NetworkModel
+
+    tcp, argv = _PopOption(argv, '--tcp', None)
+    path, argv = _PopOption(argv, '--unix', None)
+    batch_size, argv = _PopOption(argv, '--batch-size', 8)
+    batch_delay_ms, argv = _PopOption(argv, '--batch-delay-ms', 5)
+    stereo_workers, argv = _PopOption(argv, '--stereo-workers', 2)
+    stereo_preset, argv = _PopOption(argv, '--stereo', 'balanced')
+    if tcp is None and path is None:
+        path = '/tmp/vd.sock'
+    host, port = (None, None) if tcp is None else (tcp.rsplit(':', 1)[0], int(tcp.rsplit(':', 1)[1]))
+
+    model = NetworkModel(roi_stereo='roi' in argv, stereo_preset=stereo_preset, log_tracks='log-tracks' in argv)
+    server = TrackingServer(model, max_batch_size=int(batch_size), max_batch_delay=float(batch_delay_ms) / 1000,
+                            stereo_workers=int(stereo_workers))
+    print("Serving on {}".format(path if path is not None else tcp), flush=True)
+    try:
+        asyncio.run(server.Serve(host, port, path))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,93 @@
+################################################################################
+#
+# Compares the stereo quality presets on a KITTI tracking sequence. For every
+# preset it reports the stereo time per frame and the error of the 3D position
+# we get for each labelled car, using the ground truth 2D boxes as detections
+# so only the stereo side is measured.
+#
+# Usage:
+# python evaluation/stereo_benchmark.py 0010
+# python evaluation/stereo_benchmark.py 0010 50
+#
+################################################################################
+
+
+import sys
+import os
+import time
+import cv2
+import numpy as np
+from StereoDepth import StereoEngine, Convert3D
+from groundtruth import GroundTruthParser
+
+# (name, StereoEngine kwargs)
+CONFIGS = [('fast', {'preset': 'fast'}),
+           ('balanced', {'preset': 'balanced'}),
+           ('pyramid', {'preset': 'balanced-pyramid'}),
+           ('accurate', {'preset': 'accurate'})]
+
+def LoadFrames(sequence_name, num_frames):
+    vd_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    directory_l = os.path.join(vd_directory, "data/KITTI-tracking/training/image_02/", sequence_name)
+    directory_r = os.path.join(vd_directory, "data/KITTI-tracking/training/image_03/", sequence_name)
+    groundtruth = GroundTruthParser().ReadGroundTruthSequence(sequence_name)
+
+    frames = []
+    for filename in sorted(os.listdir(directory_l))[:num_frames]:
+        if not filename.endswith('.png'):
+            continue
+        frame_number = int(os.path.splitext(filename)[0])
+        frames.append((cv2.imread(os.path.join(directory_l, filename)),
+                       cv2.imread(os.path.join(directory_r, filename)),
+                       groundtruth[frame_number]['tracked_objects']))
+    return frames
+
+def _GroundTruthBoxes(gt_objects):
+    return [{'topleft': {'x': obj['bbox']['left'], 'y': obj['bbox']['top']},
+             'bottomright': {'x': obj['bbox']['right'], 'y': obj['bbox']['bottom']}} for obj in gt_objects]
+
+def BenchmarkConfig(frames, **engine_kwargs):
+    engine = StereoEngine(**engine_kwargs)
+    stereo_times = []
+    position_times = []
+    errors = []
+    depth_errors = []
+
+    for img_l, img_r, gt_objects in frames:
+        frame = Convert3D(img_l, img_r, _GroundTruthBoxes(gt_objects), engine=engine)
+        start = time.perf_counter()
+        frame.depth_img
+        stereo_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        positions = frame.positions_3D
+        position_times.append(time.perf_counter() - start)
+
+        for position, gt_object in zip(positions, gt_objects):
+            if np.any(np.isnan(position)):
+                continue
+            errors.append(np.linalg.norm(np.array(position) - np.array(gt_object['3dbbox_loc'])))
+            depth_errors.append(abs(position[2] - gt_object['3dbbox_loc'][2]))
+
+    return {'stereo_ms': 1000 * np.mean(stereo_times),
+            'positions_ms': 1000 * np.mean(position_times),
+            'objects': len(errors),
+            'median_error_m': np.median(errors) if errors else np.nan,
+            'mean_error_m': np.mean(errors) if errors else np.nan,
+            'median_depth_error_m': np.median(depth_errors) if depth_errors else np.nan}
+
+def main(argv):
+    sequence_name = argv[1] if len(argv) > 1 else '0010'
+    num_frames = int(argv[2]) if len(argv) > 2 else 100
+    frames = LoadFrames(sequence_name, num_frames)
+    print("Sequence {}, {} frames".format(sequence_name, len(frames)))
+
+    print("{:<10} {:>10} {:>10} {:>8} {:>10} {:>10} {:>12}".format('preset', 'stereo ms', 'pos ms', 'objects', 'median m', 'mean m', 'median dz m'))
+    for name, engine_kwargs in CONFIGS:
+        result = BenchmarkConfig(frames, **engine_kwargs)
+        print("{:<10} {:>10.1f} {:>10.2f} {:>8} {:>10.2f} {:>10.2f} {:>12.2f}".format(
+            name, result['stereo_ms'], result['positions_ms'], result['objects'],
+            result['median_error_m'], result['mean_error_m'], result['median_depth_error_m']))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,87 @@
+################################################################################
+#
+# Append-only on-disk log of track states, for analysing a run offline.
+# The trackers only keep a short ring buffer of history in memory; pass a
+# TrackLog to have every state they produce written out as well.
+#
+# File layout:
+#   MAGIC
+#   one JSON line: {"fields": [...]}
+#   float64 rows of (track_id, step, *fields), little-endian
+#
+# Rows are buffered and written in blocks, so logging costs one memcpy per
+# track per frame. ReadTrackLog returns the whole log as a structured array.
+#
+################################################################################
+
+import json
+import numpy as np
+
+MAGIC = b'VDTRACKLOG1\n'
+
+
+class TrackLog:
+    def __init__(self, path, fields, buffer_rows=4096):
+        self.path = path
+        self.fields = list(fields)
+        self.next_track_id = 0
+        self.buffer = np.zeros((buffer_rows, 2 + len(self.fields)), dtype='<f8')
+        self.buffered = 0
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.file.write(json.dumps({'fields': self.fields}).encode('utf-8') + b'\n')
+
+    def NewTrackId(self):
+        track_id = self.next_track_id
+        self.next_track_id += 1
+        return track_id
+
+    def NewTrackIds(self, count):
+        track_ids = np.arange(self.next_track_id, self.next_track_id + count)
+        self.next_track_id += count
+        return track_ids
+
+    def Append(self, track_id, step, values):
+        self.AppendMany([track_id], step, np.reshape(values, (1, -1)))
+
+    def AppendMany(self, track_ids, step, values):
+        # One row per track. values is (len(track_ids), len(fields)).
+        values = np.asarray(values, dtype=np.float64).reshape(len(track_ids), len(self.fields))
+        if self.buffered + len(values) > len(self.buffer):
+            self.Flush()
+        if len(values) > len(self.buffer):
+            rows = np.column_stack([track_ids, np.full(len(values), step), values]).astype('<f8')
+            self.file.write(rows.tobytes())
+            return
+        rows = self.buffer[self.buffered:self.buffered + len(values)]
+        rows[:, 0] = track_ids
+        rows[:, 1] = step
+        rows[:, 2:] = values
+        self.buffered += len(values)
+
+    def Flush(self):
+        self.file.write(self.buffer[:self.buffered].tobytes())
+        self.buffered = 0
+        self.file.flush()
+
+    def Close(self):
+        if not self.file.closed:
+            self.Flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+
+def ReadTrackLog(path):
+    # Returns a structured array with track_id, step and the logged fields.
+    with open(path, 'rb') as f:
+        if f.readline() != MAGIC:
+            raise ValueError("{} is not a track log".format(path))
+        fields = json.loads(f.readline().decode('utf-8'))['fields']
+        data = np.frombuffer(f.read(), dtype='<f8')
+    dtype = np.dtype([(name, '<f8') for name in ['track_id', 'step'] + fields])
+    return data.view(dtype)
@@ -5,6 +5,47 @@
 # python generate.py 0010 visualize
 # python generate.py visualize 0011 0012 0017
 # python generate.py all
+# python generate.py all --workers 4
+# python generate.py all --workers 4 --gpu 0
+# python generate.py pipeline 0010
+# python generate.py all --batch-size 8
+# python generate.py roi 0010
+# python generate.py all --stereo fast
+# python generate.py 0010 --format pickle
+# python generate.py 0010 --artifacts full
+# python generate.py 0010 log-tracks
+# python generate.py 0010 --trace json
+# python generate.py 0010 --profile 20:40 --profiler sampling
+#
+# With --workers N, sequences are sharded across N processes. Each worker
+# loads its own network once and keeps its own tracker state. Visualization
+# is only available when running with a single worker.
+# --gpu F is the share of GPU memory the network may use (default 0.8). All
+# workers share one GPU, so each gets F / N of it; --gpu 0 runs every worker
+# on the CPU instead, which is the better choice when F / N is too small to
+# hold the network.
+#
+# With pipeline, image decode, stereo and output writing overlap with the
+# detector inside each sequence, and per-stage timings are printed at the end.
+# With --batch-size K, K frames share one detector forward pass.
+# With roi, stereo is only matched around detections and no point cloud is
+# saved.
+# --stereo picks the stereo quality preset: fast, balanced-pyramid, balanced
+# (default) or accurate. Use evaluation/stereo_benchmark.py to compare them.
+# Frames are written to eval/<seq>/predictions.frames and groundtruth.frames
+# (see evaluation/framestore.py). --format pickle writes the old one pickle
+# per frame directories instead.
+# --artifacts picks what is saved besides the tracked objects: detections
+# (default), depth (downsampled disparity) or full (left image, disparity and
+# point cloud). The players recompute missing images and point clouds from
+# the KITTI images.
+# With log-tracks, every tracker state is also written to
+# eval/<seq>/tracks_kalman.log (see evaluation/tracklog.py).
+# --trace json|csv records per-stage timings, counters and percentiles for
+# every sequence and writes them to eval/<seq>/generate_trace.json (or .csv).
+# --profile START:STOP profiles frames START to STOP into
+# eval/<seq>/generate_profile.prof, or with --profiler sampling into a
+# .folded flame graph file. See evaluation/instrumentation.py.
 #
 ################################################################################
 
@@ -15,31 +56,124 @@ import sys
 sys.path.append('./evaluation')
 sys.path.append('./visualization')
 import os
+import time
+import traceback
+import multiprocessing
 from neuralnetprediction import *
 from groundtruth import *
 from visualization2d import PlaySequence
+import instrumentation
+
+# Per-process state for --workers mode. Set up once by _InitWorker.
+_worker_gtparser = None
+_worker_model = None
+_worker_instrumentation = {}
+
+def _InitWorker(batch_size=1, roi_stereo=False, stereo_preset='balanced', output_format='store', artifacts='detections', log_tracks=False, instrumentation_options={}, gpu_fraction=0.8):
+    global _worker_gtparser, _worker_model, _worker_instrumentation
+    _worker_gtparser = GroundTruthParser()
+    _worker_model = NetworkModel(batch_size, roi_stereo, stereo_preset, output_format, artifacts, log_tracks, gpu_fraction=gpu_fraction)
+    _worker_instrumentation = instrumentation_options
+
+def _RunSequence(args):
+    sequence_name, pipeline = args
+    # Runs in a worker process. Never raises; failures are reported back to
+    # the parent so one bad sequence doesn't take down the whole batch.
+    start = time.time()
+    try:
+        _worker_gtparser.OutGroundTruthSequence(sequence_name, output_format=_worker_model.output_format)
+        with instrumentation.Session(_worker_instrumentation, os.path.join(_worker_model.vd_directory, 'eval', sequence_name), 'generate', show_summary=False):
+            _worker_model.PredictSequence(sequence_name, show_progress=False, pipeline=pipeline)
+        return sequence_name, None, time.time() - start
+    except Exception:
+        return sequence_name, traceback.format_exc(), time.time() - start
+
+def RunParallel(sequences, workers, pipeline=False, batch_size=1, roi_stereo=False, stereo_preset='balanced', output_format='store', artifacts='detections', log_tracks=False, instrumentation_options={}, gpu_fraction=0.8):
+    # TensorFlow is not fork-safe, so always start fresh interpreters.
+    context = multiprocessing.get_context('spawn')
+    # gpu_fraction is for all workers together; each one reserves its share.
+    worker_gpu_fraction = gpu_fraction / workers
+    results = {}
+    next_to_report = 0
+    failures = []
+
+    print("Running Model on {} sequences with {} workers ({})".format(len(sequences), workers,
+          "{:.2f} of the GPU each".format(worker_gpu_fraction) if worker_gpu_fraction > 0 else "CPU only"))
+
+    with context.Pool(processes=workers, initializer=_InitWorker, initargs=(batch_size, roi_stereo, stereo_preset, output_format, artifacts, log_tracks, instrumentation_options, worker_gpu_fraction)) as pool:
+        for sequence_name, error, elapsed in pool.imap_unordered(_RunSequence, [(sequence_name, pipeline) for sequence_name in sequences]):
+            results[sequence_name] = (error, elapsed)
+
+            # Report in sequence order, as soon as every earlier sequence is done.
+            while next_to_report < len(sequences) and sequences[next_to_report] in results:
+                name = sequences[next_to_report]
+                error, elapsed = results[name]
+                status = "FAILED" if error else "done"
+                print("[{}/{}] Sequence {} {} in {:.1f}s".format(next_to_report + 1, len(sequences), name, status, elapsed), flush=True)
+                if error:
+                    failures.append((name, error))
+                next_to_report += 1
+
+    print("Finished {}/{} sequences".format(len(sequences) - len(failures), len(sequences)))
+    if failures:
+        print("Failed sequences:")
+        for name, error in failures:
+            print("---- Sequence {} ----".format(name))
+            print(error)
+
+    return failures
+
+def _PopOption(argv, name, default):
+    # Removes "name value" from argv and returns (value, argv).
+    if name not in argv:
+        return default, argv
+    index = argv.index(name)
+    return argv[index + 1], argv[:index] + argv[index + 2:]
 
 def main(argv):
+    workers, argv = _PopOption(argv, '--workers', 1)
+    workers = int(workers)
+    batch_size, argv = _PopOption(argv, '--batch-size', 1)
+    batch_size = int(batch_size)
+    stereo_preset, argv = _PopOption(argv, '--stereo', 'balanced')
+    gpu_fraction, argv = _PopOption(argv, '--gpu', 0.8)
+    gpu_fraction = float(gpu_fraction)
+    output_format, argv = _PopOption(argv, '--format', 'store')
+    artifacts, argv = _PopOption(argv, '--artifacts', 'detections')
+    instrumentation_options, argv = instrumentation.PopOptions(argv)
+
     if 'all' in argv:
         sequences = [str(seq_num).zfill(4) for seq_num in range(0, 21)]
     else:
-        sequences = [arg for arg in argv[1:] if arg != 'visualize' and arg != 'all']
+        sequences = [arg for arg in argv[1:] if arg not in ('visualize', 'all', 'pipeline', 'roi', 'log-tracks')]
 
     if 'visualize' in argv:
         visualize = True
     else:
         visualize = False
 
+    pipeline = 'pipeline' in argv
+    roi_stereo = 'roi' in argv
+    log_tracks = 'log-tracks' in argv
 
     vd_path = os.getcwd()
+
+    if workers > 1:
+        if visualize:
+            print("Visualization is not supported with --workers, ignoring")
+        failures = RunParallel(sequences, workers, pipeline, batch_size, roi_stereo, stereo_preset, output_format, artifacts, log_tracks, instrumentation_options, gpu_fraction)
+        os.chdir(vd_path)
+        return 1 if failures else 0
+
     gtparser = GroundTruthParser()
-    model = NetworkModel()
+    model = NetworkModel(batch_size, roi_stereo, stereo_preset, output_format, artifacts, log_tracks, gpu_fraction=gpu_fraction)
 
     print("Running Model")
 
     for sequence_name in sequences:
-        gtparser.OutGroundTruthSequence(sequence_name)
-        model.PredictSequence(sequence_name, visualize)
+        gtparser.OutGroundTruthSequence(sequence_name, output_format=output_format)
+        with instrumentation.Session(instrumentation_options, os.path.join(model.vd_directory, 'eval', sequence_name), 'generate'):
+            model.PredictSequence(sequence_name, visualize, pipeline=pipeline)
 
         #if visualize:
         #    PlaySequence(sequence_name, vd_path)
@@ -47,4 +181,4 @@ def main(argv):
     os.chdir(vd_path)
 
 if __name__ == '__main__':
-    main(sys.argv)
+    sys.exit(main(sys.argv))
@@ -28,22 +28,14 @@ class Obstacle:
     def get_dims(self):
         return (self.top, self.bot, self.left, self.right)
 
-# Process a single image and return a list of obstacle objects.
-def process_image(image_path):
-    base_path = "/home/anthony/darknet/"
-
-    # Have to change dirs because yolo(darknet) has to be run from within it's directory.
-    # Looks to be a known issue people are complaining about.
-    os.chdir(base_path)
+DARKNET_PATH = "/home/anthony/darknet/"
 
-    # TODO: Suppress whatever output is 1,2,3 ... 106 yolo.
-    # TODO: When it's loading weights, can I hold that in memory for multiple image processes?
-    program_path = base_path + "darknet"
-    args_list = ["detect", base_path + "cfg/yolov3.cfg", base_path + "yolov3.weights", image_path]
-
-    # Get the output from our program and decode it into a UTF-8 string
-    output = subprocess.check_output([program_path] + args_list).decode('utf-8')
+# darknet prints this (without a newline) whenever it's waiting for the next
+# image path on stdin.
+DARKNET_PROMPT = "Enter Image Path:"
 
+# Turn darknet's detection output for one image into obstacle objects.
+def parse_obstacles(output):
     obstacles = []
 
     # Looking at lines 1-end to get our obstacles.
@@ -58,8 +50,6 @@ def process_image(image_path):
         second_line = lines[i+1]
         first_split = first_line.split(": ")
         second_split = second_line.split(",")
-        print(first_split)
-        print(second_split)
 
         classification = first_split[0]
         prob = float(first_split[1].strip("%")) * 0.01
@@ -74,9 +64,81 @@ def process_image(image_path):
 
     return obstacles
 
-def get_obstacle_dims(left_image_path):
+# Process a single image and return a list of obstacle objects.
+# This starts a fresh darknet process (and reloads the weights) for every
+# image. Use DarknetDetector when processing more than a handful of images.
+def process_image(image_path, base_path=DARKNET_PATH):
+    # yolo(darknet) has to be run from within it's directory.
+    # Looks to be a known issue people are complaining about.
+    program_path = base_path + "darknet"
+    args_list = ["detect", base_path + "cfg/yolov3.cfg", base_path + "yolov3.weights", image_path]
 
-    obstacles = process_image(left_image_path)
+    # Get the output from our program and decode it into a UTF-8 string
+    output = subprocess.check_output([program_path] + args_list, cwd=base_path).decode('utf-8')
+
+    return parse_obstacles(output)
+
+# Long-lived darknet process. The weights are loaded once when the detector
+# is created; after that darknet sits at its interactive prompt and we feed
+# it one image path at a time over stdin.
+class DarknetDetector:
+
+    def __init__(self, base_path=DARKNET_PATH):
+        self.base_path = base_path
+        program_path = base_path + "darknet"
+        args_list = ["detect", base_path + "cfg/yolov3.cfg", base_path + "yolov3.weights"]
+
+        # cwd instead of os.chdir so the caller's working directory is left alone.
+        self.process = subprocess.Popen([program_path] + args_list, cwd=base_path,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        # Wait for the weights to load.
+        self._read_until_prompt()
+
+    def _read_until_prompt(self):
+        output = b""
+        prompt = DARKNET_PROMPT.encode('utf-8')
+        fd = self.process.stdout.fileno()
+        while not output.rstrip().endswith(prompt):
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise RuntimeError("darknet exited unexpectedly (code {})".format(self.process.poll()))
+            output += chunk
+        return output.rstrip()[:-len(prompt)].decode('utf-8')
+
+    def detect(self, image_path):
+        # Paths are resolved relative to the caller, not the darknet directory.
+        self.process.stdin.write((os.path.abspath(image_path) + "\n").encode('utf-8'))
+        self.process.stdin.flush()
+        return parse_obstacles(self._read_until_prompt())
+
+    def detect_directory(self, images_path):
+        # Returns a list of (file name, obstacles) for every image in images_path.
+        results = []
+        for file in sorted(os.listdir(images_path)):
+            results.append((file, self.detect(os.path.join(images_path, file))))
+        return results
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.terminate()
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _get_obstacles(left_image_path, detector=None):
+    if detector is None:
+        return process_image(left_image_path)
+    return detector.detect(left_image_path)
+
+def get_obstacle_dims(left_image_path, detector=None):
+
+    obstacles = _get_obstacles(left_image_path, detector)
 
     dims_list = []
 
@@ -85,9 +147,7 @@ def get_obstacle_dims(left_image_path):
 
     return dims_list
 
-def get_obstacle_info(left_image_path):
-
-    obstacles = process_image(left_image_path)
+def obstacle_info(obstacles):
 
     info_list = []
 
@@ -101,28 +161,31 @@ def get_obstacle_info(left_image_path):
 
     return info_list
 
+def get_obstacle_info(left_image_path, detector=None):
+
+    return obstacle_info(_get_obstacles(left_image_path, detector))
+
 def main():
 
     #images_path = sys.argv[1]
 
     # TODO: BUG at 0000-left/000016.png. For some reason outputs a car without dimensions print...
     # Creating a pickled representation of all the bounding boxes from a stream of ~300 images.
-    for i in range(11, 15):
-        images_path = "/home/anthony/git/vehicle-detection/kitti/00{:02d}-left/".format(i)
-        #images_path = "/home/anthony/git/vehicle-detection/kitti/0010-left/"
-
-        info_list = []
-        left_files = sorted(os.listdir(images_path))
-
-        for file in left_files:
-            left_image_file_path = images_path + file
-            obstacles = get_obstacle_info(left_image_file_path)
-            info_list.append(obstacles)
-            print(left_image_file_path)
-
-        nparray = np.array([np.array(obstacles) for obstacles in info_list])
-        save_path = "/home/anthony/git/vehicle-detection/" + images_path.split("/")[-2] + ".pyc"
-        np.save(save_path, nparray, allow_pickle=True)
+    # The weights are loaded once and shared by every sequence.
+    with DarknetDetector() as detector:
+        for i in range(11, 15):
+            images_path = "/home/anthony/git/vehicle-detection/kitti/00{:02d}-left/".format(i)
+            #images_path = "/home/anthony/git/vehicle-detection/kitti/0010-left/"
+
+            info_list = []
+
+            for file, obstacles in detector.detect_directory(images_path):
+                info_list.append(obstacle_info(obstacles))
+                print(images_path + file)
+
+            nparray = np.array([np.array(obstacles) for obstacles in info_list])
+            save_path = "/home/anthony/git/vehicle-detection/" + images_path.split("/")[-2] + ".pyc"
+            np.save(save_path, nparray, allow_pickle=True)
 
 if __name__ == "__main__":
      main()
@@ -11,6 +11,7 @@ sys.path.append(os.path.join(vd_directory, 'evaluation'))
 import numpy as np
 import open3d as o3d
 from StereoDepth import *
+from framestore import OpenFrames, PointClouds
 import os
 import pickle
 
@@ -47,10 +48,11 @@ if __name__ == "__main__":
     SCALE_FACTOR = 100
 
     first_sequence_folder = os.listdir(os.path.join(vd_directory, 'eval'))[1]
-    prediction_file_path = os.path.join(vd_directory, 'eval', first_sequence_folder, 'predictions/000000')
+    predictions = OpenFrames(os.path.join(vd_directory, 'eval', first_sequence_folder, 'predictions'))
+    frame_name = predictions.FrameNames()[0]
 
     pcd = o3d.geometry.PointCloud()
-    pc = loadFrameData(prediction_file_path)['point_cloud']
+    pc = PointClouds(vd_directory, first_sequence_folder).Load(frame_name, predictions.LoadFrame(frame_name, sections=('point_cloud',)))
     scaled_pc = np.clip(pc * SCALE_FACTOR, -10000, 10000)
     pcd.points = o3d.utility.Vector3dVector(np.int16(scaled_pc))
 
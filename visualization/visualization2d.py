@@ -7,6 +7,10 @@
 # Usage:
 # python visualization2d.py 0010
 # python visualization2d.py 0011 0014 0011
+# python visualization2d.py 0010 --trace json
+#
+# --trace and --profile record where playback time goes, see
+# evaluation/instrumentation.py. Files go to eval/<seq>/play2d_*.
 #
 ################################################################################
 
@@ -16,6 +20,9 @@ import os
 import sys
 import pickle
 import cv2
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evaluation'))
+from framestore import OpenFrames, LoadSourceImage
+import instrumentation
 
 def loadFrameData(filename):
     with open(filename, 'rb') as f:
@@ -44,25 +51,35 @@ def PlaySequence(sequence_name):
     _, ax = plt.subplots(figsize=(20, 10))
     im = None
 
-    for file_name in sorted(os.listdir(prediction_path)):
-        if file_name == '.DS_Store':
-            continue
-        prediction_file_path = os.path.join(prediction_path, file_name)
-        groundtruth_file_path = os.path.join(groundtruth_path, file_name)
+    predictions = OpenFrames(prediction_path)
+    groundtruths = OpenFrames(groundtruth_path)
 
-        img = Draw2DBoxes(loadFrameData(prediction_file_path), loadFrameData(groundtruth_file_path))
+    for frame_name in predictions.FrameNames():
+        with instrumentation.Frame(frame_name):
+            with instrumentation.Time('load'):
+                prediction = predictions.LoadFrame(frame_name, sections=('image_l',))
+                if prediction.get('image_l') is None:
+                    # Written without images, see framestore.ARTIFACT_POLICIES.
+                    prediction['image_l'] = LoadSourceImage(vd_directory, sequence_name, frame_name)
+                groundtruth = groundtruths.LoadFrame(frame_name, sections=())
+            with instrumentation.Time('draw'):
+                img = Draw2DBoxes(prediction, groundtruth)
 
-        if not im:
-            im = ax.imshow(img)
-        else:
-            im.set_data(img)
-        plt.pause(0.01)
-        plt.draw()
+            with instrumentation.Time('render'):
+                if not im:
+                    im = ax.imshow(img)
+                else:
+                    im.set_data(img)
+                plt.pause(0.01)
+                plt.draw()
 
 
 def main(argv):
+    instrumentation_options, argv = instrumentation.PopOptions(argv)
+    vd_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
     for sequence in argv[1:]:
-        PlaySequence(sequence)
+        with instrumentation.Session(instrumentation_options, os.path.join(vd_directory, 'eval', sequence), 'play2d'):
+            PlaySequence(sequence)
 
 if __name__ == '__main__':
     main(sys.argv)
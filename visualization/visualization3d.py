@@ -8,6 +8,10 @@
 # Usage:
 # python visualization3d.py 0010
 # python visualization3d.py 0011 0014 0011
+# python visualization3d.py 0010 --profile 0:50 --profiler sampling
+#
+# --trace and --profile record where playback time goes, see
+# evaluation/instrumentation.py. Files go to eval/<seq>/play3d_*.
 #
 ################################################################################
 
@@ -22,6 +26,8 @@ vd_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 sys.path.append(vd_directory)
 sys.path.append(os.path.join(vd_directory, 'evaluation'))
 from StereoDepth import Convert3D
+from framestore import OpenFrames, PointClouds
+import instrumentation
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
@@ -36,7 +42,7 @@ def loadFrameData(filename):
     with open(filename, 'rb') as f:
         return pickle.load(f)
 
-def PlaySequence(sequence_name, show_point_cloud = True):
+def PlaySequence(sequence_name, show_point_cloud = True, cache_point_clouds = True):
     vd_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
     groundtruth_path = os.path.join(vd_directory, 'eval', sequence_name, 'groundtruth')
     prediction_path = os.path.join(vd_directory, 'eval', sequence_name, 'predictions')
@@ -57,65 +63,69 @@ def PlaySequence(sequence_name, show_point_cloud = True):
 
     i = 0
 
-    for file_name in sorted(os.listdir(prediction_path)):
-        if file_name == '.DS_Store':
-            continue
-        prediction_file_path = os.path.join(prediction_path, file_name)
-        groundtruth_file_path = os.path.join(groundtruth_path, file_name)
-
-        prediction_frame_data = loadFrameData(prediction_file_path)
-        groundtruth_frame_data = loadFrameData(groundtruth_file_path)
-
-        if show_point_cloud:
-            pc = prediction_frame_data['point_cloud']
-            scaled_pc = np.clip(pc * SCALE_FACTOR, -10000, 10000)
-            pcd.points = o3d.utility.Vector3dVector(np.int16(scaled_pc))
-            #color = [0.2, 0.3, 0.7]
-            #pcd.colors = o3d.utility.Vector3dVector([color for i in range(len(scaled_pc))])
-
-        # clear old bounding boxes --------
-        for bbox in bounding_boxes:
-            vis.remove_geometry(bbox)
-        # clear old bounding boxes --------
-
-        if i == 0:
-            # Add point cloud at first step, otherwise update
-            vis.add_geometry(pcd)
-            pass
-
-        # add predicted bounding boxes-------------------------------------------
-        for tracked_object in prediction_frame_data['tracked_objects']:  # frame.positions_3D is a list of positions (multiple if we detect more than one car in the same frame)
-            # pos is a list of xyz, e.g. [0.45 3.10 5.0]
-            pos = tracked_object['3dbbox_loc']
-            color = [0, tracked_object['confidence'], 0]
-            bbox = bounding_box(pos, color)
-            vis.add_geometry(bbox)  # add bounding box to visualizer
-            bounding_boxes.append(bbox)  # add it to line_sets so we can clear it at the next iteration
-
-
-        # Add 3D bounding box ground truth labels
-        for tracked_object in groundtruth_frame_data['tracked_objects']:
-            # [0] alpha, [5] 3d_height, [6] 3d_width, [7] 3d_length, [8] x, [9] y, [10] z
-            # TODO: Is alpha being used inside bounding_box ?
-            #pos = [label[8], label[9], label[10]]
-            pos = tracked_object['3dbbox_loc']
-            color = [1, 0, 0]
-            #bbox = bounding_box(pos, color, label[0])
-            bbox = bounding_box(pos, color)
-            vis.add_geometry(bbox)
-            bounding_boxes.append(bbox)
-
-
-        # Change Camera Position --------------------------------------
-        ctr = vis.get_view_control() # load viewpoint
-        param = o3d.io.read_pinhole_camera_parameters('viewpoint.json')
-        ctr.convert_from_pinhole_camera_parameters(param)
-        # Change Camera Position --------------------------------------
-
-
-        vis.poll_events()
-        vis.update_renderer()
-        vis.update_geometry()
+    predictions = OpenFrames(prediction_path)
+    groundtruths = OpenFrames(groundtruth_path)
+    # Sequences written without point clouds get them from the stereo pair.
+    point_clouds = PointClouds(vd_directory, sequence_name, cache=cache_point_clouds)
+
+    for frame_name in predictions.FrameNames():
+        with instrumentation.Frame(frame_name):
+            with instrumentation.Time('load'):
+                prediction_frame_data = predictions.LoadFrame(frame_name, sections=('point_cloud',) if show_point_cloud else ())
+                groundtruth_frame_data = groundtruths.LoadFrame(frame_name, sections=())
+
+            if show_point_cloud:
+                with instrumentation.Time('point_cloud'):
+                    pc = point_clouds.Load(frame_name, prediction_frame_data)
+                scaled_pc = np.clip(pc * SCALE_FACTOR, -10000, 10000)
+                pcd.points = o3d.utility.Vector3dVector(np.int16(scaled_pc))
+                #color = [0.2, 0.3, 0.7]
+                #pcd.colors = o3d.utility.Vector3dVector([color for i in range(len(scaled_pc))])
+
+            # clear old bounding boxes --------
+            for bbox in bounding_boxes:
+                vis.remove_geometry(bbox)
+            # clear old bounding boxes --------
+
+            if i == 0:
+                # Add point cloud at first step, otherwise update
+                vis.add_geometry(pcd)
+                pass
+
+            # add predicted bounding boxes-------------------------------------------
+            for tracked_object in prediction_frame_data['tracked_objects']:  # frame.positions_3D is a list of positions (multiple if we detect more than one car in the same frame)
+                # pos is a list of xyz, e.g. [0.45 3.10 5.0]
+                pos = tracked_object['3dbbox_loc']
+                color = [0, tracked_object['confidence'], 0]
+                bbox = bounding_box(pos, color)
+                vis.add_geometry(bbox)  # add bounding box to visualizer
+                bounding_boxes.append(bbox)  # add it to line_sets so we can clear it at the next iteration
+
+
+            # Add 3D bounding box ground truth labels
+            for tracked_object in groundtruth_frame_data['tracked_objects']:
+                # [0] alpha, [5] 3d_height, [6] 3d_width, [7] 3d_length, [8] x, [9] y, [10] z
+                # TODO: Is alpha being used inside bounding_box ?
+                #pos = [label[8], label[9], label[10]]
+                pos = tracked_object['3dbbox_loc']
+                color = [1, 0, 0]
+                #bbox = bounding_box(pos, color, label[0])
+                bbox = bounding_box(pos, color)
+                vis.add_geometry(bbox)
+                bounding_boxes.append(bbox)
+
+
+            # Change Camera Position --------------------------------------
+            ctr = vis.get_view_control() # load viewpoint
+            param = o3d.io.read_pinhole_camera_parameters('viewpoint.json')
+            ctr.convert_from_pinhole_camera_parameters(param)
+            # Change Camera Position --------------------------------------
+
+
+            with instrumentation.Time('render'):
+                vis.poll_events()
+                vis.update_renderer()
+                vis.update_geometry()
         i += 1
         #time.sleep(0.75)
 
@@ -152,8 +162,10 @@ def bounding_box(pos, color, alpha=0, bbox_size=(1, 1, 1)):
     return line_set
 
 def main(argv):
+    instrumentation_options, argv = instrumentation.PopOptions(argv)
     for sequence in argv[1:]:
-        PlaySequence(sequence)
+        with instrumentation.Session(instrumentation_options, os.path.join(vd_directory, 'eval', sequence), 'play3d'):
+            PlaySequence(sequence)
 
 if __name__ == '__main__':
     main(sys.argv)